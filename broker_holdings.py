@@ -43,6 +43,8 @@ holdings_headings = ['h_ref',
                      'prime',
                      'src_ref',
                      'src_file']
+# a holding within a load - reloaded rows with the same values keep their h_ref
+holdings_keys = ['date', 'prime', 'src', 'src_ref', 'on_swap', 'type', 'sedol', 'bb_code', 'ric', 'isin', 'curr_swap']
 
 # manual overrides for assets
 ticker_map_manual = pd.DataFrame([
@@ -100,8 +102,9 @@ isin_manual_clear = ['AU0000354565', 'KRA0054201D5', 'AU0000306110','AU000030690
 # these are  all on swap..missing the physicals which are in the "custody and cont" file
 def process_gs_holdings(path=workflow_path + '/Holdings/20211214/GS', this_date=datetime.date(2021, 12, 14),
                         ops_param={}):
-    india_ssf_map = ou.exec_sql("select * from zimdb_ops..india_ssf_multiplier").set_index('ric_code')   
-    index_map = ou.exec_sql("select replace(bb_code, ' Index', '') as bb_code, replace(bb_code_long, ' Equity', '') as bb_code_z from zimdb..universe_backfill where sedol like '_SWAP%'")
+    india_ssf_map, index_map = ou.exec_sql_batch(["select * from zimdb_ops..india_ssf_multiplier",
+                                                  "select replace(bb_code, ' Index', '') as bb_code, replace(bb_code_long, ' Equity', '') as bb_code_z from zimdb..universe_backfill where sedol like '_SWAP%'"])
+    india_ssf_map = india_ssf_map.set_index('ric_code')
     index_map = index_map.append(pd.DataFrame([['CSIN00905', '.CSIN905 CH']],
                              columns = ['bb_code', 'bb_code_z']))
     index_map = index_map.set_index('bb_code')['bb_code_z']
@@ -236,11 +239,9 @@ def process_gs_holdings(path=workflow_path + '/Holdings/20211214/GS', this_date=
                         wb.iloc[20, 0] == 'TOTAL'):
                     this_line['margin'] = wb.iloc[20, 7]
             if this_line['cash'] != np.nan:
-                sqlcmd = "delete from [" + ops_param['db'] + "]..[" + ops_param[
-                    'broker_margin_table'] + "] where [date] = '" + str(this_date) + "'"
-                ou.exec_sql(sqlcmd, isselect=0)
-                ou.load_to_table(df=pd.DataFrame(this_line).transpose(), table=ops_param['broker_margin_table'],
-                                db='zimdb_ops')
+                # replace every margin row for the date - the delete and insert run in one transaction
+                ou.upsert_table(pd.DataFrame(this_line).transpose(), ops_param['broker_margin_table'], db=ops_param['db'],
+                                keys=['date'], delete_scope=['date'], mode='delete_insert')
     return gs_keep[holdings_headings]
 
 
@@ -1226,8 +1227,12 @@ def process_bbg_holdings(path=workflow_path + '/Holdings/20150618/Bloomberg', th
     return bbg_keep[holdings_headings]
 
 
+# load_mode for overwrite_exist_dates: 'upsert' merges on h_ref within the loaded dates - a holding
+# already loaded (same holdings_keys) keeps its h_ref, so only the changed rows are written
+# 'swap' loads each date to a shadow table and switches its partition in - the table must be
+# partitioned by date (see ou.swap_load_dates)
 def parse_holding_files(path=workflow_path + "/Holdings/", start_date=None, end_date=None, overwrite_exist_dates=True,
-                        ops_param={}):
+                        ops_param={}, load_mode='upsert'):
     db = ops_param['db']
     broker_holdings_table = ops_param['broker_holdings_table']
     bulk_load_path = ops_param['bulk_load_path']
@@ -1298,23 +1303,26 @@ def parse_holding_files(path=workflow_path + "/Holdings/", start_date=None, end_
 
     # strip comma's from name
     result['name'] = [x.replace(",", "") if type(x) == str else x for x in result['name']]
-    # calculate and update the z_ref
-    tmp = \
-        ou.exec_sql("select coalesce(max(h_ref),0) from [" + db + "]..[" + broker_holdings_table + "]", isselect=1).ix[
-            0, 0]
-    result['h_ref'] = [x for x in range(tmp + 1, tmp + len(result) + 1)]
+    table_cols = ou.sql_table_cols(broker_holdings_table, db=db, alias='zim_ops')
+    if overwrite_exist_dates and load_mode != 'swap':
+        # holdings already loaded keep their h_ref - new ones get ids reserved from the table sequence
+        result['h_ref'] = ou.match_ids(result, broker_holdings_table, keys=holdings_keys, db=db, col='h_ref')
+    else:
+        # reserve a block of h_ref ids from the table sequence so loaders can run at the same time
+        result['h_ref'] = list(ou.reserve_ids(broker_holdings_table, len(result), db=db, col='h_ref'))
     all_dates = list(np.unique(result.date))
-    # get max trade ref id and increment
-    if overwrite_exist_dates and len(all_dates) > 0:
-        #        ou.archive_table(table = broker_holdings_table, num_to_archive=5, db=db)
-        sqlcmd = "delete from [" + db + "]..[" + broker_holdings_table + "] where [date] in ('" + "', '".join(
-            [str(x) for x in all_dates]) + "')"
-        ou.exec_sql(sqlcmd, isselect=0)
     if len(result.index) > 0:
-        sqlcmd = "select column_name from [" + db + "].information_schema.columns where TABLE_NAME= '" + broker_holdings_table + "' order by ORDINAL_POSITION"
-        tmp = ou.exec_sql(sqlcmd, isselect=1)
-        tmp = result.reset_index()[list(tmp['column_name'])]
-        ou.load_to_table(df=tmp, table=broker_holdings_table, db=db, index=False, pathloc=bulk_load_path)
+        tmp = result.reset_index()[table_cols]
+        if overwrite_exist_dates:
+            #        ou.archive_table(table = broker_holdings_table, num_to_archive=5, db=db)
+            # the new rows replace the loaded dates in one transaction - unchanged holdings are left alone,
+            # changed ones updated and the holdings no longer in the files removed by the date scope
+            if load_mode == 'swap':
+                ou.swap_load_dates(tmp, broker_holdings_table, db=db)
+            else:
+                ou.upsert_table(tmp, broker_holdings_table, db=db, keys=['h_ref'], delete_scope=['date'])
+        else:
+            ou.load_to_table(df=tmp, table=broker_holdings_table, db=db, index=False, pathloc=bulk_load_path)
 
 
 def backfill():
@@ -1394,10 +1402,7 @@ def debug_stuff():
     # strip comma's from name
     result['name'] = [x.replace(",", "") if type(x) == str else x for x in result['name']]
     # calculate and update the z_ref
-    tmp = \
-        ou.exec_sql("select coalesce(max(h_ref),0) from [" + db + "]..[" + broker_holdings_table + "]", isselect=1).ix[
-            0, 0]
-    result['h_ref'] = [x for x in range(tmp + 1, tmp + len(result) + 1)]
+    result['h_ref'] = list(ou.reserve_ids(broker_holdings_table, len(result), db=db, col='h_ref'))
     all_dates = list(np.unique(result.date))
 
     ou.load_to_table(result, 'zzz_tmp', db='zimdb_ops')
@@ -32,7 +32,8 @@ def refresh_dashboard(return_loc = False, db = True):
     blotter = pd.DataFrame(columns=['API_SEQ_NUM','EMSX_ACCOUNT','EMSX_AMOUNT','EMSX_ARRIVAL_PRICE','EMSX_ASSET_CLASS','EMSX_ASSIGNED_TRADER','EMSX_AVG_PRICE','EMSX_BASKET_NAME','EMSX_BASKET_NUM','EMSX_BROKER','EMSX_BROKER_COMM','EMSX_BSE_AVG_PRICE','EMSX_BSE_FILLED','EMSX_CFD_FLAG','EMSX_CLEARING_ACCOUNT','EMSX_COMM_DIFF_FLAG','EMSX_COMM_RATE','EMSX_CURRENCY_PAIR','EMSX_CUSTOM_NOTE1','EMSX_CUSTOM_NOTE2','EMSX_CUSTOM_NOTE3','EMSX_CUSTOM_NOTE4','EMSX_CUSTOM_NOTE5','EMSX_DATE','EMSX_DAY_AVG_PRICE','EMSX_DAY_FILL','EMSX_DIR_BROKER_FLAG','EMSX_EXCHANGE','EMSX_EXCHANGE_DESTINATION','EMSX_EXEC_INSTRUCTION','EMSX_FILL_ID','EMSX_FILLED','EMSX_GTD_DATE','EMSX_HAND_INSTRUCTION','EMSX_IDLE_AMOUNT','EMSX_INVESTOR_ID','EMSX_ISIN','EMSX_LIMIT_PRICE','EMSX_LOCATE_BROKER','EMSX_LOCATE_REQ','EMSX_NOTES','EMSX_NSE_AVG_PRICE','EMSX_NSE_FILLED','EMSX_ORD_REF_ID','EMSX_ORDER_TYPE','EMSX_ORIGINATE_TRADER','EMSX_ORIGINATE_TRADER_FIRM','EMSX_PERCENT_REMAIN','EMSX_PM_UUID','EMSX_PORT_MGR','EMSX_PORT_NAME','EMSX_PORT_NUM','EMSX_POSITION','EMSX_PRINCIPLE','EMSX_PRODUCT','EMSX_QUEUED_DATE','EMSX_QUEUED_TIME','EMSX_REASON_CODE','EMSX_REASON_DESC','EMSX_REMAIN_BALANCE','EMSX_ROUTE_ID','EMSX_ROUTE_PRICE','EMSX_ROUTE_REF_ID','EMSX_SEC_NAME','EMSX_SEDOL','EMSX_SEQUENCE','EMSX_SETTLE_AMOUNT','EMSX_SETTLE_DATE','EMSX_SIDE','EMSX_START_AMOUNT','EMSX_STATUS','EMSX_STEP_OUT_BROKER','EMSX_STOP_PRICE','EMSX_STRATEGY_END_TIME','EMSX_STRATEGY_PART_RATE1','EMSX_STRATEGY_PART_RATE2','EMSX_STRATEGY_STYLE','EMSX_STRATEGY_TYPE','EMSX_TICKER','EMSX_TIF','EMSX_TIME_STAMP','EMSX_TRAD_UUID','EMSX_TRADE_DESK','EMSX_TRADER','EMSX_TRADER_NOTES','EMSX_TS_ORDNUM','EMSX_TYPE','EMSX_UNDERLYING_TICKER','EMSX_USER_COMM_AMOUNT','EMSX_USER_COMM_RATE','EMSX_USER_FEES','EMSX_USER_NET_MONEY','EMSX_USER_WORK_PRICE','EMSX_WORKING','EMSX_YELLOW_KEY'])
     blotter_file = None
     try : 
-        blotter_update_time = ou.exec_sql ("select last_user_update from sys.dm_db_index_usage_stats where object_id = (select OBJECT_ID('zimdb..blotter_live'))", conn=ou.get_db_conn(reuse=False))
+        with ou.db_connection() as conn :
+            blotter_update_time = ou.exec_sql ("select last_user_update from sys.dm_db_index_usage_stats where object_id = (select OBJECT_ID('zimdb..blotter_live'))", conn=conn)
         if len(blotter_update_time) > 0 and type(blotter_update_time.iloc[0,0]) == pd.tslib.Timestamp : 
             blotter_update_time = blotter_update_time.iloc[0,0]
         else : 
@@ -43,11 +44,12 @@ def refresh_dashboard(return_loc = False, db = True):
         print("use live blotter from db blotter_live table last updated : " + str(blotter_update_time))
         retries = 30 
         tmp = pd.DataFrame()
-        while len(tmp) == 0 and retries > 0 : 
-            tmp = ou.exec_sql("select * from zimdb..blotter_live", conn=ou.get_db_conn(reuse=False))
-            retries = retries - 1
-            if len(tmp) == 0 :
-                time.sleep(1)
+        with ou.db_connection() as conn :
+            while len(tmp) == 0 and retries > 0 : 
+                tmp = ou.exec_sql("select * from zimdb..blotter_live", conn=conn)
+                retries = retries - 1
+                if len(tmp) == 0 :
+                    time.sleep(1)
         blotter = tmp.loc[tmp['MSG_SUB_TYPE'] == 'O']
         routes = tmp.loc[tmp['MSG_SUB_TYPE'] == 'R']
     recvtime = datetime.datetime.strftime(datetime.datetime.now(),'%H%M%S')    
@@ -190,19 +192,25 @@ def get_live_trades(this_date = datetime.datetime.today().date(), force_refresh=
     trade_cols = list(trades.columns)
     # print(trades)         #collapse output
     if len(trades) > 0 : 
+        # read in the allocations and reference data in one concurrent batch
+        ref_data = ou.gather_sql({
+            'alloc_table' : ("select emsx_notes, alloc from zimdb..blotter_alloc where date = ?", [this_date]),
+            'india_fut_mult' : "select bb_code + ' Equity' as bb_code_traded , z_bb_code + ' Equity' as z_bb_code, multiplier from zimdb_ops..india_ssf_multiplier",
+            'xrate' : "select XRATE_USDAUD as AUD, XRATE_USDCNY as CNY, XRATE_USDHKD as HKD, XRATE_USDIDR as IDR, XRATE_USDINR as INR, XRATE_USDJPY as JPY, XRATE_USDKRW as KRW, XRATE_USDMYR as MYR, XRATE_USDNZD as NZD, XRATE_USDPHP as PHP, XRATE_USDSGD as SGD, XRATE_USDTHB as THB, XRATE_USDTWD as TWD, XRATE_USDCNH as CNH, 1.0 as USD from zimdb_ops..ref_rates where date = (select max(date) from zimdb_ops..ref_rates)",
+            'ticker_map' : "select bb_code as bb_code_traded, sedol, z_isin, z_sedol, z_AxiomaID as AxiomaID, z_bb_code , currency, lot_size, name from zimdb_ops..trade_ticker_map"})
         # read in any allocations from blotter_alloc table
-        alloc_table = ou.exec_sql("select emsx_notes, alloc from zimdb..blotter_alloc where date = '" + str(this_date) + "'")
+        alloc_table = ref_data['alloc_table']
         if len(alloc_table) > 0 : 
             alloc_table = alloc_table.set_index('emsx_notes')['alloc']
             trades['EMSX_CUSTOM_NOTE1'] = [y if 'MULTI' in x else x for x,y in zip(trades['EMSX_CUSTOM_NOTE1'], alloc_table[trades['EMSX_NOTES']])]
 
         # get currency information
-        india_fut_mult = ou.exec_sql("select bb_code + ' Equity' as bb_code_traded , z_bb_code + ' Equity' as z_bb_code, multiplier from zimdb_ops..india_ssf_multiplier")
+        india_fut_mult = ref_data['india_fut_mult']
         india_fut_mult = india_fut_mult.drop_duplicates('bb_code_traded')
         india_fut_mult = india_fut_mult.set_index('bb_code_traded')
-        xrate = ou.exec_sql("select XRATE_USDAUD as AUD, XRATE_USDCNY as CNY, XRATE_USDHKD as HKD, XRATE_USDIDR as IDR, XRATE_USDINR as INR, XRATE_USDJPY as JPY, XRATE_USDKRW as KRW, XRATE_USDMYR as MYR, XRATE_USDNZD as NZD, XRATE_USDPHP as PHP, XRATE_USDSGD as SGD, XRATE_USDTHB as THB, XRATE_USDTWD as TWD, XRATE_USDCNH as CNH, 1.0 as USD from zimdb_ops..ref_rates where date = (select max(date) from zimdb_ops..ref_rates)")    
+        xrate = ref_data['xrate']
         xrate = xrate.transpose().iloc[:,0]
-        ticker_map = ou.exec_sql("select bb_code as bb_code_traded, sedol, z_isin, z_sedol, z_AxiomaID as AxiomaID, z_bb_code , currency, lot_size, name from zimdb_ops..trade_ticker_map")
+        ticker_map = ref_data['ticker_map']
         ticker_map['xrate'] = list(xrate.reindex(ticker_map['currency']))
         ticker_map = ticker_map.drop_duplicates('bb_code_traded')
         ticker_map = ticker_map.set_index('bb_code_traded')
@@ -310,7 +318,13 @@ def get_live_trades(this_date = datetime.datetime.today().date(), force_refresh=
 def calc_settle_date(this_date, orig_data) :
     # calc_settle_date(this_date, body[['z_sedol', 'prime_broker', 'country_exchange']].copy()) 
     # orig_data = body[['z_sedol', 'prime_broker', 'country_exchange']].copy()
-    holidays = ou.exec_sql("select * from zimdb..holiday_calendar where date > '" + str(this_date) + "' and date < '" + str((this_date + pd.offsets.BDay(10)).date()) + "'")
+    prefix_list = ['', 'cnl_', 'cna_', 'cng_', 'nht_', 'nhl_']
+    # the holidays and each account's reconciled trades are independent - fetch them together
+    queries = {'holidays' : ("select * from zimdb..holiday_calendar where date > ? and date < ?", [this_date, (this_date + pd.offsets.BDay(10)).date()])}
+    for this_prefix in prefix_list :
+        queries[this_prefix] = ("select distinct z_sedol, bb_code, prime, date_settle from zimdb_ops.."+this_prefix+"reconciled_trades where date = ?", [this_date])
+    ref_data = ou.gather_sql(queries)
+    holidays = ref_data['holidays']
     holidays['iso_country'] = ['CN' if x == 'CN_A' else x for x in holidays['iso_country']]
     holidays = holidays.set_index('iso_country')
     settle_day['date_settle'] = [(this_date + pd.offsets.BDay(x)).date() for x in settle_day['days']]
@@ -322,14 +336,10 @@ def calc_settle_date(this_date, orig_data) :
         settle_day.loc[this_country,'date_settle'] = date_settle
     orig_data['date_settle'] = [settle_day.loc[y,'date_settle'] for y  in orig_data['country_exchange']]
 
-    prefix_list = ['', 'cnl_', 'cna_', 'cng_', 'nht_', 'nhl_']
     broker_map = pd.Series(['GS', 'GS',  'GS',   'BBG', 'BOAML', 'BOAML',    'CS', 'CS',    'INT', 'CIMB', 'GS-HT', 'BOAML-HT', 'GS-PT',    'UBS', 'UBS',    'ACCRUAL', 'HAIT', 'HAIT'   ,'JPM', 'JPM', 'MS' ,'MS'   ],
                    index = ['GS', 'GSI', 'GSCO', 'BBG', 'BOAML', 'BOAML-PT', 'CS', 'CS-PT', 'INT', 'CIMB', 'GS-HT', 'BOAML-HT', 'GS-PT', 'UBS', 'UBS-PT', '2GS',     'HAIT', 'HAIT-PT','JPM', 'JPM-PT', 'MS' ,'MS-PT'])
     orig_data['prime_broker'] = list(broker_map[list(orig_data['prime_broker'])])
-    broker_settle = pd.DataFrame()
-    for this_prefix in prefix_list :
-        tmp = ou.exec_sql("select distinct z_sedol, bb_code, prime, date_settle from zimdb_ops.."+this_prefix+"reconciled_trades where date = '"+str(this_date)+"'")
-        broker_settle = broker_settle.append(tmp)
+    broker_settle = pd.concat([ref_data[this_prefix] for this_prefix in prefix_list])
     broker_settle = broker_settle.drop_duplicates(['z_sedol', 'prime']).set_index(['z_sedol', 'prime'])
     keys = orig_data.set_index(['z_sedol', 'prime_broker']).index
     if len(broker_settle) > 0 :
@@ -504,7 +514,7 @@ def generate_bbg_files(all_trades_main = None, this_date = datetime.datetime.tod
         print("==============")
 
     # work out settle dates
-    holidays = ou.exec_sql("select * from zimdb..holiday_calendar where date > '" + str(this_date) + "' and date < '" + str((this_date + pd.offsets.BDay(10)).date()) + "'")
+    holidays = ou.exec_sql("select * from zimdb..holiday_calendar where date > ? and date < ?", params=[this_date, (this_date + pd.offsets.BDay(10)).date()])
     holidays['iso_country'] = ['CN' if x == 'CN_A' else x for x in holidays['iso_country']]
     holidays = holidays.set_index('iso_country')
     settle_day['date_settle'] = [(this_date + pd.offsets.BDay(x)).date() for x in settle_day['days']]
@@ -516,7 +526,7 @@ def generate_bbg_files(all_trades_main = None, this_date = datetime.datetime.tod
         settle_day.loc[this_country,'date_settle'] = date_settle
     
     # read in the ticketed trades
-    ticket_book = ou.exec_sql("select * from zimdb..ticketbook where date = '" + str(this_date) + "'")    
+    ticket_book = ou.exec_sql("select * from zimdb..ticketbook where date = ?", params=[this_date])    
     if len(ticket_book) > 0 : 
         # clean up ticketbook
         ticket_book = ticket_book.apply(lambda x : x.replace("\r\n","") if type(x) == str else x)
@@ -629,10 +639,15 @@ def generate_tw_trade_files(all_trades_main=None, this_date=datetime.datetime.no
              "where date = (select max(date) from zimdb_ops..broker_rates) \n"
              "and account = 'DEFAULT' \n"
              "and broker = 'GS' and type = 'stock' ")
-    rates = ou.exec_sql(query)
+    sqlcmd = 'select 1 as USD, XRATE_USDAUD as AUD, XRATE_USDCNY as CNY, XRATE_USDHKD as HKD, XRATE_USDIDR as IDR, XRATE_USDINR as INR, XRATE_USDJPY as JPY, XRATE_USDKRW as KRW, XRATE_USDMYR as MYR, XRATE_USDNZD as NZD, XRATE_USDPHP as PHP, XRATE_USDSGD as SGD, XRATE_USDTHB as THB, XRATE_USDTWD as TWD, XRATE_USDCNH as CNH, XRATE_USDEUR as EUR from zimdb_ops..ref_rates where date = (select max(date) from zimdb_ops..ref_rates)'
+    ref_data = ou.gather_sql({'rates' : query,
+                              'holidays' : ("select * from zimdb..holiday_calendar where date > ? and date < ?", [this_date, (this_date + pd.offsets.BDay(10)).date()]),
+                              'fx_rate' : sqlcmd,
+                              'trade_ticker_map' : "select * from zimdb_ops..trade_ticker_map"})
+    rates = ref_data['rates']
     rates = rates.set_index('country_exchange')
 
-    holidays = ou.exec_sql("select * from zimdb..holiday_calendar where date > '" + str(this_date) + "' and date < '" + str((this_date + pd.offsets.BDay(10)).date()) + "'")
+    holidays = ref_data['holidays']
     holidays['iso_country'] = ['CN' if x == 'CN_A' else x for x in holidays['iso_country']]
     holidays = holidays.set_index('iso_country')
     settle_day['date_settle'] = [(this_date + pd.offsets.BDay(x)).date() for x in settle_day['days']]
@@ -641,9 +656,8 @@ def generate_tw_trade_files(all_trades_main=None, this_date=datetime.datetime.no
         while date_settle in list(holidays.loc[[this_country],'date']) :
             date_settle = (date_settle + pd.offsets.BDay(1)).date()
         settle_day.loc[this_country,'date_settle'] = date_settle
-    sqlcmd = 'select 1 as USD, XRATE_USDAUD as AUD, XRATE_USDCNY as CNY, XRATE_USDHKD as HKD, XRATE_USDIDR as IDR, XRATE_USDINR as INR, XRATE_USDJPY as JPY, XRATE_USDKRW as KRW, XRATE_USDMYR as MYR, XRATE_USDNZD as NZD, XRATE_USDPHP as PHP, XRATE_USDSGD as SGD, XRATE_USDTHB as THB, XRATE_USDTWD as TWD, XRATE_USDCNH as CNH, XRATE_USDEUR as EUR from zimdb_ops..ref_rates where date = (select max(date) from zimdb_ops..ref_rates)'
-    fx_rate = ou.exec_sql(sqlcmd).transpose()[0]
-    trade_ticker_map = ou.exec_sql("select * from zimdb_ops..trade_ticker_map")
+    fx_rate = ref_data['fx_rate'].transpose()[0]
+    trade_ticker_map = ref_data['trade_ticker_map']
     trade_ticker_map.set_index('bb_code')['currency']
     curr_map = trade_ticker_map.set_index('bb_code')['currency']
     exchange_map = trade_ticker_map.set_index('bb_code')['country_exchange']
@@ -672,7 +686,7 @@ def generate_tw_trade_files(all_trades_main=None, this_date=datetime.datetime.no
         body[x] = np.nan
 
     # now do ticketed trades....
-    ticket_fills = ou.exec_sql("select * from zimdb..ticketbook where date = '" + str(this_date) + "' and portfolio = '" + account + "'")    
+    ticket_fills = ou.exec_sql("select * from zimdb..ticketbook where date = ? and portfolio = ?", params=[this_date, account])    
     #ticket_fills = ou.exec_sql("select * from zimdb..ticketbook where portfolio = '" + account + "'")    
     ticket_fills["country_exchange"] = list(exchange_map[list(ticket_fills.bb_code)])
     ticket_fills['country_exchange'].fillna('HK', inplace=True)
@@ -29,7 +29,7 @@ def intraday_fills(accounts = ['ZEN_NHT'],
                     output_dir = "S:/Operations/Workflow/NH/",
                     account_id = '445246'
                     ) :
-    xrate = ou.exec_sql("select currency, fx from zimdb..fx_rates where date = (select max(date) from zimdb..fx_rates where date <= '"+str(trade_date)+"')").set_index('currency')['fx']
+    xrate = ou.exec_sql("select currency, fx from zimdb..fx_rates where date = (select max(date) from zimdb..fx_rates where date <= ?)", params=[trade_date]).set_index('currency')['fx']
     ticker_map = ou.exec_sql("select bb_code as bb_code_traded, sedol, z_isin, z_sedol, z_AxiomaID as AxiomaID, z_bb_code , currency, lot_size, name from zimdb_ops..trade_ticker_map")
     ticker_map['xrate'] = list(xrate.reindex(list(ticker_map['currency'])))
 
@@ -13,6 +13,11 @@ import errno
 import shutil
 import time
 import datetime
+import threading
+import weakref
+import atexit
+import sqlite3
+from contextlib import contextmanager
 from pandas.tseries.offsets import BDay
 from scipy.stats.stats import pearsonr
 import urllib.request
@@ -23,133 +28,1344 @@ warnings.filterwarnings(
 
 # Get the ODBC connection (cursor) for a named database
 # Currently DB connection stringsare here - could move these to a config file?
-__db_connection__ = None
-__db_connect_time__ = datetime.datetime.now()-pd.offsets.Day(1)
-__db_connect_timeout__ = 3 * 60 * 60 # timeout in seconds
+# Connections are held in one pool per alias. get_db_conn() with reuse binds a pooled
+# connection to the calling thread, db_connection() checks one out for a block of work
 __db_reuse__ = True
+__db_connect_timeout__ = 3 * 60 * 60 # max connection age in seconds - older connections are replaced
+__db_pool_min__ = 1 # connections opened when a pool is first used
+__db_pool_max__ = 8 # max open connections per alias
+__db_pool_wait__ = 60 # seconds to wait for a free connection before giving up
+__db_health_check__ = 5 * 60 # seconds idle before a connection is pinged on checkout
+__db_pools__ = {}
+__db_pools_lock__ = threading.Lock()
+__db_thread__ = threading.local()
+
+
+def get_db_conn_str(alias='zim_ops'):
+    conn_str = ""
+    try:
+        # override string to use a specific DB cnnection
+        path = os.path.expanduser("~") + '/Documents/'
+        if (os.path.isfile(path + "/connect_string.txt") == True):
+            with open(path + "/connect_string.txt", 'r') as file:
+                conn_str = file.read().replace('\n', '')
+    except Exception:
+        pass
+    if conn_str == "":
+        # Production db
+        if alias == 'zim_prod':
+            # Create the connection using the connstring
+            conn_str = 'Driver={ODBC Driver 17 for SQL Server};SERVER=zimsqlhk.options-it.com;DATABASE=zimdb;Trusted_Connection=yes'
+            # Development db - not set up yet
+        elif alias == 'zim_dev':
+            # Create the connection using the connstring
+            conn_str = 'Driver={ODBC Driver 17 for SQL Server};SERVER=zimsqlhk.options-it.com;DATABASE=zimdb_dev;Trusted_Connection=yes'
+        elif alias == 'zim_ops':
+            # Create the connection using the connstring
+            conn_str = 'Driver={ODBC Driver 17 for SQL Server};SERVER=zimsqlhk.options-it.com;DATABASE=zimdb_ops;Trusted_Connection=yes'
+    return conn_str
+
+
+def new_db_conn(alias='zim_ops'):
+    # Open a new connection that is not managed by the pool
+    if is_local_alias(alias):
+        return new_local_db_conn()
+    this_connection = p.connect(get_db_conn_str(alias))
+    exec_sql(sql='SET ARITHABORT ON;', conn=this_connection, isselect=False)
+    return this_connection
 
 
-def get_db_conn(alias='zim_ops', reuse=None):
-    global __db_connection__, __db_reuse__, __db_connect_time__, __db_connect_timeout__
-    if reuse is None:
-        reuse = __db_reuse__
-    # check if the connection has been alive for more than time out  - if so close and create a new one
-    if (__db_connection__  is not None and __db_connect_time__ < (datetime.datetime.now() - pd.offsets.Second(__db_connect_timeout__))):
-        reset_db_conn()
-    if __db_connection__  is not None and reuse==True :
-        this_connection = __db_connection__
-    else :
-        conn_str = ""
+class DbPool(object):
+    # Thread-safe pool of connections for one alias
+    # Connections older than max_age are closed on checkout/checkin and replaced,
+    # idle connections are pinged before being handed out again
+    def __init__(self, alias, min_size=None, max_size=None, max_age=None, health_check=None):
+        self.alias = alias
+        self.min_size = __db_pool_min__ if min_size is None else min_size
+        self.max_size = __db_pool_max__ if max_size is None else max_size
+        self.max_age = __db_connect_timeout__ if max_age is None else max_age
+        self.health_check = __db_health_check__ if health_check is None else health_check
+        # re-entrant so a thread's leases can be checked in from a finalizer at any point
+        self.cond = threading.Condition(threading.RLock())
+        self.idle = []
+        self.leased = {}
+        self.size = 0
+
+    def _open(self):
+        now = time.time()
+        return {'conn': new_db_conn(self.alias), 'created': now, 'used': now}
+
+    def _close(self, rec):
         try:
-            # override string to use a specific DB cnnection
-            path = os.path.expanduser("~") + '/Documents/'
-            if (os.path.isfile(path + "/connect_string.txt") == True):
-                with open(path + "/connect_string.txt", 'r') as file:
-                    conn_str = file.read().replace('\n', '')
+            rec['conn'].close()
         except Exception:
             pass
-        if conn_str == "":
-            # Production db
-            if alias == 'zim_prod':
-                # Create the connection using the connstring
-                conn_str = 'Driver={ODBC Driver 17 for SQL Server};SERVER=zimsqlhk.options-it.com;DATABASE=zimdb;Trusted_Connection=yes'
-                # Development db - not set up yet
-            elif alias == 'zim_dev':
-                # Create the connection using the connstring
-                conn_str = 'Driver={ODBC Driver 17 for SQL Server};SERVER=zimsqlhk.options-it.com;DATABASE=zimdb_dev;Trusted_Connection=yes'
-            elif alias == 'zim_ops':
-                # Create the connection using the connstring
-                conn_str = 'Driver={ODBC Driver 17 for SQL Server};SERVER=zimsqlhk.options-it.com;DATABASE=zimdb_ops;Trusted_Connection=yes'
-        # over-ride connection string
-        this_connection = p.connect(conn_str)
-        exec_sql(sql='SET ARITHABORT ON;', conn=this_connection, isselect=False)
-    if (__db_connection__  is None and reuse==True) :
-        __db_connection__ = this_connection
-        __db_connect_time__ = datetime.datetime.now()
+
+    def expired(self, rec):
+        return (time.time() - rec['created']) > self.max_age
+
+    def healthy(self, rec):
+        if (time.time() - rec['used']) < self.health_check:
+            return True
+        try:
+            with rec['conn'].cursor() as curs:
+                curs.execute('SELECT 1')
+                curs.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def fill(self):
+        # open connections up to min_size
+        while True:
+            with self.cond:
+                if self.size >= self.min_size:
+                    return
+                self.size = self.size + 1
+            try:
+                rec = self._open()
+            except Exception:
+                with self.cond:
+                    self.size = self.size - 1
+                raise
+            with self.cond:
+                self.idle.append(rec)
+                self.cond.notify()
+
+    def checkout(self, timeout=None):
+        timeout = __db_pool_wait__ if timeout is None else timeout
+        deadline = time.time() + timeout
+        while True:
+            rec = None
+            create = False
+            with self.cond:
+                while rec is None and not create:
+                    if len(self.idle) > 0:
+                        rec = self.idle.pop()
+                    elif self.size < self.max_size:
+                        self.size = self.size + 1
+                        create = True
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Exception('Timed out waiting for a ' + self.alias + ' connection (pool max ' +
+                                            str(self.max_size) + ')')
+                        self.cond.wait(remaining)
+            if create:
+                try:
+                    rec = self._open()
+                except Exception:
+                    with self.cond:
+                        self.size = self.size - 1
+                        self.cond.notify()
+                    raise
+            elif self.expired(rec) or not self.healthy(rec):
+                self._discard(rec)
+                continue
+            rec['used'] = time.time()
+            with self.cond:
+                self.leased[id(rec['conn'])] = rec
+            return rec['conn']
+
+    def _discard(self, rec):
+        self._close(rec)
+        with self.cond:
+            self.size = self.size - 1
+            self.cond.notify()
+
+    def checkin(self, conn, discard=False):
+        with self.cond:
+            rec = self.leased.pop(id(conn), None)
+        if rec is None:
+            # not one of ours - just close it
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        if discard or self.expired(rec):
+            self._discard(rec)
+            return
+        try:
+            # don't hand back a connection with an open transaction
+            conn.rollback()
+        except Exception:
+            self._discard(rec)
+            return
+        rec['used'] = time.time()
+        with self.cond:
+            self.idle.append(rec)
+            self.cond.notify()
+
+    def owns(self, conn):
+        with self.cond:
+            return id(conn) in self.leased
+
+    def is_expired(self, conn):
+        with self.cond:
+            rec = self.leased.get(id(conn))
+        return rec is None or self.expired(rec)
+
+    def close(self):
+        with self.cond:
+            recs = self.idle
+            self.idle = []
+            self.size = self.size - len(recs)
+        for rec in recs:
+            self._close(rec)
+
+
+def get_db_pool(alias='zim_ops'):
+    # Get (or create) the pool for an alias
+    alias = alias or 'zim_ops'
+    with __db_pools_lock__:
+        pool = __db_pools__.get(alias)
+        if pool is None:
+            pool = DbPool(alias)
+            __db_pools__[alias] = pool
+            new_pool = True
+        else:
+            new_pool = False
+    if new_pool:
+        pool.fill()
+    return pool
+
+
+def set_db_pool(alias='zim_ops', min_size=None, max_size=None, max_age=None, health_check=None):
+    # Change the pool settings for an alias - existing connections are kept
+    pool = get_db_pool(alias)
+    with pool.cond:
+        if min_size is not None:
+            pool.min_size = min_size
+        if max_size is not None:
+            pool.max_size = max_size
+        if max_age is not None:
+            pool.max_age = max_age
+        if health_check is not None:
+            pool.health_check = health_check
+        pool.cond.notify_all()
+    pool.fill()
+    return pool
+
+
+def checkout_db_conn(alias='zim_ops', timeout=None):
+    return get_db_pool(alias).checkout(timeout=timeout)
+
+
+def checkin_db_conn(conn, alias='zim_ops', discard=False):
+    get_db_pool(alias).checkin(conn, discard=discard)
+
+
+# Usage:
+# with db_connection('zim_ops') as conn:
+#    exec_sql(sql, conn=conn)
+@contextmanager
+def db_connection(alias='zim_ops', timeout=None):
+    conn = checkout_db_conn(alias, timeout=timeout)
+    discard = False
+    try:
+        yield conn
+    except (p.Error, pd.io.sql.DatabaseError):
+        # the connection may be broken - don't hand it out again
+        discard = True
+        raise
+    finally:
+        checkin_db_conn(conn, alias, discard=discard)
+
+
+def get_db_conn(alias='zim_ops', reuse=None):
+    if reuse is None:
+        reuse = __db_reuse__
+    if not reuse:
+        return new_db_conn(alias)
+    alias = alias or 'zim_ops'
+    # the calling thread keeps one pooled connection per alias until reset_db_conn(),
+    # release_db_conn() or the thread exits
+    conns = thread_db_conns()
+    pool = get_db_pool(alias)
+    this_connection = conns.get(alias)
+    # replace the connection once it is past the max age
+    if this_connection is not None and pool.is_expired(this_connection):
+        reset_db_conn(alias)
+        this_connection = None
+    if this_connection is None:
+        this_connection = pool.checkout()
+        conns[alias] = this_connection
     return this_connection
 
 
-def reset_db_conn():
-    global __db_connection__, __db_connect_time__
-    if __db_connection__ is not None:
-        __db_connection__.close()
-        __db_connection__ = None
-        __db_connect_time__ = datetime.datetime.now()-pd.offsets.Day(1)
+class ThreadDbConns(object):
+    # Holds the connections get_db_conn() leased to one thread. It lives on the thread-local,
+    # so it is dropped when the thread exits and the finalizer checks the leases back in
+    def __init__(self):
+        self.conns = {}
+        finalizer = weakref.finalize(self, checkin_thread_db_conns, self.conns)
+        finalizer.atexit = False
 
-# Executes sql on a connection (cursor) - creates the cursor itself so no need
-# for separately creating a connection, just give an alias
+
+def checkin_thread_db_conns(conns):
+    # Only return leases to pools that still exist - close_db_pools() may already have run
+    for alias, conn in list(conns.items()):
+        conns.pop(alias, None)
+        pool = __db_pools__.get(alias)
+        if pool is not None:
+            pool.checkin(conn)
+        else:
+            try:
+                conn.close()
+            except Exception:
+                pass
 
 
-def exec_sql(sql, isselect=1, alias='zim_ops', check_sql=False, conn=None):
+def thread_db_conns(create=True):
+    holder = getattr(__db_thread__, 'holder', None)
+    if holder is None:
+        if not create:
+            return {}
+        holder = ThreadDbConns()
+        __db_thread__.holder = holder
+    return holder.conns
+
+
+def is_thread_db_conn(conn, alias='zim_ops'):
+    # True if conn is the connection bound to this thread by get_db_conn()
+    return conn is not None and conn is thread_db_conns(create=False).get(alias or 'zim_ops')
+
+
+# Usage - worker threads that are kept alive (e.g. in an executor) hand their lease back when done:
+# release_db_conn()
+def release_db_conn(alias=None):
+    # Check the connection(s) bound to this thread back into the pool for reuse
+    conns = thread_db_conns(create=False)
+    for this_alias in ([alias or 'zim_ops'] if alias is not None else list(conns.keys())):
+        conn = conns.pop(this_alias, None)
+        if conn is not None:
+            checkin_db_conn(conn, this_alias)
+
+
+def reset_db_conn(alias=None):
+    # Drop the connection(s) bound to this thread - they are closed rather than reused
+    conns = thread_db_conns(create=False)
+    for this_alias in ([alias or 'zim_ops'] if alias is not None else list(conns.keys())):
+        conn = conns.pop(this_alias, None)
+        if conn is not None:
+            checkin_db_conn(conn, this_alias, discard=True)
+
+
+def close_db_pools():
+    # Close all pooled connections - leased connections are closed when checked in
+    reset_db_conn()
+    with __db_pools_lock__:
+        pools = list(__db_pools__.values())
+        __db_pools__.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_db_pools)
+
+
+# Local database - an embedded sqlite db that stands in for sql server so scripts can be run
+# and timed without zimsqlhk. The 'local' alias always uses it, use_local_db() can also point
+# the usual aliases at it. The connection shim makes the sql used here work on sqlite:
+#   db..table, db.dbo.table -> table (all dbs share one namespace)
+#   information_schema.columns / tables -> views over the sqlite catalogue
+#   SET ..., begin/commit transaction, ALTER TABLE ... ADD CONSTRAINT are skipped
+#   select top n -> limit n, ON [PRIMARY] and N'..' prefixes are dropped
+#   BULK INSERT table FROM 'file.csv' is loaded from the csv with executemany
+#   isnull() -> ifnull(), getdate(), len() and binary_checksum() are added as functions
+# Usage:
+# use_local_db('c:/temp/ops_local.db')  # zim_ops/zim_prod/zim_dev now run on the local db
+# seed_local_db('c:/temp/fixtures/')    # one <table>.csv per table
+# parse_holding_files(...)
+__local_db__ = {'path': None, 'aliases': set(['local'])}
+
+
+def is_local_alias(alias):
+    return (alias or 'zim_ops') in __local_db__['aliases']
+
+
+def use_local_db(path=None, aliases=('zim_ops', 'zim_prod', 'zim_dev')):
+    # path None is an in-memory db shared by the connections of this process
+    __local_db__['path'] = path
+    __local_db__['aliases'] = set(['local']) | set(aliases)
+    for alias in __local_db__['aliases']:
+        close_db_pool(alias)
+        __load_engine__[alias] = 'executemany'
+    invalidate_schema_cache()
+
+
+def close_db_pool(alias='zim_ops'):
+    alias = alias or 'zim_ops'
+    reset_db_conn(alias)
+    with __db_pools_lock__:
+        pool = __db_pools__.pop(alias, None)
+    if pool is not None:
+        pool.close()
+
+
+sqlite3.register_adapter(datetime.date, lambda x: x.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda x: x.isoformat(sep=' '))
+sqlite3.register_converter('date', lambda x: datetime.date.fromisoformat(x.decode()[:10]))
+sqlite3.register_converter('datetime', lambda x: datetime.datetime.fromisoformat(x.decode()))
+sqlite3.register_converter('timestamp', lambda x: datetime.datetime.fromisoformat(x.decode()))
+
+
+def new_local_db_conn():
+    path = __local_db__['path']
+    if path is None:
+        conn = sqlite3.connect('file:ops_local_db?mode=memory&cache=shared', uri=True, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES, timeout=60)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES, timeout=60)
+    conn.create_function('getdate', 0, lambda: datetime.datetime.now().isoformat(sep=' '))
+    conn.create_function('len', 1, lambda x: None if x is None else len(str(x).rstrip()))
+    conn.create_function('binary_checksum', -1, local_checksum)
+    conn.execute("create temp view if not exists information_schema_tables as "
+                 "select 'main' as table_catalog, 'dbo' as table_schema, name as table_name, "
+                 "case when type = 'view' then 'VIEW' else 'BASE TABLE' end as table_type "
+                 "from sqlite_master where type in ('table', 'view') and name not like 'sqlite_%'")
+    conn.execute("create temp view if not exists information_schema_columns as "
+                 "select 'main' as table_catalog, 'dbo' as table_schema, m.name as table_name, c.name as column_name, "
+                 "c.cid + 1 as ordinal_position, lower(case when instr(c.type, '(') > 0 then substr(c.type, 1, instr(c.type, '(') - 1) "
+                 "else c.type end) as data_type, case when instr(c.type, '(') > 0 then cast(substr(c.type, instr(c.type, '(') + 1) as integer) "
+                 "end as character_maximum_length, case when c.[notnull] then 'NO' else 'YES' end as is_nullable "
+                 "from sqlite_master m join pragma_table_info(m.name) c where m.type in ('table', 'view') and m.name not like 'sqlite_%'")
+    return LocalDbConnection(conn)
+
+
+# stand in for sql server BINARY_CHECKSUM - a stable 32 bit hash of the values
+def local_checksum(*values):
+    import zlib
+    return zlib.crc32(repr(values).encode()) - (1 << 31)
+
+
+# Split a batch on ; outside quotes/brackets
+def split_sql_batch(sql):
+    statements = []
+    current = ''
+    quote = None
+    for ch in sql:
+        if quote is not None:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == '[':
+            quote = ']'
+        elif ch == ';':
+            statements.append(current)
+            current = ''
+            continue
+        current = current + ch
+    statements.append(current)
+    return [x.strip() for x in statements if x.strip() != '']
+
+
+def count_sql_params(sql):
+    return len(re.findall(r"\?", re.sub(r"'(?:[^']|'')*'", "''", sql)))
+
+
+# T-SQL statement -> sqlite statement, None if it is skipped
+def local_sql(sql):
+    if re.match(r"(?is)^(set\s|begin\s+tran|commit(\s|$)|alter\s+table\s.*\sadd\s+constraint\s)", sql):
+        return None
+    sql = re.sub(r"(?i)\[?\w+\]?\.(?:\[?dbo\]?)?\.(?=\[?\w)", "", sql)
+    sql = re.sub(r"(?i)\[?\w+\]?\.(?=information_schema\.)", "", sql)
+    sql = re.sub(r"(?i)information_schema\.(columns|tables)\b", lambda m: "information_schema_" + m.group(1).lower(), sql)
+    sql = re.sub(r"(?i)\bon\s+\[primary\]", "", sql)
+    sql = re.sub(r"(?<![\w'])N'", "'", sql)
+    sql = re.sub(r"(?i)\bisnull\s*\(", "ifnull(", sql)
+    top = re.match(r"(?is)^(select\s+(?:distinct\s+)?)top\s*\(?\s*(\d+)\s*\)?\s(.*)$", sql)
+    if top is not None:
+        sql = top.group(1) + top.group(3) + " limit " + top.group(2)
+    return sql
+
+
+# pyodbc-like connection over sqlite3 for the local db
+class LocalDbConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.autocommit = False
+
+    def cursor(self):
+        return LocalDbCursor(self)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+    def execute(self, sql, *params):
+        curs = self.cursor()
+        return curs.execute(sql, *params)
+
+
+class LocalDbCursor(object):
+    # Result sets follow pyodbc: the cursor starts on the first select of the batch,
+    # nextset() moves to the next one. rowcount is the total for the other statements
+    def __init__(self, connection):
+        self.connection = connection
+        self.fast_executemany = False
+        self.results = []
+        self.current = None
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # like pyodbc - commit when the block ends without an error
+        if exc_type is None:
+            self.connection.commit()
+        self.close()
+
+    @property
+    def description(self):
+        return None if self.current is None else self.current.description
+
+    def execute(self, sql, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        params = list(params)
+        self.results = []
+        self.current = None
+        self.rowcount = -1
+        changed = None
+        for this_sql in split_sql_batch(sql):
+            nparams = count_sql_params(this_sql)
+            these_params = params[:nparams]
+            params = params[nparams:]
+            bulk = re.match(r"(?is)^bulk\s+insert\s+(\S+)\s+from\s+'([^']+)'(.*)$", this_sql)
+            if bulk is not None:
+                count = self.bulk_insert(local_sql(bulk.group(1)), bulk.group(2), bulk.group(3))
+                changed = count if changed is None else changed + count
+                continue
+            this_sql = local_sql(this_sql)
+            if this_sql is None:
+                continue
+            curs = self.connection.conn.execute(this_sql, these_params)
+            if curs.description is not None:
+                self.results.append(curs)
+            elif curs.rowcount >= 0:
+                changed = curs.rowcount if changed is None else changed + curs.rowcount
+        if len(self.results) > 0:
+            self.current = self.results.pop(0)
+        if changed is not None:
+            self.rowcount = changed
+        return self
+
+    def bulk_insert(self, table, fileloc, options):
+        # BULK INSERT from a csv written by load_to_table (header row, comma separated)
+        first_row = re.search(r"(?i)firstrow\s*=\s*(\d+)", options)
+        skip = (int(first_row.group(1)) - 1) if first_row is not None else 0
+        with open(fileloc, 'r', newline='') as f:
+            rows = list(csv.reader(f))[skip:]
+        rows = [[None if x == '' else x for x in row] for row in rows]
+        if len(rows) == 0:
+            return 0
+        cols = [x[1] for x in self.connection.conn.execute("select * from pragma_table_info(?)", [table.strip('[]')]).fetchall()]
+        self.connection.conn.executemany("insert into " + table + " (" + ", ".join(["[" + x + "]" for x in cols]) + ") values (" +
+                                         ", ".join(["?"] * len(cols)) + ")", rows)
+        return len(rows)
+
+    def executemany(self, sql, seq_of_params):
+        curs = self.connection.conn.executemany(local_sql(sql), [list(x) for x in seq_of_params])
+        self.rowcount = curs.rowcount
+        return self
+
+    def fetchone(self):
+        return None if self.current is None else self.current.fetchone()
+
+    def fetchmany(self, size=1):
+        return [] if self.current is None else self.current.fetchmany(size)
+
+    def fetchall(self):
+        return [] if self.current is None else self.current.fetchall()
+
+    def nextset(self):
+        if len(self.results) == 0:
+            self.current = None
+            return False
+        self.current = self.results.pop(0)
+        return True
+
+    def close(self):
+        for curs in ([self.current] if self.current is not None else []) + self.results:
+            curs.close()
+        self.current = None
+        self.results = []
+
+
+# Load fixtures into the local db - a dict of {table: DataFrame} or a folder of <table>.csv files
+# Existing tables are replaced. Columns named date or ending _date are stored as dates
+def seed_local_db(fixtures, alias='local'):
+    if not is_local_alias(alias):
+        raise ValueError(alias + " is not a local db alias - call use_local_db() first")
+    if type(fixtures) == str:
+        path = fixtures
+        fixtures = {}
+        for this_file in sorted(os.listdir(path)):
+            if this_file.lower().endswith('.csv'):
+                fixtures[this_file[:-4]] = pd.read_csv(os.path.join(path, this_file))
+    with db_connection(alias) as conn:
+        for table, df in fixtures.items():
+            df = df.copy()
+            for this_col in df.columns:
+                if this_col == 'date' or this_col.endswith('_date'):
+                    df[this_col] = pd.to_datetime(df[this_col]).dt.date
+            df.to_sql(table, conn.conn, if_exists='replace', index=False,
+                      dtype={x: 'date' for x in df.columns if x == 'date' or x.endswith('_date')})
+            conn.commit()
+            invalidate_schema_cache(table, alias=alias)
+    return list(fixtures.keys())
+
+# Retry policy for exec_sql / insert_rows
+# Errors are classified by the pyodbc SQLSTATE (e.args[0]) and message:
+#   'deadlock' - 40001 / chosen as the deadlock victim
+#   'link'     - 08S01, 08001, 08003, 08007 / Communication link failure
+#   'timeout'  - HYT00, HYT01 (not retried unless added to retry_on)
+# Waits grow as base_delay * multiplier ** n (capped at max_delay) with random jitter,
+# and no retry is started once budget seconds have gone since the first attempt
+# Usage:
+# set_retry_policy(RetryPolicy(max_retries=10, budget=600), alias='zim_ops')
+# exec_sql(sql, isselect=0, retry=RetryPolicy(max_retries=0))
+class RetryPolicy(object):
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=30, multiplier=2, jitter=0.5, budget=300,
+                 retry_on=('deadlock', 'link')):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.budget = budget
+        self.retry_on = tuple(retry_on)
+
+    def classify(self, e):
+        state = str(e.args[0]) if len(e.args) > 0 else ''
+        message = str(e)
+        if state == '40001' or 'deadlock victim' in message:
+            return 'deadlock'
+        if state in ('08S01', '08001', '08003', '08007') or 'Communication link failure' in message:
+            return 'link'
+        if state in ('HYT00', 'HYT01'):
+            return 'timeout'
+        return None
+
+    def delay(self, retries):
+        wait = min(self.max_delay, self.base_delay * (self.multiplier ** retries))
+        return wait * (1 - self.jitter * random.random())
+
+    def next_delay(self, kind, retries, tstart):
+        # seconds to wait before the next attempt, None if the error should be raised
+        if kind not in self.retry_on or retries >= self.max_retries:
+            return None
+        wait = self.delay(retries)
+        if self.budget is not None and (time.time() - tstart + wait) > self.budget:
+            return None
+        return wait
+
+
+__retry_policy__ = {}
+
+
+def set_retry_policy(policy, alias='zim_ops'):
+    __retry_policy__[alias or 'zim_ops'] = policy
+
+
+def get_retry_policy(alias='zim_ops'):
+    policy = __retry_policy__.get(alias or 'zim_ops')
+    if policy is None:
+        policy = RetryPolicy()
+        __retry_policy__[alias or 'zim_ops'] = policy
+    return policy
+
+
+# Decide whether a failed statement is rerun - returns (kind, conn to rerun on) after waiting,
+# or None if the error should be raised
+# Only statements on the thread connection from get_db_conn() are rerun - each exec_sql call on it
+# commits on its own, so a deadlock victim has lost nothing but the statement being rerun. A
+# connection passed in by the caller may hold earlier statements of the caller's transaction, which
+# the server has rolled back, so the error is raised for it - the caller reruns its whole unit,
+# eg with retry_transaction
+# After a dropped link the commit may already have gone through, so only idempotent statements
+# (selects by default) are rerun, on a replacement connection
+def retry_sql_error(e, policy, retries, tstart, conn, alias='zim_ops', idempotent=False):
+    # read_sql wraps the pyodbc error in a pandas DatabaseError
+    if not isinstance(e, p.Error) and isinstance(e.__cause__, p.Error):
+        e = e.__cause__
+    kind = policy.classify(e)
+    wait = policy.next_delay(kind, retries, tstart)
+    if wait is None or not is_thread_db_conn(conn, alias):
+        return None
+    if kind == 'link':
+        if not idempotent:
+            return None
+        reset_db_conn(alias)
+        time.sleep(wait)
+        return kind, get_db_conn(alias)
+    try:
+        conn.rollback()
+    except p.Error:
+        pass
+    time.sleep(wait)
+    return kind, conn
+
+
+# Run work(conn) on a pooled connection as one unit, rerunning all of it under the alias RetryPolicy
+# (or retry= if given) when it is a deadlock victim or loses its link - statements on a caller's
+# connection are not rerun one by one (see retry_sql_error), so multi statement loads retry here.
+# The server has rolled back what work did when it failed, so work must start from nothing and be
+# safe to run again if a dropped link hid its commit (eg staging and merging the same rows)
+# Usage:
+# counts = retry_transaction(lambda conn: merge_rows(df, conn), alias='zim_ops')
+def retry_transaction(work, alias='zim_ops', retry=None):
+    policy = get_retry_policy(alias) if retry is None else retry
+    tstart = time.time()
+    retries = 0
+    while True:
+        try:
+            with db_connection(alias) as conn:
+                return work(conn)
+        except Exception as e:
+            # read_sql wraps the pyodbc error in a pandas DatabaseError
+            cause = e.__cause__ if not isinstance(e, p.Error) and isinstance(e.__cause__, p.Error) else e
+            wait = policy.next_delay(policy.classify(cause), retries, tstart) if isinstance(cause, p.Error) else None
+            if wait is None:
+                raise
+        time.sleep(wait)
+        retries = retries + 1
+
+
+# Executes sql on a connection (cursor) - creates the cursor itself so no need
+# for separately creating a connection, just give an alias
+# params are bound by pyodbc (use ? placeholders, or sql_bind() for :name placeholders)
+# so the server can reuse the plan across values
+# Deadlocks and dropped links are rerun under the alias RetryPolicy (or retry= if given), see retry_sql_error
+# writes are only rerun after a dropped link if idempotent=True (e.g. a delete or update to fixed values)
+# cache=True returns a recent identical select from the result cache (see enable_result_cache)
+
+
+def exec_sql(sql, isselect=1, alias='zim_ops', check_sql=False, conn=None, params=None, retry=None, cache=None,
+             idempotent=None):
+    if params is not None:
+        params = [sql_param(x) for x in params]
+    tstart = time.time()
+    cache_key = None
+    if isselect == 1 and (__result_cache_on__ if cache is None else cache):
+        cache_key = result_cache_key(sql, alias, params)
+        df = get_result_cache(cache_key)
+        if df is not None:
+            if __sql_trace__ is not None:
+                trace_sql('cached', sql, alias, tstart, rows=len(df), nbytes=0, params=params)
+            return df
     # Create a cursor for the db in use
     if conn is None:
         conn = get_db_conn(alias)
+    policy = get_retry_policy(alias) if retry is None else retry
+    retries = 0
+    deadlock = False
     # Check whether it is necessary to commit changes (insert/update/delete) or
     # return the records (select)
     df = None
-    if isselect == 1:
-        # Use pandas to return straight to a dataframe
-        success = False
-        max_attempts = 5
-        while not success:
+    try:
+        while True:
             try:
-                chunksize = None  # 5_000_000
-                if chunksize is not None:
-                    df = pd.concat(pd.io.sql.read_sql(
-                        sql, conn, chunksize=chunksize))
-                else:
-                    df = pd.io.sql.read_sql(sql, conn)
-                success = True
-            except p.Error as e:
-                message = str(e)
-                if ('has been chosen as the deadlock victim. Rerun the transaction.' in message) and (max_attempts > 0):
-                    max_attempts = max_attempts - 1
-                    time.sleep(3)
-                elif (conn == __db_connection__) and ('Communication link failure (' in message) and (max_attempts > 0):
-                    reset_db_conn()
-                    conn = None
-                    conn = get_db_conn(alias)
-                    max_attempts = max_attempts - 1
+                if isselect == 1:
+                    # Use pandas to return straight to a dataframe
+                    # for large pulls use iter_sql() to stream chunks instead
+                    df = pd.io.sql.read_sql(sql, conn, params=params)
                 else:
+                    # Execute sql
+                    with conn.cursor() as curs:
+                        if params is not None:
+                            curs.execute(sql, params)
+                        else:
+                            curs.execute(sql)
+                        # Commit the sql - required for insert/update/delete
+                        conn.commit()
+                        # Return the number of rows changed
+                        df = curs.rowcount
+                break
+            except (p.Error, pd.io.sql.DatabaseError) as e:
+                rerun = retry_sql_error(e, policy, retries, tstart, conn, alias,
+                                        idempotent=(isselect == 1) if idempotent is None else idempotent)
+                if rerun is None:
                     raise
-        # For select fetch all the row data and the column names
-        # data = curs.fetchall()
-        # cols = [d[0] for d in curs.description]
-        # Return the data in a pandas data frame
-        # df = pd.DataFrame(data=data, columns=cols)
-    else:
-        # Execute sql
-        success = False
-        max_attempts = 5
-        while not success:
+                kind, conn = rerun
+                deadlock = deadlock or kind == 'deadlock'
+                retries = retries + 1
+    except Exception as e:
+        if __sql_trace__ is not None:
+            trace_sql('select' if isselect == 1 else 'exec', sql, alias, tstart, retries=retries, deadlock=deadlock, error=e,
+                      params=params)
+        raise
+    if __sql_trace__ is not None:
+        if isselect == 1:
+            trace_sql('select', sql, alias, tstart, rows=len(df), nbytes=int(df.memory_usage(deep=True).sum()),
+                      retries=retries, deadlock=deadlock, params=params)
+        else:
+            trace_sql('exec', sql, alias, tstart, rows=df, nbytes=len(sql) + (len(str(params)) if params is not None else 0),
+                      retries=retries, deadlock=deadlock, params=params)
+    if cache_key is not None:
+        set_result_cache(cache_key, sql, df)
+    elif isselect != 1 and (len(__result_cache__) > 0 or __result_cache_path__ is not None):
+        tables = sql_tables(sql)
+        invalidate_result_cache(tables if len(tables) > 0 else None)
+    return df
+
+
+# Query trace - off until start_sql_trace() is called. Each exec_sql / iter_sql / load_to_table call
+# then adds a record with the sql fingerprint, alias, wall time, rows, bytes, retries,
+# deadlock flag and the calling function, kept in memory and/or appended to a jsonl file
+# Usage:
+# start_sql_trace('c:/temp/sql_trace.jsonl')
+# ... run the job ...
+# print(sql_trace_report(stop_sql_trace()))
+__sql_trace__ = None
+__sql_trace_lock__ = threading.Lock()
+
+
+def start_sql_trace(path=None, collect=True):
+    global __sql_trace__
+    with __sql_trace_lock__:
+        __sql_trace__ = {'path': path, 'collect': collect, 'records': []}
+
+
+def stop_sql_trace():
+    # Turn tracing off and return the records collected
+    global __sql_trace__
+    with __sql_trace_lock__:
+        records = [] if __sql_trace__ is None else __sql_trace__['records']
+        __sql_trace__ = None
+    return records
+
+
+def sql_trace_records():
+    with __sql_trace_lock__:
+        return [] if __sql_trace__ is None else list(__sql_trace__['records'])
+
+
+# Normalise sql so calls that only differ by literal values group together
+def sql_fingerprint(sql):
+    sql = re.sub(r"--[^\n]*", " ", sql)
+    sql = re.sub(r"/\*.*?\*/", " ", sql, flags=re.S)
+    sql = re.sub(r"N?'(?:[^']|'')*'", "?", sql)
+    # random transaction names from load_to_table / load_chunk
+    sql = re.sub(r"\bt_\d+\b", "t_?", sql)
+    sql = re.sub(r"(?<![\w\]])-?\d+(\.\d+)?(e[+-]?\d+)?\b", "?", sql, flags=re.I)
+    sql = re.sub(r"\s+", " ", sql).strip().lower()
+    sql = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", sql)
+    return sql
+
+
+# The first function on the stack outside ops_utils - "module:function:line"
+def sql_trace_caller():
+    import inspect
+    this_file = os.path.normcase(os.path.abspath(__file__))
+    frame = inspect.currentframe()
+    try:
+        while frame is not None:
+            if os.path.normcase(os.path.abspath(frame.f_code.co_filename)) != this_file:
+                return os.path.basename(frame.f_code.co_filename) + ":" + frame.f_code.co_name + ":" + str(frame.f_lineno)
+            frame = frame.f_back
+    finally:
+        del frame
+    return None
+
+
+def trace_sql(kind, sql, alias, tstart, rows=None, nbytes=None, retries=0, deadlock=False, error=None, params=None):
+    trace = __sql_trace__
+    if trace is None:
+        return
+    record = {'time': datetime.datetime.now().isoformat(),
+              'kind': kind,
+              'fingerprint': sql_fingerprint(sql),
+              'sql': sql,
+              'params': params,
+              'alias': alias or 'zim_ops',
+              'seconds': time.time() - tstart,
+              'rows': rows,
+              'bytes': nbytes,
+              'retries': retries,
+              'deadlock': deadlock,
+              'error': None if error is None else str(error),
+              'caller': sql_trace_caller(),
+              'thread': threading.current_thread().name}
+    with __sql_trace_lock__:
+        if trace['collect']:
+            trace['records'].append(record)
+        if trace['path'] is not None:
+            import json
+            with open(trace['path'], 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+# Read back a jsonl trace file
+def read_sql_trace(path):
+    import json
+    with open(path, 'r') as f:
+        return [json.loads(x) for x in f if x.strip() != '']
+
+
+# Summary of a trace grouped by sql fingerprint, slowest total first
+def sql_trace_report(records=None):
+    if records is None:
+        records = sql_trace_records()
+    elif type(records) == str:
+        records = read_sql_trace(records)
+    cols = ['fingerprint', 'kind', 'calls', 'seconds', 'mean_seconds', 'max_seconds', 'rows', 'bytes', 'retries', 'deadlocks', 'errors', 'callers']
+    if len(records) == 0:
+        return pd.DataFrame(columns=cols)
+    tmp = pd.DataFrame(records)
+    tmp['rows'] = pd.to_numeric(tmp['rows'], errors='coerce')
+    tmp['bytes'] = pd.to_numeric(tmp['bytes'], errors='coerce')
+    tmp['is_error'] = tmp['error'].notnull()
+    result = tmp.groupby('fingerprint').agg(kind=('kind', 'first'),
+                                            calls=('seconds', 'size'),
+                                            seconds=('seconds', 'sum'),
+                                            mean_seconds=('seconds', 'mean'),
+                                            max_seconds=('seconds', 'max'),
+                                            rows=('rows', 'sum'),
+                                            bytes=('bytes', 'sum'),
+                                            retries=('retries', 'sum'),
+                                            deadlocks=('deadlock', 'sum'),
+                                            errors=('is_error', 'sum'),
+                                            callers=('caller', lambda x: ", ".join(sorted(set([y for y in x if y is not None])))))
+    result = result.reset_index()[cols]
+    return sort_dataframe(result, columns=['seconds'], ascending=False).reset_index(drop=True)
+
+
+# Result cache for selects - off unless exec_sql(cache=True) or enable_result_cache()
+# Entries are keyed on the sql (whitespace normalised), alias and params and expire after the
+# shortest ttl of the tables they read (__result_cache_default_ttl__ if none is set).
+# exec_sql(isselect=0) and load_to_table drop the entries that read the tables they write.
+# With a path the results are also pickled there so other processes can use them - writes
+# leave a <table>.inv stamp in the same folder so those copies are dropped too
+# Usage:
+# enable_result_cache(path='c:/temp/ops_cache/')
+# set_result_cache_ttl('holiday_calendar', 24 * 60 * 60)
+# rates = exec_sql("select * from zimdb_ops..broker_rates", cache=True)
+__result_cache__ = {}
+__result_cache_lock__ = threading.Lock()
+__result_cache_on__ = False
+__result_cache_path__ = None
+__result_cache_default_ttl__ = 5 * 60
+__result_cache_ttl__ = {'holiday_calendar': 24 * 60 * 60,
+                        'broker_rates': 60 * 60,
+                        'ref_rates': 10 * 60,
+                        'ticker_map': 10 * 60,
+                        'ticker_changes': 10 * 60,
+                        'trade_ticker_map': 10 * 60}
+
+
+def enable_result_cache(enabled=True, path=None, default_ttl=None):
+    global __result_cache_on__, __result_cache_path__, __result_cache_default_ttl__
+    __result_cache_on__ = enabled
+    __result_cache_path__ = path
+    if path is not None and not os.path.isdir(path):
+        os.makedirs(path)
+    if default_ttl is not None:
+        __result_cache_default_ttl__ = default_ttl
+
+
+def set_result_cache_ttl(table, ttl):
+    __result_cache_ttl__[split_table_name(table)[1].lower()] = ttl
+
+
+# Tables read or written by a statement - lower case names without the db
+def sql_tables(sql):
+    names = re.findall(r"(?i)\b(?:from|join|into|update|table|delete(?!\s+from\b))\s+((?:\[?[\w#]+\]?\.{1,2})*\[?[\w#]+\]?)", sql)
+    result = set([split_table_name(x)[1].lower() for x in names])
+    return result - set(['from', 'select', 'set', 'where'])
+
+
+def result_cache_key(sql, alias='zim_ops', params=None):
+    import hashlib
+    # collapse whitespace outside quoted strings
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    sql = "".join([re.sub(r"\s+", " ", x) if i % 2 == 0 else x for i, x in enumerate(parts)]).strip().rstrip(';')
+    return hashlib.sha1(((alias or 'zim_ops') + '\n' + sql + '\n' + repr(params)).encode()).hexdigest()
+
+
+def result_cache_stamp(table):
+    # time of the last write to a table seen through the disk cache folder
+    try:
+        with open(os.path.join(__result_cache_path__, table + '.inv'), 'r') as f:
+            return float(f.read())
+    except (IOError, ValueError):
+        return 0
+
+
+def get_result_cache(key):
+    now = time.time()
+    with __result_cache_lock__:
+        entry = __result_cache__.get(key)
+    if entry is None and __result_cache_path__ is not None:
+        import pickle
+        fileloc = os.path.join(__result_cache_path__, key + '.pkl')
+        try:
+            with open(fileloc, 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            entry = None
+    if entry is None:
+        return None
+    stale = entry['expires'] < now
+    if not stale and __result_cache_path__ is not None:
+        stale = any([result_cache_stamp(x) >= entry['time'] for x in entry['tables']])
+    if stale:
+        with __result_cache_lock__:
+            __result_cache__.pop(key, None)
+        if __result_cache_path__ is not None:
+            silentremove(os.path.join(__result_cache_path__, key + '.pkl'))
+        return None
+    with __result_cache_lock__:
+        __result_cache__[key] = entry
+    return entry['df'].copy()
+
+
+def set_result_cache(key, sql, df):
+    now = time.time()
+    tables = sql_tables(sql)
+    ttl = min([__result_cache_ttl__.get(x, __result_cache_default_ttl__) for x in tables] or [__result_cache_default_ttl__])
+    entry = {'time': now, 'expires': now + ttl, 'tables': tables, 'df': df.copy()}
+    with __result_cache_lock__:
+        __result_cache__[key] = entry
+    if __result_cache_path__ is not None:
+        import pickle
+        fileloc = os.path.join(__result_cache_path__, key + '.pkl')
+        with open(fileloc + '.tmp' + str(threading.get_ident()), 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(fileloc + '.tmp' + str(threading.get_ident()), fileloc)
+
+
+# Drop cached results that read any of the tables (all results if tables is None)
+def invalidate_result_cache(tables=None):
+    now = time.time()
+    if tables is not None:
+        tables = set([split_table_name(x)[1].lower() for x in tables])
+    with __result_cache_lock__:
+        for key in list(__result_cache__.keys()):
+            if tables is None or len(__result_cache__[key]['tables'] & tables) > 0:
+                del __result_cache__[key]
+    if __result_cache_path__ is not None:
+        if tables is None:
+            for this_file in os.listdir(__result_cache_path__):
+                if this_file.endswith('.pkl'):
+                    silentremove(os.path.join(__result_cache_path__, this_file))
+        else:
+            for table in tables:
+                with open(os.path.join(__result_cache_path__, table + '.inv'), 'w') as f:
+                    f.write(repr(now))
+
+
+# Run several selects as one batch (a single round trip) - returns a list of DataFrames in order
+# queries are sql strings or (sql, params) tuples with ? placeholders; each must return one result set
+# Usage:
+# max_ref, cols = exec_sql_batch(["select coalesce(max(h_ref),0) from zimdb_ops..broker_holdings",
+#                                 ("select column_name from information_schema.columns where table_name = ?", [table])])
+def exec_sql_batch(queries, alias='zim_ops', conn=None, retry=None):
+    sqls = []
+    params = []
+    for this_query in queries:
+        if isinstance(this_query, (tuple, list)):
+            this_sql, these_params = this_query
+        else:
+            this_sql, these_params = this_query, None
+        sqls.append(this_sql.strip().rstrip(';'))
+        if these_params is not None:
+            params.extend([sql_param(x) for x in these_params])
+    sql = "SET NOCOUNT ON; " + "; ".join(sqls) + ";"
+    if conn is None:
+        conn = get_db_conn(alias)
+    policy = get_retry_policy(alias) if retry is None else retry
+    tstart = time.time()
+    retries = 0
+    deadlock = False
+    try:
+        while True:
             try:
+                result = []
                 with conn.cursor() as curs:
-                    curs.execute(sql)
-                    # Commit the sql - required for insert/update/delete
-                    conn.commit()
-                    success = True
-                    # Return the number of rows changed
-                    df = curs.rowcount
+                    if len(params) > 0:
+                        curs.execute(sql, params)
+                    else:
+                        curs.execute(sql)
+                    # walk the result sets - statements without one (SET) have no description
+                    while True:
+                        if curs.description is not None:
+                            cols = [d[0] for d in curs.description]
+                            rows = curs.fetchall()
+                            result.append(pd.DataFrame.from_records([tuple(x) for x in rows], columns=cols, coerce_float=True))
+                        if not curs.nextset():
+                            break
+                break
             except p.Error as e:
-                message = str(e)
-                if ('has been chosen as the deadlock victim. Rerun the transaction.' in message) and (max_attempts > 0):
-                    max_attempts = max_attempts - 1
-                    time.sleep(3)
-                else:
+                rerun = retry_sql_error(e, policy, retries, tstart, conn, alias, idempotent=True)
+                if rerun is None:
                     raise
-    return df
+                kind, conn = rerun
+                deadlock = deadlock or kind == 'deadlock'
+                retries = retries + 1
+        if len(result) != len(queries):
+            raise Exception('exec_sql_batch expected ' + str(len(queries)) + ' result sets, got ' + str(len(result)))
+    except Exception as e:
+        if __sql_trace__ is not None:
+            trace_sql('batch', sql, alias, tstart, retries=retries, deadlock=deadlock, error=e, params=params)
+        raise
+    if __sql_trace__ is not None:
+        trace_sql('batch', sql, alias, tstart, rows=sum([len(x) for x in result]),
+                  nbytes=sum([int(x.memory_usage(deep=True).sum()) for x in result]), retries=retries, deadlock=deadlock,
+                  params=params)
+    return result
+
+
+# Stream the result of a select as DataFrame chunks of up to chunksize rows
+# Every chunk gets the same dtypes - taken from the cursor description unless given in
+# dtypes ({column: dtype}) - so chunks can be aggregated or concatenated safely.
+# Uses its own pooled connection and releases it when the generator is exhausted or closed
+# Usage:
+# for chunk in iter_sql("select * from zimdb_ops..cash_tickets where date >= ?", 500_000, params=[start]):
+#    total = total + chunk.groupby('prime')['cash_local'].sum()
+def iter_sql(sql, chunksize=100_000, dtypes=None, alias='zim_ops', params=None, conn=None):
+    if params is not None:
+        params = [sql_param(x) for x in params]
+    own_conn = conn is None
+    if own_conn:
+        conn = checkout_db_conn(alias)
+    discard = False
+    curs = None
+    tstart = time.time()
+    nrows = 0
+    nbytes = 0
+    error = None
+    try:
+        curs = conn.cursor()
+        if params is not None:
+            curs.execute(sql, params)
+        else:
+            curs.execute(sql)
+        cols = [d[0] for d in curs.description]
+        col_types = sql_description_dtypes(curs.description)
+        if dtypes is not None:
+            col_types.update(dtypes)
+        while True:
+            rows = curs.fetchmany(int(chunksize))
+            if len(rows) == 0:
+                break
+            chunk = pd.DataFrame.from_records([tuple(x) for x in rows], columns=cols)
+            for this_col, this_type in col_types.items():
+                if this_col in chunk.columns and this_type is not None:
+                    chunk[this_col] = chunk[this_col].astype(this_type)
+            nrows = nrows + len(chunk)
+            if __sql_trace__ is not None:
+                nbytes = nbytes + int(chunk.memory_usage(deep=True).sum())
+            yield chunk
+    except p.Error as e:
+        discard = True
+        error = e
+        raise
+    finally:
+        if __sql_trace__ is not None:
+            trace_sql('iter', sql, alias, tstart, rows=nrows, nbytes=nbytes, error=error, params=params)
+        if curs is not None:
+            try:
+                curs.close()
+            except Exception:
+                discard = True
+        if own_conn:
+            checkin_db_conn(conn, alias, discard=discard)
+
+
+# pandas dtypes for the columns of a cursor description (pyodbc gives the python type)
+# dates are left as datetime.date objects to match the rest of ops_utils
+def sql_description_dtypes(description):
+    import decimal
+    type_map = {int: 'Int64',
+                float: 'float64',
+                decimal.Decimal: 'float64',
+                bool: 'boolean',
+                datetime.datetime: 'datetime64[ns]',
+                str: 'object',
+                datetime.date: 'object'}
+    return {d[0]: type_map.get(d[1], 'object') for d in description}
+
+
+# Run independent selects concurrently, each over its own pooled connection
+# queries = {name: sql} or {name: (sql, params)} - returns {name: DataFrame}
+# cache is passed to exec_sql, or a list of the query names to take from the result cache
+# Usage:
+# ref = gather_sql({'rates': "select * from zimdb_ops..ref_rates where date = ?", ...})
+def gather_sql(queries, alias='zim_ops', max_workers=None, cache=None):
+    if len(queries) == 0:
+        return {}
+
+    def run_one(item):
+        name, query = item
+        sql, params = query if isinstance(query, tuple) else (query, None)
+        # the worker's own thread connection, so deadlocks and dropped links are rerun
+        try:
+            return name, exec_sql(sql, alias=alias, params=params,
+                                  cache=(name in cache) if isinstance(cache, (list, tuple, set)) else cache)
+        finally:
+            release_db_conn(alias)
+    if max_workers is None:
+        max_workers = min(len(queries), get_db_pool(alias).max_size)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(run_one, list(queries.items())))
+
+
+# asyncio versions of exec_sql / gather_sql - the queries run in the default executor
+# Usage:
+# frames = await gather_sql_async({'holidays': sql1, 'rates': sql2})
+async def exec_sql_async(sql, alias='zim_ops', params=None):
+    import asyncio
+
+    def run_one():
+        try:
+            return exec_sql(sql, alias=alias, params=params)
+        finally:
+            release_db_conn(alias)
+    return await asyncio.get_running_loop().run_in_executor(None, run_one)
+
+
+async def gather_sql_async(queries, alias='zim_ops'):
+    import asyncio
+    names = list(queries.keys())
+    tasks = []
+    for name in names:
+        sql, params = queries[name] if isinstance(queries[name], tuple) else (queries[name], None)
+        tasks.append(exec_sql_async(sql, alias=alias, params=params))
+    return dict(zip(names, await asyncio.gather(*tasks)))
+
+
+# Convert a value to something pyodbc can bind (numpy/pandas scalars and NaN/NaT)
+def sql_param(x):
+    if x is None or x is pd.NaT or x is pd.NA:
+        return None
+    if isinstance(x, pd.Timestamp):
+        return None if pd.isnull(x) else x.to_pydatetime()
+    if isinstance(x, np.datetime64):
+        return None if np.isnat(x) else pd.Timestamp(x).to_pydatetime()
+    if isinstance(x, np.generic):
+        x = x.item()
+    if isinstance(x, float) and np.isnan(x):
+        return None
+    return x
+
+
+# Convert sql with :name placeholders to ? placeholders plus the params list for exec_sql
+# lists/tuples/sets/Series are expanded for IN clauses. Table and db names can't be
+# bound - keep building those into the string
+# Usage:
+# sql, params = sql_bind("select * from zimdb_ops..cash_tickets where date_settle = :date and prime in :primes",
+#                        date=this_date, primes=['GS', 'MS'])
+# df = exec_sql(sql, params=params)
+def sql_bind(sql, **values):
+    params = []
+
+    def bind(match):
+        name = match.group(1)
+        if name not in values:
+            return match.group(0)
+        value = values[name]
+        if isinstance(value, (list, tuple, set, pd.Series, pd.Index, np.ndarray)):
+            value = list(value)
+            if len(value) == 0:
+                # nothing to match - keep the sql valid
+                return "(NULL)"
+            params.extend(value)
+            return "(" + ", ".join(["?"] * len(value)) + ")"
+        params.append(value)
+        return "?"
+    sql = re.sub(r"(?<![:\w]):([A-Za-z_]\w*)", bind, sql)
+    return sql, params
+
+
+# Process level cache of table metadata from information_schema, keyed by (alias, db, table)
+# Entries expire after __schema_cache_ttl__ seconds and are dropped by create_table / drop_table_if_exists
+# call invalidate_schema_cache() after any other DDL
+__schema_cache__ = {}
+__schema_cache_ttl__ = 10 * 60
+__schema_cache_lock__ = threading.Lock()
+
+
+def schema_cache_key(table, db='', alias='zim_ops'):
+    return (alias or 'zim_ops', ('' if db is None else db).strip('[]').lower(), ('' if table is None else table).strip('[]').lower())
+
+
+def get_schema_cache(kind, table, db='', alias='zim_ops'):
+    with __schema_cache_lock__:
+        entry = __schema_cache__.get((kind,) + schema_cache_key(table, db, alias))
+    if entry is None or (time.time() - entry[0]) > __schema_cache_ttl__:
+        return None
+    return entry[1]
+
+
+def set_schema_cache(kind, value, table, db='', alias='zim_ops'):
+    with __schema_cache_lock__:
+        __schema_cache__[(kind,) + schema_cache_key(table, db, alias)] = (time.time(), value)
+
+
+# Drop cached metadata for a table plus the table lists of its db, or for a whole db / everything
+# A table is dropped under every db it is cached for, as '' and the default db are the same tables
+def invalidate_schema_cache(table=None, db=None, alias=None):
+    with __schema_cache_lock__:
+        this_alias, this_db, this_table = schema_cache_key(table, db, alias)
+        for key in list(__schema_cache__.keys()):
+            kind, key_alias, key_db, key_table = key
+            if alias is not None and key_alias != this_alias:
+                continue
+            if table is None:
+                drop = db is None or key_db == this_db
+            else:
+                drop = key_table == this_table or (kind == 'tables' and (db is None or key_db in [this_db, '']))
+            if drop:
+                del __schema_cache__[key]
+
+
+# Split "[db]..[table]" / "db..table" / "table" into (db, table)
+def split_table_name(name):
+    parts = [x.strip().strip('[]') for x in name.split('.')]
+    if len(parts) == 1:
+        return '', parts[0]
+    return parts[0], parts[-1]
 
 
 def sql_table_exists(table, db='', alias='zim_ops'):
+    tmp = get_schema_cache('exists', table, db, alias)
+    if tmp is not None:
+        return tmp
     if db == '':
-        tmp = exec_sql("SELECT count(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '" +
-                       table+"'", alias=alias).iloc[0, 0] == 1
+        tmp = exec_sql("SELECT count(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = ?",
+                       alias=alias, params=[table]).iloc[0, 0] == 1
     else:
         tmp = exec_sql("SELECT count(*) FROM " + db +
-                       ".INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '"+table+"'", alias=alias).iloc[0, 0] == 1
+                       ".INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = ?", alias=alias, params=[table]).iloc[0, 0] == 1
+    # only cache tables that exist - one created since (select into, another process) must show up
+    if tmp:
+        set_schema_cache('exists', tmp, table, db, alias)
     return tmp
 
 
+# List the tables in a db, optionally only those starting with prefix (cached)
+def sql_table_list(db='', prefix=None, alias='zim_ops'):
+    tmp = get_schema_cache('tables', '', db, alias)
+    if tmp is None:
+        tmp = list(exec_sql("select table_name from " + ('' if db == '' or db is None else db + ".") +
+                            "information_schema.tables", alias=alias)['table_name'])
+        set_schema_cache('tables', tmp, '', db, alias)
+    if prefix is not None:
+        tmp = [x for x in tmp if x.lower().startswith(prefix.lower())]
+    return list(tmp)
+
+
 def drop_table_if_exists(table, alias='zim_ops'):
     # Check if table exists, and if so drop it
     # dropsql = "IF (EXISTS (SELECT * " + \
@@ -158,6 +1374,7 @@ def drop_table_if_exists(table, alias='zim_ops'):
     #       "BEGIN " + \
     #       "    DROP TABLE " + table + " " + \
     #       "END"
+    this_db, this_table = split_table_name(table)
     try:
         dropsql = "DROP TABLE " + table
         # Execute the drop
@@ -165,6 +1382,8 @@ def drop_table_if_exists(table, alias='zim_ops'):
         return result
     except:
         print("can't find " + table, flush=True)
+    finally:
+        invalidate_schema_cache(this_table, db=this_db if this_db != '' else None, alias=alias)
 
 
 def merge_df_list(dflist, merge_type):
@@ -192,73 +1411,215 @@ def merge_df_list(dflist, merge_type):
     return df
 
 
-def sql_table_cols(table, db='', alias='', details=False, conn=None):
-    tmp = exec_sql("select column_name " + (",data_type,character_maximum_length" if details else "") + " from " + ('' if db ==
-                   '' or db is None else db + ".") + "information_schema.columns where TABLE_NAME= '"+table+"' order by ORDINAL_POSITION", alias=alias, conn=conn)
-    if len(tmp.columns) == 1:
-        tmp = list(tmp.iloc[:, 0])
-    else:
+def sql_table_cols(table, db='', alias='', details=False, conn=None, use_cache=True):
+    # the details are always fetched so one cache entry serves both forms
+    tmp = get_schema_cache('cols', table, db, alias) if use_cache else None
+    if tmp is None:
+        tmp = exec_sql("select column_name,data_type,character_maximum_length from " + ('' if db ==
+                       '' or db is None else db + ".") + "information_schema.columns where TABLE_NAME= ? order by ORDINAL_POSITION", alias=alias, conn=conn,
+                       params=[table])
         tmp.columns = ['name', 'type', 'len']
+        # don't cache a missing table - it may be about to be created
+        if len(tmp) > 0:
+            set_schema_cache('cols', tmp, table, db, alias)
+    if details:
+        tmp = tmp.copy()
+    else:
+        tmp = list(tmp['name'])
     return tmp
 
-# Wrapper for bulk insert that simplifies the load and checks load was successful
-# Index is not loaded to table. Use .reset_index() prior to sending if index columns are to be kept
+# Read only the columns and rows needed from a table - the filters are sent as parameters
+# where = {col: value} - value can be a single value (None for null), a list / set / Series of values (in)
+# or a (low, high) tuple (between, either end can be None)
+# date_range = (low, high) on date_col. Columns are checked against the cached table schema
+# group_by sums the sums columns (default the numeric columns) on the server
+# returnsql gives (sql, params) instead, eg for gather_sql
+# Usage:
+# pos = read_table('holdings', 'zimdb_ops', columns=['date', 'bb_code', 'quantity'], where={'prime': ['GS', 'MS']},
+#                  date_range=(start, end), group_by=['date', 'bb_code'])
+__read_table_max_params__ = 2000
+
+
+def read_table(table, db=None, columns=None, where=None, date_range=None, date_col='date', group_by=None, sums=None,
+               alias='zim_ops', cache=None, returnsql=False):
+    col_types = sql_table_cols(table, db=db, alias=alias, details=True)
+    if len(col_types) == 0:
+        raise ValueError('Table ' + table + ' not found')
+    lookup = {x.lower(): x for x in col_types['name']}
+
+    def check_cols(cols):
+        missing = [x for x in cols if x.lower() not in lookup]
+        if len(missing) > 0:
+            raise ValueError('Columns ' + str(missing) + ' not in ' + table)
+        return [lookup[x.lower()] for x in cols]
+    where = dict(where or {})
+    if date_range is not None:
+        where[date_col] = tuple(date_range)
+    where = dict(zip(check_cols(list(where.keys())), where.values()))
+    group_by = None if group_by is None else check_cols(list(group_by))
+    if columns is not None:
+        columns = check_cols(list(columns))
+    if group_by is not None:
+        if sums is None:
+            types = col_types.set_index('name')['type']
+            sums = [x for x in (columns or list(col_types['name'])) if x not in group_by and
+                    types[x] in ['int', 'bigint', 'smallint', 'tinyint', 'float', 'real', 'decimal', 'numeric', 'money']]
+        sums = check_cols(list(sums))
+        select = ", ".join(["[" + x + "]" for x in group_by] + ["sum([" + x + "]) as [" + x + "]" for x in sums])
+    else:
+        select = "*" if columns is None else ", ".join(["[" + x + "]" for x in columns])
+    # the biggest list is split up if there are too many parameters for one query
+    lists = {x: list(y) for x, y in where.items() if isinstance(y, (list, set, np.ndarray, pd.Series, pd.Index))}
+    split_col = max(lists, key=lambda x: len(lists[x])) if len(lists) > 0 else None
+    others = sum([len(y) for x, y in lists.items() if x != split_col]) + len(where)
+    step = max(__read_table_max_params__ - others, 1)
+    parts = [None] if split_col is None else [lists[split_col][i:i + step] for i in range(0, max(len(lists[split_col]), 1), step)]
+    queries = []
+    for part in parts:
+        conds = []
+        params = []
+        for this_col, value in where.items():
+            value = part if this_col == split_col else lists.get(this_col, value)
+            if isinstance(value, list):
+                if len(value) == 0:
+                    conds.append("1 = 0")
+                else:
+                    conds.append("[" + this_col + "] in (" + ", ".join(["?"] * len(value)) + ")")
+                    params = params + [sql_param(x) for x in value]
+            elif isinstance(value, tuple):
+                if len(value) != 2:
+                    raise ValueError('Range for ' + this_col + ' must be (low, high)')
+                if value[0] is not None:
+                    conds.append("[" + this_col + "] >= ?")
+                    params.append(sql_param(value[0]))
+                if value[1] is not None:
+                    conds.append("[" + this_col + "] <= ?")
+                    params.append(sql_param(value[1]))
+            elif value is None:
+                conds.append("[" + this_col + "] is null")
+            else:
+                conds.append("[" + this_col + "] = ?")
+                params.append(sql_param(value))
+        sql = "select " + select + " from " + ('' if db == '' or db is None else db + "..") + table + \
+            (" where " + " and ".join(conds) if len(conds) > 0 else '') + \
+            (" group by " + ", ".join(["[" + x + "]" for x in group_by]) if group_by is not None else '')
+        queries.append((sql, params if len(params) > 0 else None))
+    if returnsql:
+        return queries[0] if len(queries) == 1 else queries
+    result = [exec_sql(sql, alias=alias, params=params, cache=cache) for sql, params in queries]
+    if len(result) == 1:
+        return result[0]
+    result = pd.concat(result, ignore_index=True)
+    if group_by is not None:
+        result = result.groupby(group_by, dropna=False)[sums].sum().reset_index()
+    return result
 
 
-def load_to_table(df, table, db=None, index=False, keepnulls=True, pathloc=None, verbose=False, encoding=None, step_size=1e100, pre_sql_cmd='', printrows=False):
-    pathloc = activate_env.sql_tmp
+# Engines load_to_table can use:
+#   'bulk'        - write a csv to the sql tmp share and BULK INSERT it (default)
+#   'executemany' - send the rows over the connection with pyodbc fast_executemany, no temp file
+# set per alias with set_load_engine() or per call with load_to_table(engine=...)
+__load_engine__ = {}
+__load_engines__ = ['bulk', 'executemany']
+
+
+def set_load_engine(engine, alias='zim_ops'):
+    if engine not in __load_engines__:
+        raise ValueError("engine must be one of " + str(__load_engines__))
+    __load_engine__[alias or 'zim_ops'] = engine
+
+
+def get_load_engine(alias='zim_ops'):
+    return __load_engine__.get(alias or 'zim_ops', 'executemany' if is_local_alias(alias) else 'bulk')
+
+
+# Wrapper for bulk insert that simplifies the load and checks load was successful
+# Index is not loaded to table. Use .reset_index() prior to sending if index columns are to be kept
+# With workers > 1 the step_size chunks are written and loaded concurrently, each over its
+# own pooled connection and temp file. The chunks commit separately, so pre_sql_cmd can't be used with
+# workers > 1 (a failed chunk would leave its delete done) - replace rows with upsert_table or
+# swap_load_dates instead
+
+
+def load_to_table(df, table, db=None, index=False, keepnulls=True, pathloc=None, verbose=False, encoding=None, step_size=1e100, pre_sql_cmd='', printrows=False,
+                  engine=None, alias='zim_ops', workers=1):
+    if engine is None:
+        engine = get_load_engine(alias)
+    if engine not in __load_engines__:
+        raise ValueError("engine must be one of " + str(__load_engines__))
+    if workers > 1 and pre_sql_cmd != '':
+        raise ValueError('load_to_table can not run pre_sql_cmd with workers > 1 - use upsert_table or swap_load_dates')
+    tstart = time.time()
     # match the columns of the df to the table
-    tmp = sql_table_cols(table, db=db)
+    tmp = sql_table_cols(table, db=db, alias=alias)
     for this_col in set(tmp) - set(df.reset_index().columns):
         df[this_col] = np.nan
     tmp_df = df.reset_index()[tmp]
-    # Create a random file name
-    randname = 'xxx_' + datetime.datetime.now().strftime('%Y%m%d%H%M') + '_' + \
-        str(round(random.random()*1e15))
-    # Use this location for a temp file
-    fileloc = pathloc + randname + '.csv'
+    # Full name of the table to load
+    if db is not None and db != '':
+        tmp_db_name = db + ".." + table
+    else:
+        tmp_db_name = table
+    fileloc = None
+    if engine == 'bulk':
+        fileloc = bulk_tmp_file()
     # do it in row steps specified
-    try:
-        pos = 0
-        rowcount = 0
-        while pos < len(tmp_df):
-            pos_next = min(pos + step_size, len(tmp_df))
-            # Save to csv with no index (due to index reset, index is just ints)
-            if encoding:
-                tmp_df.iloc[pos:pos_next].to_csv(
-                    fileloc, index=False, encoding=encoding)
-            else:
-                tmp_df.iloc[pos:pos_next].to_csv(fileloc, index=False)
-            # Run the bulk insert
-            if db is not None and db != '':
-                tmp_db_name = db + ".." + table
-            else:
-                tmp_db_name = table
-            sqlcmd = bulk_insert(fileloc, tmp_db_name, rterm='\\n',
-                                 keepnulls=keepnulls, returnsql=True, encoding=encoding)
-            randname = str(round(random.random()*1e15))
-            # Prepare and execute the transaction as a whole
-            sqltransaction = "begin transaction t_" + randname + "; " + \
-                (('SET NOCOUNT ON; ' + pre_sql_cmd + "; SET NOCOUNT OFF; ") if pre_sql_cmd != "" else "") + \
-                sqlcmd + "; " + \
-                "commit transaction t_" + randname + "; "
-            if verbose:
-                print("AT " + str(datetime.datetime.now()) + " doing rows " +
-                      str(pos) + " out of " + str(len(tmp_df)) + " SQL : " + sqltransaction)
-            rowcount = rowcount + exec_sql(sqltransaction, isselect=0)
-            pos = pos_next
-    except:
-        print('Problem file: ' + fileloc, flush=True)
-        raise
+    chunks = []
+    pos = 0
+    while pos < len(tmp_df):
+        pos_next = int(min(pos + step_size, len(tmp_df)))
+        chunks.append((pos, pos_next))
+        pos = pos_next
+    if workers > 1 and len(chunks) > 1:
+        def load_one(i):
+            chunk_file = None if fileloc is None else fileloc.replace('.csv', '_' + str(i) + '.csv')
+            try:
+                # each chunk commits on its own over the worker's thread connection, so a deadlock
+                # victim is rerun
+                result = load_chunk(tmp_df.iloc[chunks[i][0]:chunks[i][1]], tmp_db_name, engine=engine, fileloc=chunk_file,
+                                    keepnulls=keepnulls, encoding=encoding, alias=alias, verbose=verbose,
+                                    rows_info=(chunks[i][0], len(tmp_df)))
+            except:
+                if chunk_file is not None:
+                    print('Problem file: ' + chunk_file, flush=True)
+                raise
+            finally:
+                release_db_conn(alias)
+            if chunk_file is not None:
+                silentremove(chunk_file)
+            return result
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                rowcount = sum(executor.map(load_one, range(len(chunks))))
+        except Exception as e:
+            trace_sql('load', 'load_to_table ' + tmp_db_name, alias, tstart, nbytes=load_trace_bytes(tmp_df), error=e)
+            invalidate_result_cache([table])
+            raise
+    else:
+        try:
+            rowcount = 0
+            for pos, pos_next in chunks:
+                rowcount = rowcount + load_chunk(tmp_df.iloc[pos:pos_next], tmp_db_name, engine=engine, fileloc=fileloc,
+                                                 keepnulls=keepnulls, encoding=encoding, pre_sql_cmd=pre_sql_cmd, alias=alias,
+                                                 verbose=verbose, rows_info=(pos, len(tmp_df)))
+        except Exception as e:
+            if fileloc is not None:
+                print('Problem file: ' + fileloc, flush=True)
+            trace_sql('load', 'load_to_table ' + tmp_db_name, alias, tstart, nbytes=load_trace_bytes(tmp_df), error=e)
+            invalidate_result_cache([table])
+            raise
+    trace_sql('load', 'load_to_table ' + tmp_db_name, alias, tstart, rows=rowcount, nbytes=load_trace_bytes(tmp_df))
+    invalidate_result_cache([table])
     # rowcount = bulk_insert(fileloc, tmp, rterm='\\n', keepnulls=keepnulls)
     # Check that all rows were inserted
     # don't check if pre_sql_cmd used - usually a delete first, but that means the number of rows changed may not equal
-    # if some rows already exist
+    # if some rows already exist. There is no pre_sql_cmd with workers > 1, so the chunk counts are always checked
     if rowcount != len(df) and pre_sql_cmd == '':
         print("table " + table + " expected " +
               str(len(df)) + " got " + str(rowcount))
         raise Exception('Bulk upload in load_to_table failed')
-    else:
+    elif fileloc is not None:
         # Remove the temporary file
         silentremove(fileloc)
     # Return count of inserted rows
@@ -268,8 +1629,470 @@ def load_to_table(df, table, db=None, index=False, keepnulls=True, pathloc=None,
     return rowcount
 
 
+# Random csv file name on the sql tmp share for BULK INSERT
+def bulk_tmp_file():
+    pathloc = activate_env.sql_tmp
+    # Create a random file name
+    randname = 'xxx_' + datetime.datetime.now().strftime('%Y%m%d%H%M') + '_' + \
+        str(round(random.random()*1e15))
+    # Use this location for a temp file
+    return pathloc + randname + '.csv'
+
+
+# Size of the data sent by load_to_table - only worked out when tracing
+def load_trace_bytes(df):
+    if __sql_trace__ is None:
+        return None
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+
+# Load one chunk of rows into a table in its own transaction - returns the rows inserted
+# exec_sql / insert_rows rerun the chunk under the alias RetryPolicy (deadlock victim, dropped link)
+def load_chunk(chunk_df, table, engine='bulk', fileloc=None, keepnulls=True, encoding=None, pre_sql_cmd='', alias='zim_ops', conn=None,
+               verbose=False, rows_info=None):
+    if verbose:
+        where = (" doing rows " + str(rows_info[0]) + " out of " + str(rows_info[1])) if rows_info is not None else \
+            (" doing " + str(len(chunk_df)) + " rows")
+    if engine == 'executemany':
+        if verbose:
+            print("AT " + str(datetime.datetime.now()) + where + " into " + table)
+        return insert_rows(chunk_df, table, pre_sql_cmd=pre_sql_cmd, alias=alias, conn=conn)
+    # Save to csv with no index (due to index reset, index is just ints)
+    if encoding:
+        chunk_df.to_csv(fileloc, index=False, encoding=encoding)
+    else:
+        chunk_df.to_csv(fileloc, index=False)
+    sqlcmd = bulk_insert(fileloc, table, rterm='\\n',
+                         keepnulls=keepnulls, returnsql=True, encoding=encoding)
+    randname = str(round(random.random()*1e15))
+    # Prepare and execute the transaction as a whole
+    sqltransaction = "begin transaction t_" + randname + "; " + \
+        (('SET NOCOUNT ON; ' + pre_sql_cmd + "; SET NOCOUNT OFF; ") if pre_sql_cmd != "" else "") + \
+        sqlcmd + "; " + \
+        "commit transaction t_" + randname + "; "
+    if verbose:
+        print("AT " + str(datetime.datetime.now()) + where + " SQL : " + sqltransaction)
+    return exec_sql(sqltransaction, isselect=0, alias=alias, conn=conn)
+
+
+# Convert a DataFrame to a list of row tuples of plain python values (None for NaN/NaT)
+def df_to_rows(df):
+    cols = []
+    for this_col in df.columns:
+        values = df[this_col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = pd.Series(values.dt.to_pydatetime(), index=values.index, dtype=object)
+        values = values.astype(object)
+        cols.append([sql_param(x) for x in values])
+    return list(zip(*cols))
+
+
+# Insert the rows of df straight over the connection (pyodbc fast_executemany)
+# pre_sql_cmd is run first and post_sql_cmd last in the same transaction. Returns the number of rows the
+# server reports inserted (summed per batch of __insert_rows_batch__), -1 if the driver didn't report a count
+__insert_rows_batch__ = 10000
+
+
+def insert_rows(df, table, pre_sql_cmd='', alias='zim_ops', conn=None, retry=None, post_sql_cmd=''):
+    if conn is None:
+        conn = get_db_conn(alias)
+    sqlcmd = "INSERT INTO " + table + " (" + ", ".join(["[" + x + "]" for x in df.columns]) + ") VALUES (" + \
+        ", ".join(["?"] * len(df.columns)) + ")"
+    rows = df_to_rows(df)
+    policy = get_retry_policy(alias) if retry is None else retry
+    tstart = time.time()
+    retries = 0
+    while True:
+        try:
+            inserted = 0
+            with conn.cursor() as curs:
+                curs.fast_executemany = True
+                # pooled connections can be left with NOCOUNT on, which hides the row counts
+                curs.execute('SET NOCOUNT OFF')
+                if pre_sql_cmd != '':
+                    curs.execute(pre_sql_cmd)
+                for pos in range(0, len(rows), __insert_rows_batch__):
+                    curs.executemany(sqlcmd, rows[pos:pos + __insert_rows_batch__])
+                    if curs.rowcount < 0 or inserted < 0:
+                        inserted = -1
+                    else:
+                        inserted = inserted + curs.rowcount
+                if post_sql_cmd != '':
+                    curs.execute(post_sql_cmd)
+                conn.commit()
+            break
+        except p.Error as e:
+            rerun = retry_sql_error(e, policy, retries, tstart, conn, alias)
+            if rerun is None:
+                try:
+                    conn.rollback()
+                except p.Error:
+                    pass
+                raise
+            kind, conn = rerun
+            retries = retries + 1
+    return inserted
+
+
+# Reserve a block of n new ids for a table's id column - returns range(first, first + n)
+# The ids come from a SEQUENCE in the table's db ([seq_<table>_<col>]), created on first use to start
+# after the current max(col), and are handed out with sp_sequence_get_range so concurrent loaders
+# never get the same ids. Everything writing the column must take its ids from here
+# Usage:
+# result['h_ref'] = list(reserve_ids('broker_holdings', len(result), db='zimdb_ops', col='h_ref'))
+__sequences_checked__ = set()
+__reserve_ids_lock__ = threading.Lock()
+
+
+def reserve_ids(table, n, db=None, col='h_ref', alias='zim_ops'):
+    n = int(n)
+    if n <= 0:
+        return range(0)
+    seq = 'seq_' + table + '_' + col
+    prefix = '' if db is None or db == '' else '[' + db + '].'
+    full_name = ('' if db is None or db == '' else '[' + db + ']..') + '[' + table + ']'
+    if is_local_alias(alias):
+        # no sequences in sqlite - a table of next ids updated under a lock
+        with __reserve_ids_lock__:
+            exec_sql("create table if not exists local_sequences (name varchar(255) primary key, next_id bigint)", isselect=0,
+                     alias=alias)
+            tmp = exec_sql("select next_id from local_sequences where name = ?", alias=alias, params=[seq], cache=False)
+            if len(tmp) == 0:
+                first = int(exec_sql("select coalesce(max([" + col + "]), 0) + 1 from " + full_name, alias=alias,
+                                     cache=False).iloc[0, 0])
+                exec_sql("insert into local_sequences (name, next_id) values (?, ?)", isselect=0, alias=alias, params=[seq, first + n])
+            else:
+                first = int(tmp.iloc[0, 0])
+                exec_sql("update local_sequences set next_id = ? where name = ?", isselect=0, alias=alias, params=[first + n, seq])
+        return range(first, first + n)
+    if (alias, db, seq) not in __sequences_checked__:
+        # the applock stops two first runs both creating the sequence
+        sql = "SET NOCOUNT ON; begin transaction; " + \
+              "declare @lock int; exec @lock = sp_getapplock @Resource = '" + seq + "', @LockMode = 'Exclusive', @LockOwner = 'Transaction'; " + \
+              "if object_id('" + prefix + "dbo.[" + seq + "]', 'SO') is null " + \
+              "begin " + \
+              "declare @start bigint, @sql nvarchar(max); " + \
+              "select @start = coalesce(max([" + col + "]), 0) + 1 from " + full_name + " with (tablockx, holdlock); " + \
+              "set @sql = N'create sequence dbo.[" + seq + "] as bigint start with ' + cast(@start as nvarchar(20)) + N' increment by 1 cache 100'; " + \
+              "exec " + prefix + "sys.sp_executesql @sql; " + \
+              "end; " + \
+              "commit transaction;"
+        exec_sql(sql, isselect=0, alias=alias)
+        __sequences_checked__.add((alias, db, seq))
+    sql = "SET NOCOUNT ON; declare @first sql_variant; " + \
+          "exec " + prefix + "sys.sp_sequence_get_range @sequence_name = N'dbo." + seq + "', @range_size = ?, " + \
+          "@range_first_value = @first output; " + \
+          "select cast(@first as bigint) as first_id"
+    first = int(exec_sql(sql, alias=alias, params=[n], cache=False).iloc[0, 0])
+    return range(first, first + n)
+
+
+# The ids for the rows of df - the id of the table row with the same keys within the scope values of
+# df (eg the dates being reloaded), or a new id from reserve_ids for rows not in the table. Rows that
+# repeat a key are paired with the table rows for it in id order. Keys are compared on the column
+# types of the table, nulls match nulls and strings are compared without trailing spaces ('' is null)
+# Lets upsert_table keep the ids of unchanged rows, so a reload only touches the rows that changed
+# Usage:
+# result['h_ref'] = match_ids(result, 'cna_broker_holdings', keys=['date', 'prime', 'sedol', 'type'], db='zimdb_ops')
+def match_ids(df, table, keys, db=None, col='h_ref', scope=('date',), alias='zim_ops'):
+    keys = list(keys)
+    scope = list(scope)
+    if len(df) == 0:
+        return []
+    types = sql_table_cols(table, db=db, alias=alias, details=True).set_index('name')['type']
+
+    def key_frame(frame):
+        tmp = pd.DataFrame(index=range(len(frame)))
+        for this_col in keys:
+            values = pd.Series(list(frame[this_col]), dtype=object)
+            if types.get(this_col) in ['date', 'datetime', 'datetime2', 'smalldatetime']:
+                values = pd.to_datetime(values, errors='coerce')
+            elif types.get(this_col) in ['int', 'bigint', 'smallint', 'tinyint', 'float', 'real', 'decimal', 'numeric', 'money']:
+                values = pd.to_numeric(values, errors='coerce')
+            else:
+                values = values.where(values.notnull()).map(lambda x: x if pd.isnull(x) else str(x).rstrip())
+                values = values.where(values != '')
+            tmp[this_col] = values.values
+        tmp['_n'] = tmp.groupby(keys, dropna=False).cumcount().values
+        return tmp
+    existing = read_table(table, db=db, columns=list(dict.fromkeys(scope + keys + [col])),
+                          where={x: list(pd.unique(df[x])) for x in scope}, alias=alias, cache=False)
+    existing = existing.sort_values(col, kind='mergesort').reset_index(drop=True)
+    old = key_frame(existing)
+    old['_id'] = existing[col].values
+    ids = key_frame(df).merge(old, on=keys + ['_n'], how='left')['_id']
+    new = ids.isnull().values
+    if new.any():
+        ids[new] = list(reserve_ids(table, int(new.sum()), db=db, col=col, alias=alias))
+    return [int(x) for x in ids]
+
+
+# Upsert a DataFrame into a table on its key columns - returns {'inserted', 'updated', 'deleted'} counts
+# The rows are loaded to a session temp table and applied in one transaction:
+#   'merge'         - one MERGE; only rows whose values changed count as updated (default)
+#   'delete_insert' - keyed delete of the matched rows then insert; matched rows count as updated
+#                     (used for the local db, which has no MERGE)
+# delete_scope columns (eg ['date']) also delete target rows in the same scope values as the
+# DataFrame whose keys are not in it, so the scope ends up holding exactly the DataFrame rows
+# A deadlock or dropped link reruns the whole stage and apply under the RetryPolicy (retry_transaction)
+# Usage:
+# counts = upsert_table(df, 'broker_margin', db='zimdb_ops', keys=['date'])
+# counts = upsert_table(df, 'cna_broker_holdings', db='zimdb_ops', keys=['h_ref'], delete_scope=['date'])
+def upsert_table(df, table, db=None, keys=[], delete_scope=None, mode=None, alias='zim_ops', engine=None, keepnulls=True,
+                 encoding=None, verbose=False, retry=None):
+    if len(keys) == 0:
+        raise ValueError('upsert_table needs the key columns')
+    if mode is None:
+        mode = 'delete_insert' if is_local_alias(alias) else 'merge'
+    if mode not in ['merge', 'delete_insert']:
+        raise ValueError("mode must be 'merge' or 'delete_insert'")
+    if engine is None:
+        engine = get_load_engine(alias)
+    delete_scope = [] if delete_scope is None else list(delete_scope)
+    tstart = time.time()
+    # match the columns of the df to the table
+    cols = sql_table_cols(table, db=db, alias=alias)
+    missing = [x for x in keys + delete_scope if x not in cols]
+    if len(missing) > 0:
+        raise ValueError(table + ' has no columns ' + str(missing))
+    tmp_df = df.reset_index()
+    for this_col in set(cols) - set(tmp_df.columns):
+        tmp_df[this_col] = np.nan
+    tmp_df = tmp_df[cols]
+    if tmp_df.duplicated(keys).any():
+        raise ValueError('upsert_table rows are not unique on ' + str(keys))
+    if db is not None and db != '':
+        tmp_db_name = db + ".." + table
+    else:
+        tmp_db_name = table
+    local = is_local_alias(alias)
+    randname = str(round(random.random()*1e15))
+    stage = ('stage_' if local else '#stage_') + randname
+    col_list = ", ".join(["[" + x + "]" for x in cols])
+    non_keys = [x for x in cols if x not in keys]
+
+    def match(a, b, these_cols):
+        return " and ".join([a + ".[" + x + "] = " + b + ".[" + x + "]" for x in these_cols])
+    files = []
+
+    # stage and apply the rows - rerun from the start on a new connection after a deadlock or dropped link
+    def attempt(conn):
+        counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        fileloc = None
+        try:
+            if local:
+                exec_sql("create temp table " + stage + " as select * from " + tmp_db_name + " where 0", isselect=0, alias=alias,
+                         conn=conn)
+            else:
+                exec_sql("select top 0 * into " + stage + " from " + tmp_db_name, isselect=0, alias=alias, conn=conn)
+            if len(tmp_df) > 0:
+                if engine == 'bulk':
+                    fileloc = bulk_tmp_file()
+                    files.append(fileloc)
+                load_chunk(tmp_df, stage, engine=engine, fileloc=fileloc, keepnulls=keepnulls, encoding=encoding, alias=alias,
+                           conn=conn, verbose=verbose)
+            if mode == 'merge':
+                target = tmp_db_name
+                if len(delete_scope) > 0:
+                    # only rows in the scope of the DataFrame can be deleted
+                    target = "scope"
+                sqlcmd = "SET NOCOUNT ON; DECLARE @actions TABLE (action nvarchar(10)); " + \
+                    ("WITH scope AS (SELECT * FROM " + tmp_db_name + " d WHERE EXISTS (SELECT 1 FROM " + stage + " x WHERE " +
+                     match('x', 'd', delete_scope) + ")) " if len(delete_scope) > 0 else "") + \
+                    "MERGE " + target + ("" if len(delete_scope) > 0 else " WITH (HOLDLOCK)") + " AS t USING " + stage + \
+                    " AS s ON " + match('t', 's', keys) + \
+                    ((" WHEN MATCHED AND EXISTS (SELECT " + ", ".join(["s.[" + x + "]" for x in non_keys]) + " EXCEPT SELECT " +
+                      ", ".join(["t.[" + x + "]" for x in non_keys]) + ") THEN UPDATE SET " +
+                      ", ".join(["t.[" + x + "] = s.[" + x + "]" for x in non_keys])) if len(non_keys) > 0 else "") + \
+                    " WHEN NOT MATCHED BY TARGET THEN INSERT (" + col_list + ") VALUES (" + \
+                    ", ".join(["s.[" + x + "]" for x in cols]) + ")" + \
+                    (" WHEN NOT MATCHED BY SOURCE THEN DELETE" if len(delete_scope) > 0 else "") + \
+                    " OUTPUT $action INTO @actions; " + \
+                    "SELECT coalesce(sum(case when action = 'INSERT' then 1 else 0 end), 0) as inserted, " + \
+                    "coalesce(sum(case when action = 'UPDATE' then 1 else 0 end), 0) as updated, " + \
+                    "coalesce(sum(case when action = 'DELETE' then 1 else 0 end), 0) as deleted FROM @actions;"
+                if verbose:
+                    print("AT " + str(datetime.datetime.now()) + " SQL : " + sqlcmd)
+                result = exec_sql_batch([sqlcmd], alias=alias, conn=conn)[0]
+                counts = {x: int(result.iloc[0][x]) for x in ['inserted', 'updated', 'deleted']}
+            else:
+                # one transaction - the statements are committed together
+                if local:
+                    delete_head = "DELETE FROM " + tmp_db_name + " WHERE "
+                    t = split_table_name(tmp_db_name)[1]
+                else:
+                    delete_head = "DELETE t FROM " + tmp_db_name + " t WHERE "
+                    t = 't'
+                with conn.cursor() as curs:
+                    if len(delete_scope) > 0:
+                        curs.execute(delete_head + "EXISTS (SELECT 1 FROM " + stage + " x WHERE " + match('x', t, delete_scope) +
+                                     ") AND NOT EXISTS (SELECT 1 FROM " + stage + " s WHERE " + match('s', t, keys) + ")")
+                        counts['deleted'] = max(curs.rowcount, 0)
+                    curs.execute(delete_head + "EXISTS (SELECT 1 FROM " + stage + " s WHERE " + match('s', t, keys) + ")")
+                    removed = max(curs.rowcount, 0)
+                    curs.execute("INSERT INTO " + tmp_db_name + " (" + col_list + ") SELECT " + col_list + " FROM " + stage)
+                    # duplicate target rows on a key are replaced by one row - the extras count as deleted
+                    counts['updated'] = min(removed, max(curs.rowcount, 0))
+                    counts['inserted'] = max(curs.rowcount, 0) - counts['updated']
+                    counts['deleted'] = counts['deleted'] + removed - counts['updated']
+                    conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            try:
+                exec_sql("DROP TABLE " + stage, isselect=0, alias=alias, conn=conn)
+            except Exception:
+                pass
+        return counts
+    try:
+        counts = retry_transaction(attempt, alias=alias, retry=retry)
+    except Exception as e:
+        trace_sql('upsert', 'upsert_table ' + tmp_db_name, alias, tstart, nbytes=load_trace_bytes(tmp_df), error=e)
+        for fileloc in files[:-1]:
+            silentremove(fileloc)
+        if len(files) > 0:
+            print('Problem file: ' + files[-1], flush=True)
+        raise
+    finally:
+        invalidate_result_cache([table])
+    for fileloc in files:
+        silentremove(fileloc)
+    trace_sql('upsert', 'upsert_table ' + tmp_db_name, alias, tstart, rows=sum(counts.values()), nbytes=load_trace_bytes(tmp_df))
+    if verbose:
+        print(table + ' upsert: ' + str(counts), flush=True)
+    return counts
+
+
+# Replace whole dates of a table with the rows in df, switching them in so readers never see
+# the dates missing and the old rows are not deleted row by row. Returns {date: rows loaded}
+# The table must be partitioned on date_col with one date per partition and have no other indexes:
+# each date is loaded to a shadow table on the same partition scheme, counted and then switched in
+# with ALTER TABLE ... SWITCH PARTITION (the old partition is switched out first). Any other table
+# raises ValueError - use upsert_table with delete_scope=[date_col] for those
+# A date that is a deadlock victim or loses its link is loaded and switched again (retry_transaction)
+# Usage:
+# swap_load_dates(df, 'cna_broker_holdings', db='zimdb_ops')
+def swap_load_dates(df, table, db=None, date_col='date', alias='zim_ops', engine=None, verbose=False, retry=None):
+    if date_col not in df.columns:
+        raise ValueError('swap_load_dates needs a ' + date_col + ' column')
+    expected = df.groupby(date_col).size()
+    dates = list(expected.index)
+    if len(dates) == 0:
+        return {}
+    info = table_partition_info(table, db=db, alias=alias)
+    if info is None or info['column'] != date_col:
+        raise ValueError('swap_load_dates needs ' + table + ' partitioned on ' + date_col)
+    if info['other_indexes']:
+        raise ValueError('swap_load_dates can not switch partitions of ' + table + ' - it has non-clustered indexes')
+    parts = [partition_number(info, x, db=db, alias=alias) for x in dates]
+    nexts = [partition_number(info, (pd.Timestamp(x) + pd.offsets.Day(1)).date(), db=db, alias=alias) for x in dates]
+    if not all([x != y for x, y in zip(parts, nexts)]) or len(set(parts)) != len(parts):
+        raise ValueError('swap_load_dates needs one ' + date_col + ' per partition of ' + table)
+    try:
+        for this_date, this_part in zip(dates, parts):
+            switch_partition_date(df.loc[df[date_col] == this_date], table, this_date, this_part, int(expected[this_date]),
+                                  info, db=db, date_col=date_col, alias=alias, engine=engine, verbose=verbose, retry=retry)
+    finally:
+        invalidate_schema_cache(table, db=db, alias=alias)
+        invalidate_result_cache([table])
+    return {x: int(expected[x]) for x in dates}
+
+
+# Partitioning of a table (None if it is not partitioned): scheme, function, partition column,
+# clustered index columns and whether it has other indexes
+def table_partition_info(table, db=None, alias='zim_ops'):
+    if is_local_alias(alias):
+        return None
+    prefix = '' if db is None or db == '' else db + '.'
+    full_name = table if db is None or db == '' else db + '..' + table
+    tmp = exec_sql("select ps.name as scheme, pf.name as func, c.name as col from " + prefix + "sys.indexes i " +
+                   "join " + prefix + "sys.partition_schemes ps on ps.data_space_id = i.data_space_id " +
+                   "join " + prefix + "sys.partition_functions pf on pf.function_id = ps.function_id " +
+                   "join " + prefix + "sys.index_columns ic on ic.object_id = i.object_id and ic.index_id = i.index_id " +
+                   "and ic.partition_ordinal = 1 " +
+                   "join " + prefix + "sys.columns c on c.object_id = ic.object_id and c.column_id = ic.column_id " +
+                   "where i.object_id = object_id(?) and i.index_id in (0, 1)", alias=alias, params=[full_name])
+    if len(tmp) == 0:
+        return None
+    indexes = exec_sql("select i.index_id, i.name, i.is_primary_key, c.name as col, ic.is_descending_key from " + prefix +
+                       "sys.indexes i left join " + prefix + "sys.index_columns ic on ic.object_id = i.object_id and " +
+                       "ic.index_id = i.index_id and ic.key_ordinal > 0 left join " + prefix + "sys.columns c on " +
+                       "c.object_id = ic.object_id and c.column_id = ic.column_id where i.object_id = object_id(?) " +
+                       "order by i.index_id, ic.key_ordinal", alias=alias, params=[full_name])
+    clustered = indexes.loc[indexes['index_id'] == 1]
+    return {'scheme': tmp['scheme'].iloc[0],
+            'function': tmp['func'].iloc[0],
+            'column': tmp['col'].iloc[0],
+            'clustered': [(x, bool(y)) for x, y in zip(clustered['col'], clustered['is_descending_key'])],
+            'primary_key': bool(clustered['is_primary_key'].any()) if len(clustered) > 0 else False,
+            'other_indexes': bool((indexes['index_id'] > 1).any())}
+
+
+def partition_number(info, this_date, db=None, alias='zim_ops'):
+    proc = 'sp_executesql' if db is None or db == '' else db + '.sys.sp_executesql'
+    return int(exec_sql("exec " + proc + " N'select $PARTITION.[" + info['function'] + "](@d) as n', N'@d date', @d = ?",
+                        alias=alias, params=[this_date]).iloc[0, 0])
+
+
+# Empty copy of a partitioned table on the same partition scheme and clustered index
+def create_partition_shadow(table, shadow, info, db=None, alias='zim_ops', conn=None):
+    full_name = table if db is None or db == '' else db + '..' + table
+    shadow_name = shadow if db is None or db == '' else db + '..' + shadow
+    exec_sql("select top 0 * into " + shadow_name + " from " + full_name, isselect=0, alias=alias, conn=conn)
+    on = " ON [" + info['scheme'] + "]([" + info['column'] + "])"
+    if len(info['clustered']) > 0:
+        cols = ", ".join(["[" + x + "]" + (" DESC" if y else " ASC") for x, y in info['clustered']])
+        if info['primary_key']:
+            exec_sql("ALTER TABLE " + shadow_name + " ADD CONSTRAINT [PK_" + shadow + "] PRIMARY KEY CLUSTERED (" + cols + ")" + on,
+                     isselect=0, alias=alias, conn=conn)
+        else:
+            exec_sql("CREATE CLUSTERED INDEX [_index_" + shadow + "] ON " + shadow_name + " (" + cols + ")" + on, isselect=0,
+                     alias=alias, conn=conn)
+    else:
+        # a partitioned heap - build on the scheme then drop the index, the heap stays partitioned
+        exec_sql("CREATE CLUSTERED INDEX [_index_" + shadow + "] ON " + shadow_name + " ([" + info['column'] + "])" + on +
+                 "; DROP INDEX [_index_" + shadow + "] ON " + shadow_name, isselect=0, alias=alias, conn=conn)
+
+
+# Load one date to a shadow table and switch it in - rerun from new shadow tables after a deadlock or
+# dropped link (retry_transaction), switching the same rows in again is harmless
+def switch_partition_date(df, table, this_date, part, expected, info, db=None, date_col='date', alias='zim_ops', engine=None,
+                          verbose=False, retry=None):
+    prefix = '' if db is None or db == '' else db + '..'
 
-def bulk_insert(fileloc, table, fterm=',', rterm='\\n', keepnulls=True, returnsql=False, encoding=None):
+    def attempt(conn):
+        randname = str(round(random.random()*1e8))
+        new_table = table + '_swap_new_' + randname
+        old_table = table + '_swap_old_' + randname
+        try:
+            create_partition_shadow(table, new_table, info, db=db, alias=alias, conn=conn)
+            create_partition_shadow(table, old_table, info, db=db, alias=alias, conn=conn)
+            invalidate_schema_cache(new_table, db=db, alias=alias)
+            load_to_table(df.copy(), new_table, db=db, alias=alias, engine=engine, verbose=verbose)
+            got = exec_sql("select count(*) from " + prefix + new_table + " where [" + date_col + "] = ?", alias=alias, conn=conn,
+                           params=[this_date]).iloc[0, 0]
+            if got != expected:
+                raise Exception('swap_load_dates ' + table + ' ' + str(this_date) + ' expected ' + str(expected) + ' got ' + str(got))
+            exec_sql("ALTER TABLE " + prefix + table + " SWITCH PARTITION " + str(part) + " TO " + prefix + old_table +
+                     " PARTITION " + str(part) + "; ALTER TABLE " + prefix + new_table + " SWITCH PARTITION " + str(part) + " TO " +
+                     prefix + table + " PARTITION " + str(part) + ";", isselect=0, alias=alias, conn=conn)
+            if verbose:
+                print('Switched in ' + str(got) + ' rows for ' + str(this_date) + ' to ' + table, flush=True)
+        finally:
+            for this_table in [new_table, old_table]:
+                try:
+                    exec_sql("DROP TABLE " + prefix + this_table, isselect=0, alias=alias, conn=conn)
+                except Exception:
+                    pass
+                invalidate_schema_cache(this_table, db=db, alias=alias)
+    retry_transaction(attempt, alias=alias, retry=retry)
+
+
+def bulk_insert(fileloc, table, fterm=',', rterm='\\n', keepnulls=True, returnsql=False, encoding=None, tablock=False):
     # Simple function to use SQL bulk insert to fill a table
     # Replace Z:/ notation with //
     fileloc = fileloc.replace('Z:', '//zimsqlhk/sd.zentific-im.com$')
@@ -287,6 +2110,8 @@ def bulk_insert(fileloc, table, fterm=',', rterm='\\n', keepnulls=True, returnsq
         sql = sql + ", DATAFILETYPE = 'widechar' "
     if keepnulls:
         sql = sql + ", KEEPNULLS"
+    if tablock:
+        sql = sql + ", TABLOCK"
     sql = sql + ")"
     # Check what the needs to be sent back
     if returnsql:
@@ -298,46 +2123,263 @@ def bulk_insert(fileloc, table, fterm=',', rterm='\\n', keepnulls=True, returnsq
         return result
 
 
-def create_index_on_table(table):
+# columns / include override the default [date], [sedol] index, eg from advise_indexes()
+# returnsql gives the sql without running it
+
+
+def create_index_on_table(table, columns=None, include=None, db=None, name=None, alias='zim_ops', returnsql=False):
     # Create index on the table given
     # If a weekly or monthly table, include the forward returns
-    if table in ['insight_weekly']:
+    if include is not None and len(include) > 0:
+        sqlinclude = "INCLUDE (" + ",".join(["[" + x + "]" for x in include]) + ")"
+    elif table in ['insight_weekly']:
         sqlinclude = "INCLUDE ([fwdret_total_1w],[fwdret_total_1w_1dplus])"
     elif table in ['insight_monthly']:
         sqlinclude = "INCLUDE ([fwdret_total_1m],[fwdret_total_1m_1dplus])"
     else:
         sqlinclude = ''
-    # Create the main stats and index
-    sql = "CREATE STATISTICS [_stats_" + table + "_date] ON [dbo].[" + table + "]([date]) " + \
-          "CREATE NONCLUSTERED INDEX [_index_" + table + "_nonclustered] ON [dbo].[" + table + "] " + \
-        "([date] ASC, [sedol] ASC) " + \
-        sqlinclude + " " + \
-        "WITH (SORT_IN_TEMPDB = OFF, DROP_EXISTING = OFF, ONLINE = OFF) ON [PRIMARY] "
+    default_cols = columns is None
+    if columns is None:
+        columns = ['date', 'sedol']
+        name = '_index_' + table + '_nonclustered' if name is None else name
+    elif name is None:
+        name = '_index_' + table + '_' + '_'.join(columns)
+    full_name = ('' if db is None or db == '' else '[' + db + '].') + "[dbo].[" + table + "]"
+    if is_local_alias(alias):
+        sql = "CREATE INDEX [" + name + "] ON " + table + " (" + ", ".join(["[" + x + "]" for x in columns]) + ")"
+    else:
+        # Create the main stats and index - the index has its own statistics on its leading column, so
+        # [_stats_<table>_date] is only made for the default index (an advised date-led index would clash with it)
+        sql = ("CREATE STATISTICS [_stats_" + table + "_date] ON " + full_name + "([date]) " if default_cols else "") + \
+              "CREATE NONCLUSTERED INDEX [" + name + "] ON " + full_name + " " + \
+            "(" + ", ".join(["[" + x + "] ASC" for x in columns]) + ") " + \
+            sqlinclude + " " + \
+            "WITH (SORT_IN_TEMPDB = OFF, DROP_EXISTING = OFF, ONLINE = OFF) ON [PRIMARY] "
+    if returnsql:
+        return sql
     # Submit for creation
     print('Starting create index on ' + table + '...', flush=True)
-    result = exec_sql(sql, isselect=0)
+    result = exec_sql(sql, isselect=0, alias=alias)
     return result
 
 
-def create_clustered_index_on_table(table):
+def create_clustered_index_on_table(table, columns=None, db=None, name=None, alias='zim_ops', returnsql=False):
     # Create index on the table given
     # If a weekly or monthly table, include the forward returns
-    if table in ['universe_alpha']:
+    if table in ['universe_alpha'] and columns is None:
         sqlextracols = ", [univ_tradeable] DESC"
     else:
         sqlextracols = ''
-    # Create the main stats and index
-    sql = "CREATE STATISTICS [_stats_" + table + "_date] ON [dbo].[" + table + "]([date]) " + \
-          "CREATE CLUSTERED INDEX [_index_" + table + "_clustered] ON [dbo].[" + table + "] " + \
-        "([date] ASC, [sedol] ASC " + \
-        sqlextracols + ") " + \
-        "WITH (SORT_IN_TEMPDB = OFF, DROP_EXISTING = OFF, ONLINE = OFF) ON [PRIMARY] "
+    default_cols = columns is None
+    if columns is None:
+        columns = ['date', 'sedol']
+    name = '_index_' + table + '_clustered' if name is None else name
+    full_name = ('' if db is None or db == '' else '[' + db + '].') + "[dbo].[" + table + "]"
+    if is_local_alias(alias):
+        sql = "CREATE INDEX [" + name + "] ON " + table + " (" + ", ".join(["[" + x + "]" for x in columns]) + ")"
+    else:
+        # Create the main stats and index - the index has its own statistics on its leading column, so
+        # [_stats_<table>_date] is only made for the default index (an advised date-led index would clash with it)
+        sql = ("CREATE STATISTICS [_stats_" + table + "_date] ON " + full_name + "([date]) " if default_cols else "") + \
+              "CREATE CLUSTERED INDEX [" + name + "] ON " + full_name + " " + \
+            "(" + ", ".join(["[" + x + "] ASC" for x in columns]) + \
+            sqlextracols + ") " + \
+            "WITH (SORT_IN_TEMPDB = OFF, DROP_EXISTING = OFF, ONLINE = OFF) ON [PRIMARY] "
+    if returnsql:
+        return sql
     # Submit for creation
     print('Starting create clustered index on ' + table + '...', flush=True)
-    result = exec_sql(sql, isselect=0)
+    result = exec_sql(sql, isselect=0, alias=alias)
+    return result
+
+
+# Index advisor - reads the sql from a query trace (start_sql_trace) or from the string literals
+# in python modules, works out the filter and select columns used per table and proposes one
+# covering index per table: equality filter columns (most used first), then the most used range
+# filter column, with the other selected columns as INCLUDE
+# Usage:
+# start_sql_trace('c:/temp/trace.jsonl'); ... run the job ...; stop_sql_trace()
+# advice = advise_indexes('c:/temp/trace.jsonl')                  # or advise_indexes(modules=['broker_holdings.py'])
+# apply_index_advice(advice)                                     # dry run - prints the sql
+# apply_index_advice(advice, apply=True)
+# print(compare_sql_trace(before_records, replay_sql_trace('c:/temp/trace.jsonl')))
+__sql_keywords__ = set(['select', 'from', 'where', 'and', 'or', 'not', 'in', 'is', 'null', 'between', 'like', 'as', 'on', 'join',
+                        'inner', 'left', 'right', 'full', 'outer', 'cross', 'group', 'order', 'by', 'having', 'union', 'all',
+                        'distinct', 'top', 'case', 'when', 'then', 'else', 'end', 'exists', 'with', 'nolock', 'asc', 'desc',
+                        'into', 'update', 'set', 'delete', 'insert', 'values', 'cast', 'convert', 'coalesce', 'isnull',
+                        'max', 'min', 'sum', 'count', 'avg', 'getdate', 'replace'])
+
+
+# Columns used per table in a statement - {table: {'db', 'eq', 'range', 'select'}}
+def sql_predicate_columns(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    sql = re.sub(r"--[^\n]*", " ", sql)
+    refs = re.findall(r"(?i)\b(?:from|join|update|into)\s+((?:\[?[\w#]+\]?\.{1,2})*\[?[\w#]+\]?)(?:\s+(?:as\s+)?(\w+))?", sql)
+    aliases = {}
+    tables = {}
+    for name, this_alias in refs:
+        this_db, this_table = split_table_name(name)
+        this_table = this_table.lower()
+        if this_table.startswith('#') or this_table in __sql_keywords__ or 'information_schema' in name.lower() or \
+                this_db.lower() == 'sys':
+            continue
+        tables.setdefault(this_table, {'db': this_db, 'eq': [], 'range': [], 'select': []})
+        aliases[this_table] = this_table
+        if this_alias != '' and this_alias.lower() not in __sql_keywords__:
+            aliases[this_alias.lower()] = this_table
+    if len(tables) == 0:
+        return {}
+    only = list(tables.keys())[0] if len(tables) == 1 else None
+
+    def owner(prefix):
+        if prefix == '':
+            return only
+        return aliases.get(prefix.lower())
+    for prefix, col, op in re.findall(r"(?i)(?:\b(\w+)\.)?\[?(\w+)\]?\s*(<>|!=|<=|>=|=|<|>|\bnot\s+in\b|\bin\b|\bbetween\b|"
+                                      r"\blike\b|\bis\b)", sql):
+        this_table = owner(prefix)
+        if this_table is None or col.lower() in __sql_keywords__ or col.isdigit():
+            continue
+        kind = 'eq' if op.lower() in ['=', 'in', 'is'] else 'range'
+        tables[this_table][kind].append(col)
+    # select list of the outer query
+    select = re.match(r"(?is)^\s*select\s+(?:distinct\s+)?(?:top\s*\(?\s*\d+\s*\)?\s+)?(.*?)\bfrom\b", sql)
+    if select is not None:
+        for prefix, col, paren in re.findall(r"(?:\b(\w+)\.)?\[?\b([A-Za-z_]\w*)\]?(\s*\()?", select.group(1)):
+            this_table = owner(prefix)
+            if this_table is None or paren != '' or col.lower() in __sql_keywords__:
+                continue
+            tables[this_table]['select'].append(col)
+        if re.search(r"(?:^|,)\s*(?:\w+\.)?\*", select.group(1)) is not None:
+            for this_table in tables:
+                tables[this_table]['select'].append('*')
+    return tables
+
+
+# The sql string literals in a python module (concatenated pieces are joined with ? for the variable parts)
+def module_sql(path):
+    import ast
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        tree = ast.parse(f.read())
+
+    def flatten(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return node.value
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            left = flatten(node.left)
+            right = flatten(node.right)
+            if left is None and right is None:
+                return None
+            return (left if left is not None else '?') + (right if right is not None else '?')
+        return None
+    result = []
+    seen = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.BinOp, ast.Constant)):
+            this_sql = flatten(node)
+            if this_sql is not None and re.search(r"(?is)\bselect\b.*\bfrom\b|\bdelete\s+from\b|\bupdate\b.*\bset\b", this_sql) \
+                    and id(node) not in seen:
+                result.append(this_sql)
+                for child in ast.walk(node):
+                    seen.add(id(child))
+    return [x for x in result if not any([x != y and x in y for y in result])]
+
+
+def advise_indexes(trace=None, modules=None, alias='zim_ops', check=True, max_include=8):
+    # trace - trace records or a jsonl trace file, modules - list of python files
+    queries = []
+    if trace is not None:
+        records = read_sql_trace(trace) if type(trace) == str else trace
+        for x in records:
+            if x['kind'] in ['select', 'iter', 'exec', 'batch', 'cached']:
+                queries.append((x['sql'], float(x.get('seconds') or 0), x.get('alias') or alias))
+    for path in (modules or []):
+        queries = queries + [(x, 0.0, alias) for x in module_sql(path)]
+    usage = {}
+    for this_sql, seconds, this_alias in queries:
+        for this_table, cols in sql_predicate_columns(this_sql).items():
+            if len(cols['eq']) + len(cols['range']) == 0:
+                continue
+            rec = usage.setdefault(this_table, {'db': cols['db'], 'alias': this_alias, 'queries': 0, 'seconds': 0.0,
+                                                'eq': {}, 'range': {}, 'select': {}})
+            rec['queries'] = rec['queries'] + 1
+            rec['seconds'] = rec['seconds'] + seconds
+            rec['db'] = rec['db'] or cols['db']
+            for kind in ['eq', 'range', 'select']:
+                for this_col in set(cols[kind]):
+                    rec[kind][this_col] = rec[kind].get(this_col, 0) + 1
+    result = []
+    for this_table, rec in usage.items():
+        known = None
+        if check:
+            known = sql_table_cols(this_table, db=rec['db'], alias=rec['alias'])
+            if len(known) == 0:
+                continue
+            lookup = {x.lower(): x for x in known}
+            for kind in ['eq', 'range', 'select']:
+                rec[kind] = {lookup[x.lower()]: y for x, y in rec[kind].items() if x.lower() in lookup}
+        eq = [x for x, y in sorted(rec['eq'].items(), key=lambda z: -z[1])]
+        rng = [x for x, y in sorted(rec['range'].items(), key=lambda z: -z[1]) if x not in eq]
+        columns = eq + rng[:1]
+        if len(columns) == 0:
+            continue
+        include = []
+        if '*' not in rec['select']:
+            include = [x for x, y in sorted(rec['select'].items(), key=lambda z: -z[1]) if x not in columns]
+            if len(include) > max_include:
+                include = []
+        result.append({'table': this_table,
+                       'db': rec['db'],
+                       'alias': rec['alias'],
+                       'columns': columns,
+                       'include': include,
+                       'queries': rec['queries'],
+                       'seconds': rec['seconds'],
+                       'sql': create_index_on_table(this_table, columns=columns, include=include, db=rec['db'],
+                                                    alias=rec['alias'], returnsql=True)})
+    result = pd.DataFrame(result, columns=['table', 'db', 'alias', 'columns', 'include', 'queries', 'seconds', 'sql'])
+    return sort_dataframe(result, columns=['seconds', 'queries'], ascending=False).reset_index(drop=True)
+
+
+# Dry run by default - prints the index sql, apply=True creates the indexes
+def apply_index_advice(advice, apply=False):
+    result = []
+    for this_advice in advice.itertuples(index=False):
+        if not apply:
+            print(this_advice.sql, flush=True)
+            result.append(None)
+        else:
+            result.append(create_index_on_table(this_advice.table, columns=list(this_advice.columns),
+                                                include=list(this_advice.include), db=this_advice.db, alias=this_advice.alias))
     return result
 
 
+# Run the selects of a trace again (traced) - returns the new trace records
+def replay_sql_trace(trace, alias=None, repeat=1):
+    global __sql_trace__
+    records = read_sql_trace(trace) if type(trace) == str else trace
+    previous = __sql_trace__
+    start_sql_trace()
+    try:
+        for i in range(repeat):
+            for x in records:
+                if x['kind'] in ['select', 'cached']:
+                    exec_sql(x['sql'], alias=alias or x.get('alias') or 'zim_ops', params=x.get('params'), cache=False)
+    finally:
+        result = stop_sql_trace()
+        __sql_trace__ = previous
+    return result
+
+
+# Time per fingerprint before and after (eg an index change)
+def compare_sql_trace(before, after):
+    before = sql_trace_report(before)[['fingerprint', 'calls', 'mean_seconds']]
+    after = sql_trace_report(after)[['fingerprint', 'calls', 'mean_seconds']]
+    result = pd.merge(before, after, on='fingerprint', how='outer', suffixes=('_before', '_after'))
+    result['speedup'] = result['mean_seconds_before'] / result['mean_seconds_after']
+    return sort_dataframe(result, columns=['mean_seconds_before'], ascending=False).reset_index(drop=True)
+
+
 def drop_index_on_table(table):
     # Drop index and stats on the table given
     sql = "DROP STATISTICS [" + table + "].[_stats_" + table + "_date] " + \
@@ -429,13 +2471,13 @@ return 0 means it fill up all the column on toTable.
 
 def inserttable2table(fromtable, totable):
 
-    toheadersql = "select column_name from information_schema.columns where table_name = '" + totable + "' "
-    toheaders = exec_sql(toheadersql).values.flatten().tolist()
+    toheadersql = "select column_name from information_schema.columns where table_name = ? "
+    toheaders = exec_sql(toheadersql, params=[totable]).values.flatten().tolist()
 
     print("to Table cols: " + str(toheaders))
 
-    fromheadersql = "select column_name from information_schema.columns where table_name = '" + fromtable + "' "
-    fromheaders = exec_sql(fromheadersql).values.flatten().tolist()
+    fromheadersql = "select column_name from information_schema.columns where table_name = ? "
+    fromheaders = exec_sql(fromheadersql, params=[fromtable]).values.flatten().tolist()
 
     print("from Table cols: " + str(fromtable))
 
@@ -479,8 +2521,7 @@ def inserttable2table(fromtable, totable):
 
 def archive_table_cleanup(table, num_to_archive=5, db='zimdb_ops'):
     # Get the list of tables too old and drop
-    tmp = exec_sql("select table_name from " + db +
-                   ".information_schema.tables where substring(table_name,1,len('xxx_' + '"+table+"_')) = 'xxx_' + '"+table+"_'")
+    tmp = pd.DataFrame({'table_name': sql_table_list(db, prefix='xxx_' + table + '_')})
     tmp['pos'] = [x.replace('xxx_'+table+'_', '') for x in tmp.table_name]
     tmp = tmp.loc[[x.isdigit() for x in tmp.pos]]
     tmp['pos'] = [int(x) for x in tmp.pos]
@@ -495,7 +2536,22 @@ def archive_table_cleanup(table, num_to_archive=5, db='zimdb_ops'):
 # Function to archive a daily table
 
 
-def archive_table(table, num_to_archive=5, db='zimdb_ops', archivedate=None, datefield='date'):
+# With keys the changed rows are appended to one xxx_<table>_archive table instead of a full copy
+# (see archive_table_incremental) and all but the last num_to_archive snapshots are compacted
+
+
+def archive_table(table, num_to_archive=5, db='zimdb_ops', archivedate=None, datefield='date', keys=None):
+    if keys is not None:
+        if archivedate is None:
+            archivedate = exec_sql(
+                "select max("+datefield+") from " + db + ".." + table).values.flatten()[0]
+        if archivedate is None:
+            return None
+        result = archive_table_incremental(table, keys, db=db, snapshot_date=archivedate)
+        dates = archive_table_dates(table, db=db)
+        if len(dates) > num_to_archive:
+            archive_table_compact(table, keys, dates[-num_to_archive], db=db)
+        return result
     # Get the date in the table for archiving
     archive_table_cleanup(table, num_to_archive, db=db)
     if archivedate is None:
@@ -506,13 +2562,127 @@ def archive_table(table, num_to_archive=5, db='zimdb_ops', archivedate=None, dat
         archivetable = 'xxx_' + table + '_' + \
             str(datetime.datetime.strftime(archivedate, '%Y%m%d'))
         time.sleep(1)
-        tmp = list(exec_sql("select table_name from " + db +
-                   ".information_schema.tables where substring(table_name,1,len('xxx_' + '"+table+"_')) = 'xxx_' + '"+table+"_'")['table_name'])
+        tmp = sql_table_list(db, prefix='xxx_' + table + '_')
         if archivetable in tmp:
             drop_table_if_exists("["+db+"]..["+archivetable+"]")
         # Select into the archive
         result = exec_sql('select * into ' + db + ".." +
                           archivetable + ' from ' + db + ".." + table, isselect=0)
+        invalidate_schema_cache(archivetable, db=db)
+    return result
+
+
+# Incremental archive - one xxx_<table>_archive table holding the table columns plus
+# snapshot_date, row_checksum (BINARY_CHECKSUM of the columns) and is_deleted. Each run adds
+# only the rows whose checksum changed since the last snapshot of their key, new keys, and an
+# is_deleted copy of the last row for keys that have gone, so the cost follows the daily changes
+# archive_table_snapshot() rebuilds the table as at any snapshot date and archive_table_compact()
+# drops the history before a date with one range delete, keeping the state as at that date
+# Usage:
+# archive_table_incremental('cna_cash_tickets', keys=['ticket_ref'], snapshot_date=datetime.date.today())
+# old = archive_table_snapshot('cna_cash_tickets', datetime.date(2024, 1, 31), keys=['ticket_ref'])
+def archive_table_name(table):
+    return 'xxx_' + table + '_archive'
+
+
+def archive_latest_sql(archive, keys, outer, date_test):
+    # rows that are the latest snapshot of their key as at a date
+    return outer + ".snapshot_date = (select max(b.snapshot_date) from " + archive + " b where " + \
+        " and ".join(["b.[" + x + "] = " + outer + ".[" + x + "]" for x in keys]) + " and b.snapshot_date " + date_test + " ?)"
+
+
+def archive_table_incremental(table, keys, db='zimdb_ops', snapshot_date=None, alias='zim_ops'):
+    if snapshot_date is None:
+        snapshot_date = datetime.date.today()
+    local = is_local_alias(alias)
+    prefix = '' if db is None or db == '' else db + '..'
+    archive = archive_table_name(table)
+    cols = sql_table_cols(table, db=db, alias=alias)
+    col_list = ", ".join(["[" + x + "]" for x in cols])
+    if not sql_table_exists(archive, db=db, alias=alias):
+        if local:
+            info = exec_sql("select name, type, [notnull] from pragma_table_info(?)", alias=alias, params=[table])
+            exec_sql("create table " + archive + " ([snapshot_date] date NOT NULL, [row_checksum] int NOT NULL, "
+                     "[is_deleted] bit NOT NULL, " + ", ".join(["[" + x + "] " + y + (" NOT NULL" if z else "")
+                                                                 for x, y, z in zip(info['name'], info['type'], info['notnull'])]) +
+                     ")", isselect=0, alias=alias)
+        else:
+            exec_sql("select top 0 cast(null as date) as snapshot_date, cast(0 as int) as row_checksum, cast(0 as bit) as "
+                     "is_deleted, " + col_list + " into " + prefix + archive + " from " + prefix + table, isselect=0, alias=alias)
+        exec_sql("create " + ("" if local else "clustered ") + "index [_index_" + archive + "] on " + prefix + archive + " (" +
+                 ", ".join(["[" + x + "]" for x in keys]) + ", [snapshot_date])", isselect=0, alias=alias)
+        invalidate_schema_cache(archive, db=db, alias=alias)
+    last = exec_sql("select max(snapshot_date) from " + prefix + archive, alias=alias).iloc[0, 0]
+    if last is not None and not pd.isnull(last) and pd.Timestamp(last) > pd.Timestamp(snapshot_date):
+        raise ValueError(archive + ' already has snapshot ' + str(last) + ' after ' + str(snapshot_date))
+    checksum = "binary_checksum(" + col_list + ")"
+    counts = {}
+    with db_connection(alias) as conn:
+        with conn.cursor() as curs:
+            # a rerun for the same date replaces that snapshot
+            curs.execute("delete from " + prefix + archive + " where snapshot_date = ?", [snapshot_date])
+            counts['replaced'] = max(curs.rowcount, 0)
+            # keys that have gone since their last snapshot
+            curs.execute("insert into " + prefix + archive + " (snapshot_date, row_checksum, is_deleted, " + col_list + ") " +
+                         "select ?, a.row_checksum, 1, " + ", ".join(["a.[" + x + "]" for x in cols]) + " from " + prefix + archive +
+                         " a where " + archive_latest_sql(prefix + archive, keys, 'a', '<') + " and a.is_deleted = 0 and " +
+                         "not exists (select 1 from " + prefix + table + " t where " +
+                         " and ".join(["t.[" + x + "] = a.[" + x + "]" for x in keys]) + ")", [snapshot_date, snapshot_date])
+            counts['deleted'] = max(curs.rowcount, 0)
+            # new keys and changed rows
+            curs.execute("insert into " + prefix + archive + " (snapshot_date, row_checksum, is_deleted, " + col_list + ") " +
+                         "select ?, s.chk, 0, " + ", ".join(["s.[" + x + "]" for x in cols]) + " from (select " + col_list + ", " +
+                         checksum + " as chk from " + prefix + table + ") s where not exists (select 1 from " + prefix + archive +
+                         " a where " + " and ".join(["a.[" + x + "] = s.[" + x + "]" for x in keys]) + " and " +
+                         archive_latest_sql(prefix + archive, keys, 'a', '<') + " and a.is_deleted = 0 and a.row_checksum = s.chk)",
+                         [snapshot_date, snapshot_date])
+            counts['changed'] = max(curs.rowcount, 0)
+            conn.commit()
+    invalidate_result_cache([archive])
+    return counts
+
+
+# Snapshot dates held in the archive, oldest first
+def archive_table_dates(table, db='zimdb_ops', alias='zim_ops'):
+    prefix = '' if db is None or db == '' else db + '..'
+    tmp = exec_sql("select distinct snapshot_date from " + prefix + archive_table_name(table) + " order by snapshot_date",
+                   alias=alias)
+    return list(tmp['snapshot_date'])
+
+
+# The table as it was at snapshot_date (the latest snapshot on or before it)
+def archive_table_snapshot(table, snapshot_date, keys, db='zimdb_ops', alias='zim_ops'):
+    prefix = '' if db is None or db == '' else db + '..'
+    archive = archive_table_name(table)
+    cols = [x for x in sql_table_cols(archive, db=db, alias=alias) if x not in ['snapshot_date', 'row_checksum', 'is_deleted']]
+    return exec_sql("select " + ", ".join(["a.[" + x + "]" for x in cols]) + " from " + prefix + archive + " a where " +
+                    archive_latest_sql(prefix + archive, keys, 'a', '<=') + " and a.is_deleted = 0", alias=alias,
+                    params=[snapshot_date])
+
+
+# Drop the history before before_date - each key keeps its state as at before_date
+def archive_table_compact(table, keys, before_date, db='zimdb_ops', alias='zim_ops'):
+    prefix = '' if db is None or db == '' else db + '..'
+    archive = archive_table_name(table)
+    if is_local_alias(alias):
+        head = "delete from " + archive + " where "
+        outer = archive
+    else:
+        head = "delete a from " + prefix + archive + " a where "
+        outer = 'a'
+    result = 0
+    with db_connection(alias) as conn:
+        with conn.cursor() as curs:
+            # rows replaced by a later snapshot that is still on or before before_date
+            curs.execute(head + outer + ".snapshot_date < ? and " + outer + ".snapshot_date < (select max(b.snapshot_date) from " +
+                         prefix + archive + " b where " + " and ".join(["b.[" + x + "] = " + outer + ".[" + x + "]" for x in keys]) +
+                         " and b.snapshot_date <= ?)", [before_date, before_date])
+            result = result + max(curs.rowcount, 0)
+            # keys deleted by then
+            curs.execute(head + outer + ".snapshot_date < ? and " + outer + ".is_deleted = 1", [before_date])
+            result = result + max(curs.rowcount, 0)
+            conn.commit()
+    invalidate_result_cache([archive])
     return result
 
 
@@ -547,20 +2717,181 @@ class timer(object):
 
 # code to map the various tickers into one common 6 digit sedol
 
-def get_hist_ticker_map(start_date):
-    ticker_map = exec_sql("select sedol, bb_code, AxiomaTicker, [local], factset_ticker, isin, AxiomaID, name, country_exchange, AxiomaCountry, gics_code, bb_code_short, sedol_short, bb_code_long, sedol_long, bb_code_long_alt, bb_code_short_alt, sedol_long_alt, sedol_short_alt, sedol_hist_0, sedol_hist_1, sedol_hist_2, sedol_hist_3, currency, multiplier_long, multiplier_short, fs_id_r  from zimdb_ops..ticker_map")
+# True where the value is a str (NaN / None / numbers are not ids)
+__py_type__ = np.frompyfunc(type, 1, 1)
+
+
+def is_str_mask(values):
+    values = values.to_numpy(dtype=object) if hasattr(values, 'to_numpy') else np.asarray(values, dtype=object)
+    return np.asarray(__py_type__(values) == str, dtype=bool)
+
+
+# Ticker map snapshot - off by default, enable_ticker_snapshot() turns it on. Off, each call queries
+# ticker_map and only the ticker_changes rows after its date, as before. On, ticker_map and all of
+# ticker_changes are kept in memory, and in files in path if one is given, under a version of the two
+# tables: the max ticker_changes date and the row counts (YYYYMMDD_<change rows>_<map rows>). An edit
+# to ticker_map is picked up when it logs a ticker_changes row or changes the row count. Each call then
+# only checks the version, reads the files when the version is new to the process and queries the
+# tables when they have changed. Writing a version removes the files of the versions before it
+# The files are feather (memory mapped) when pyarrow is installed, otherwise pickles
+# Usage:
+# enable_ticker_snapshot(path=os.path.join(os.path.expanduser("~"), 'ops_cache', 'ticker_map'))
+__ticker_map_cols__ = ['sedol', 'bb_code', 'AxiomaTicker', 'local', 'factset_ticker', 'isin', 'AxiomaID', 'name', 'country_exchange',
+                       'AxiomaCountry', 'gics_code', 'bb_code_short', 'sedol_short', 'bb_code_long', 'sedol_long', 'bb_code_long_alt',
+                       'bb_code_short_alt', 'sedol_long_alt', 'sedol_short_alt', 'sedol_hist_0', 'sedol_hist_1', 'sedol_hist_2',
+                       'sedol_hist_3', 'currency', 'multiplier_long', 'multiplier_short', 'fs_id_r']
+__ticker_snapshot__ = {'on': False, 'path': None, 'version': None, 'frames': None, 'maps': {}}
+__ticker_snapshot_lock__ = threading.RLock()
+__ticker_snapshot_max_maps__ = 16
+
+
+def enable_ticker_snapshot(enabled=True, path=None):
+    with __ticker_snapshot_lock__:
+        __ticker_snapshot__['on'] = enabled
+        __ticker_snapshot__['path'] = path if enabled else None
+        __ticker_snapshot__['version'] = None
+        __ticker_snapshot__['frames'] = None
+        __ticker_snapshot__['maps'] = {}
+
+
+def ticker_snapshot_version():
+    tmp = exec_sql("select (select max([date]) from zimdb_ops..ticker_changes) as change_date, "
+                   "(select count(*) from zimdb_ops..ticker_changes) as change_rows, "
+                   "(select count(*) from zimdb_ops..ticker_map) as map_rows")
+    change_date = pd.to_datetime(tmp['change_date'].iloc[0])
+    return ('00000000' if pd.isnull(change_date) else change_date.strftime('%Y%m%d')) + '_' + \
+        str(int(tmp['change_rows'].iloc[0])) + '_' + str(int(tmp['map_rows'].iloc[0]))
+
+
+# ticker_map and the ticker_changes rows after start_date (none when it is None), or all of them
+def ticker_map_query(start_date=None, all_changes=False):
+    ticker_map = exec_sql("select " + ", ".join(["[" + x + "]" for x in __ticker_map_cols__]) + " from zimdb_ops..ticker_map")
+    sql = "select [date], " + ", ".join(["[" + x + "_old] AS [" + x + "]" for x in __ticker_map_cols__]) + " from zimdb_ops..ticker_changes"
+    if all_changes:
+        ticker_changes = exec_sql(sql)
+    elif start_date is not None:
+        ticker_changes = exec_sql(sql + " where [date] > ?", params=[start_date])
+    else:
+        ticker_changes = pd.DataFrame(columns=['date'] + __ticker_map_cols__)
+    return {'ticker_map': ticker_map, 'ticker_changes': ticker_changes}
+
+
+def ticker_snapshot_query():
+    return ticker_map_query(all_changes=True)
+
+
+def write_ticker_snapshot(frames, path, version):
+    os.makedirs(path, exist_ok=True)
+    for name, df in frames.items():
+        fileloc = os.path.join(path, name + '_' + version)
+        tmp_file = fileloc + '.' + str(os.getpid()) + '.tmp'
+        try:
+            import pyarrow.feather as feather
+            feather.write_feather(df.reset_index(drop=True), tmp_file)
+            fileloc = fileloc + '.feather'
+        except Exception:
+            # no pyarrow or columns arrow can't type (mixed values) - pickle instead
+            silentremove(tmp_file)
+            df.to_pickle(tmp_file)
+            fileloc = fileloc + '.pkl'
+        os.replace(tmp_file, fileloc)
+    # drop the versions before this one (an earlier change date, or fewer changes on the same date) - a
+    # newer one may have just been written by another process
+    this_version = [int(x) for x in version.split('_')[:2]]
+    for this_file in os.listdir(path):
+        found = re.match(r"^(?:ticker_map|ticker_changes)_(\d{8})_(\d+)_\d+\.(?:feather|pkl)$", this_file)
+        if found is not None and [int(found.group(1)), int(found.group(2))] < this_version:
+            try:
+                silentremove(os.path.join(path, this_file))
+            except OSError:
+                # still open in another process
+                pass
+
+
+def read_ticker_snapshot(path, version):
+    frames = {}
+    for name in ['ticker_map', 'ticker_changes']:
+        fileloc = os.path.join(path, name + '_' + version)
+        if os.path.isfile(fileloc + '.feather'):
+            import pyarrow.feather as feather
+            frames[name] = feather.read_table(fileloc + '.feather', memory_map=True).to_pandas(date_as_object=True)
+        elif os.path.isfile(fileloc + '.pkl'):
+            frames[name] = pd.read_pickle(fileloc + '.pkl')
+        else:
+            return None
+    return frames
+
+
+# ticker_map and ticker_changes at the current version - from memory, the snapshot files or the db
+def get_ticker_snapshot():
+    with __ticker_snapshot_lock__:
+        version = ticker_snapshot_version()
+        if __ticker_snapshot__['version'] == version:
+            return __ticker_snapshot__['frames'], version
+        path = __ticker_snapshot__['path']
+        frames = None
+        if path is not None:
+            try:
+                frames = read_ticker_snapshot(path, version)
+            except Exception:
+                frames = None
+        if frames is None:
+            frames = ticker_snapshot_query()
+            if path is not None:
+                try:
+                    write_ticker_snapshot(frames, path, version)
+                except Exception as e:
+                    print('Unable to write ticker map snapshot: ' + str(e), flush=True)
+        __ticker_snapshot__['version'] = version
+        __ticker_snapshot__['frames'] = frames
+        __ticker_snapshot__['maps'] = {}
+        return frames, version
+
+
+# Something built from the ticker map (eg the map for a date) kept until the snapshot version changes
+# build(frames) makes it - callers must not change what is returned. With the snapshot off it is built
+# on every call from ticker_map_query(start_date, all_changes), so build must take the changes after
+# start_date itself and use no others unless all_changes is set
+def ticker_snapshot_cached(key, build, start_date=None, all_changes=False):
+    if not __ticker_snapshot__['on']:
+        return build(ticker_map_query(start_date, all_changes))
+    frames, version = get_ticker_snapshot()
+    with __ticker_snapshot_lock__:
+        value = __ticker_snapshot__['maps'].get(key)
+    if value is not None:
+        return value
+    value = build(frames)
+    with __ticker_snapshot_lock__:
+        if __ticker_snapshot__['version'] == version:
+            maps = __ticker_snapshot__['maps']
+            maps[key] = value
+            while len(maps) > __ticker_snapshot_max_maps__:
+                del maps[next(iter(maps))]
+    return value
+
+
+# ticker_map as it was after start_date - the first change after the date for a bb_code / sedol
+# gives its row (start_date None gives ticker_map as it is)
+def hist_ticker_map(frames, start_date):
+    ticker_map = frames['ticker_map'].copy()
     if start_date is not None:
-        ticker_changes = exec_sql(
-"SELECT date, sedol_old AS sedol, bb_code_old AS bb_code, AxiomaTicker_old AS AxiomaTicker, local_old AS local, factset_ticker_old AS factset_ticker, isin_old AS isin, AxiomaID_old AS AxiomaID, name_old AS name, country_exchange_old AS country_exchange,              AxiomaCountry_old AS AxiomaCountry, gics_code_old AS gics_code, bb_code_short_old AS bb_code_short, sedol_short_old AS sedol_short, bb_code_long_old AS bb_code_long, sedol_long_old AS sedol_long, bb_code_short_alt_old AS bb_code_short_alt, bb_code_long_alt_old AS bb_code_long_alt, sedol_short_alt_old AS sedol_short_alt, sedol_long_alt_old AS sedol_long_alt, sedol_hist_0_old AS sedol_hist_0, sedol_hist_1_old AS sedol_hist_1, sedol_hist_2_old AS sedol_hist_2, sedol_hist_3_old AS sedol_hist_3, currency_old AS currency, multiplier_long_old as multiplier_long, multiplier_short_old as multiplier_short, fs_id_r_old as fs_id_r from zimdb_ops..ticker_changes where [date] > '" + str(start_date) + "'")
+        ticker_changes = frames['ticker_changes']
+        ticker_changes = ticker_changes.loc[(pd.to_datetime(ticker_changes['date']) > pd.Timestamp(start_date)).values]
         ticker_changes = sort_dataframe(
             data=ticker_changes, columns=['date'], ascending=True)
-        ticker_changes.drop_duplicates('bb_code', inplace=True)
-        ticker_changes.drop_duplicates('sedol', inplace=True)
-        ticker_map = ticker_changes[ticker_map.columns].append(ticker_map)
+        ticker_changes = ticker_changes.drop_duplicates('bb_code')
+        ticker_changes = ticker_changes.drop_duplicates('sedol')
+        ticker_map = pd.concat([ticker_changes[ticker_map.columns], ticker_map])
     ticker_map.drop_duplicates('bb_code', inplace=True)
     ticker_map.drop_duplicates('sedol', inplace=True)
     return ticker_map
 
+
+def get_hist_ticker_map(start_date):
+    ticker_map = ticker_snapshot_cached(('hist', start_date), lambda frames: hist_ticker_map(frames, start_date), start_date)
+    # the joined map for a date is kept until the version changes - callers get a copy
+    return ticker_map.copy() if __ticker_snapshot__['on'] else ticker_map
+
 # id_info = dataframe with columns [sedol, bb_code, isin, type]
 # returns mapping of 'z_sedol', 'z_bb_code', 'sedol', 'bb_code', 'fs_id_r', 'ric', 'isin'
 
@@ -574,27 +2905,26 @@ def map_tickers(id_info, at_date=None):
         return this_map[x] if x in this_map.keys() else x
     # for future change to fs_id_r
     ticker_map['sedol'] = ticker_map['sedol_hist_0']
-    all_map = pd.DataFrame()
+
+    def has_id(values):
+        return is_str_mask(values) & ~values.isin(['NULL', 'NO_ID']).to_numpy()
+    parts = []
     for i in ['', '_long', '_short', '_long_alt', '_short_alt']:
         tmp = ticker_map[['bb_code'+i, 'sedol'+i,
                           'fs_id_r', 'isin', 'sedol', 'bb_code']].copy()
         tmp.columns = ['bb_code', 'sedol', 'fs_id_r',
                        'isin', 'z_sedol', 'z_bb_code']
         tmp['src'] = i
-        filt = [(type(x) == str and x != 'NULL' and x != 'NO_ID') or (type(
-y) == str and y != 'NULL' and y != 'NO_ID') for x, y in zip(tmp['bb_code'], tmp['sedol'])]
-        all_map = all_map.append(tmp.loc[filt])
+        parts.append(tmp.loc[has_id(tmp['bb_code']) | has_id(tmp['sedol'])])
     # add in the India futures
-    filt = [x == 'IN' and type(y) == str for x, y in zip(
-        ticker_map.country_exchange, ticker_map.bb_code_short)]
+    filt = (ticker_map['country_exchange'] == 'IN').to_numpy() & is_str_mask(ticker_map['bb_code_short'])
     tmp = ticker_map.loc[filt, ['bb_code_short', 'sedol',
                                 'fs_id_r', 'isin', 'sedol', 'bb_code_short']]
     tmp.columns = ['bb_code', 'sedol', 'fs_id_r',
                    'isin', 'z_sedol', 'z_bb_code']
     tmp['src'] = 'india'
-    filt = [(type(x) == str and x != 'NULL' and x != 'NO_ID') or (type(
-        y) == str and y != 'NULL' and y != 'NO_ID') for x, y in zip(tmp['bb_code'], tmp['sedol'])]
-    all_map = all_map.append(tmp.loc[filt])
+    parts.append(tmp.loc[has_id(tmp['bb_code']) | has_id(tmp['sedol'])])
+    all_map = pd.concat(parts)
     all_map['bb_code'] = [x.replace(" Equity", "") if type(
         x) == str else np.nan for x in all_map['bb_code']]
     all_map['z_bb_code'] = [x.replace(" Equity", "") if type(
@@ -624,16 +2954,21 @@ y) == str and y != 'NULL' and y != 'NO_ID') for x, y in zip(tmp['bb_code'], tmp[
     result['z_bb_code'] = [x.split(
         "=")[0]+"= IS" if type(x) == str and "=" in x else x for x in result['bb_code']]
     result['fs_id_r'] = np.nan
+    # fill each id from the others in priority order - a keyed lookup per id type, only for the
+    # rows still missing the id, the first match wins
+    map_is_str = {x: is_str_mask(all_map[x]) for x in ['bb_code', 'sedol', 'isin', 'fs_id_r', 'z_bb_code']}
     for this_col in ['bb_code', 'sedol', 'isin', 'fs_id_r', 'z_bb_code']:
         other_cols = [x for x in ['bb_code', 'sedol',
                                   'isin', 'z_bb_code'] if x != this_col]
         for check_col in other_cols:
-            filt = [type(x) == str and type(y) == str for x,
-                    y in zip(all_map[this_col], all_map[check_col])]
-            lookup = all_map.loc[filt].drop_duplicates(
-                check_col).set_index(check_col)
-            result[this_col] = [x[this_col] if type(x[this_col]) == str or type(
-                x[check_col]) != str else lookup[this_col].reindex([x[check_col]])[0] for i, x in result.iterrows()]
+            values = result[this_col].to_numpy(dtype=object, copy=True)
+            keys = result[check_col].to_numpy(dtype=object)
+            need = ~is_str_mask(values) & is_str_mask(keys)
+            if need.any():
+                lookup = all_map.loc[map_is_str[this_col] & map_is_str[check_col], [check_col, this_col]].drop_duplicates(check_col)
+                lookup = pd.Series(lookup[this_col].to_numpy(dtype=object), index=lookup[check_col].to_numpy(dtype=object))
+                values[need] = pd.Series(keys[need]).map(lookup).to_numpy(dtype=object)
+            result[this_col] = list(values)
 
     result['fs_id_r'] = [x if type(x) == str else y for x, y in zip(
         result['fs_id_r'], result['sedol'])]
@@ -648,9 +2983,7 @@ y) == str and y != 'NULL' and y != 'NO_ID') for x, y in zip(tmp['bb_code'], tmp[
     return result
 
 
-def map_z_sedol(sedol, bb_code, isin, trade_type, at_date=None):
-    ticker_map = get_hist_ticker_map(at_date)
-    bb_country_map = {'JT': 'JP',
+__bb_country_map__ = {'JT': 'JP',
                       'JM': 'JP',
                       'JS': 'JP',
                       'JF': 'JP',
@@ -667,85 +3000,436 @@ def map_z_sedol(sedol, bb_code, isin, trade_type, at_date=None):
                       'KQ': 'KS',
                       'CG': 'CH',  # Adrian 20201120: add CG/CS to map CH for JPM QFII
                       'CS': 'CH'}  # Adrian 20201120: add CG/CS to map CH for JPM QFII
+
+
+# futures bb_codes lose the expiry - "XX=H4 IS" -> "XX= IS". Everything becomes a str (NaN -> 'nan')
+def future_bb_code(values):
+    values = pd.Series(values, dtype=object).map(str)
+    filt = values.str.contains('=', regex=False).values
+    if filt.any():
+        values[filt] = values[filt].str.split('=').str[0] + '= IS'
+    return values
+
+
+# The lookups map_z_sedol uses for a date - built once per date and ticker map version
+def z_sedol_maps(at_date=None):
+    return ticker_snapshot_cached(('z_sedol', at_date), lambda frames: build_z_sedol_maps(frames, at_date), at_date)
+
+
+# The map_z_sedol lookups from ticker_map / ticker_changes frames as they were after at_date
+def build_z_sedol_maps(frames, at_date=None):
+    ticker_map = hist_ticker_map(frames, at_date)
     # for futures convert bb_code to strip the timing of the future part of the ticker
-    ticker_map['bb_code_short'] = [x.split(
-        "=")[0]+"= IS" if "=" in str(x) else str(x) for x in ticker_map['bb_code_short']]
-    ticker_map['bb_code_long'] = [x.split(
-        "=")[0]+"= IS" if "=" in str(x) else str(x) for x in ticker_map['bb_code_long']]
-    ticker_map['bb_code_short_alt'] = [x.split(
-        "=")[0]+"= IS" if "=" in str(x) else str(x) for x in ticker_map['bb_code_short_alt']]
-    ticker_map['bb_code_long_alt'] = [x.split(
-        "=")[0]+"= IS" if "=" in str(x) else str(x) for x in ticker_map['bb_code_long_alt']]
+    for i in ['_short', '_long', '_short_alt', '_long_alt']:
+        ticker_map['bb_code' + i] = future_bb_code(ticker_map['bb_code' + i]).values
     # for future change to fs_id_r
     ticker_map['sedol'] = ticker_map['sedol_hist_0']
-    # create a sedol to bb_code map
-    all_map = pd.DataFrame()
-    for i in ['', '_long', '_short', '_long_alt', '_short_alt']:
-        tmp = ticker_map[['bb_code'+i, 'sedol'+i]]
-        tmp.columns = ['bb_code', 'sedol']
-        all_map = all_map.append(tmp)
-    all_map['bb_code'] = [x.replace(" Equity", "") if type(
-        x) == str else np.nan for x in all_map['bb_code']]
-    all_map = all_map.drop_duplicates('sedol')
-    all_map = all_map.loc[[type(x) == str for x in all_map.sedol]]
-    all_map = all_map.set_index('sedol').sort_index()['bb_code']
-    # create a secondary to primary z_sedols mapping
-    parent_map = pd.DataFrame()
+    # secondary sedols / bb_codes to the primary z_sedol, first listing wins
+    parent_map = []
     for i in ['', '_long', '_short', '_long_alt', '_short_alt']:
         tmp = ticker_map[['bb_code'+i, 'sedol'+i, 'sedol', 'fs_id_r']]
         tmp.columns = ['bb_code', 'sedol', 'z_sedol', 'fs_id_r']
-        parent_map = parent_map.append(tmp)
-    parent_map['bb_code'] = [x.replace(" Equity", "") if type(
-        x) == str else np.nan for x in parent_map['bb_code']]
-    par_bb_map = parent_map.loc[[type(x) == str for x in parent_map['bb_code']]].drop_duplicates(
-        'bb_code').set_index('bb_code').sort_index()[['z_sedol', 'fs_id_r']]
-    par_sedol_map = parent_map.loc[[type(x) == str for x in parent_map['sedol']]].drop_duplicates(
-        'sedol').set_index('sedol').sort_index()[['z_sedol', 'fs_id_r']]
-
-    bb_code = [x.split("=")[0]+"= IS" if "=" in str(x) else str(x)
-               for x in bb_code]
-    for this_key in bb_country_map.keys():
-        this_val = bb_country_map[this_key]
-        bb_code = [x[:-2] + this_val if (x[-2:] == this_key)
-                   and ("=" not in x) else x for x in bb_code]
+        parent_map.append(tmp)
+    parent_map = pd.concat(parent_map, ignore_index=True)
+    parent_map['bb_code'] = parent_map['bb_code'].where(is_str_mask(parent_map['bb_code'])).str.replace(" Equity", "", regex=False)
+    # sedol to bb_code
+    all_map = parent_map.loc[is_str_mask(parent_map['sedol'])].drop_duplicates('sedol')
+    all_map = pd.Series(all_map['bb_code'].values, index=pd.Index(all_map['sedol'].values, dtype=object))
+    par_bb_map = parent_map.loc[is_str_mask(parent_map['bb_code'])].drop_duplicates('bb_code')
+    par_bb_map = pd.Series(par_bb_map['z_sedol'].values, index=pd.Index(par_bb_map['bb_code'].values, dtype=object))
+    par_sedol_map = parent_map.loc[is_str_mask(parent_map['sedol'])].drop_duplicates('sedol')
+    par_sedol_map = pd.Series(par_sedol_map['z_sedol'].values, index=pd.Index(par_sedol_map['sedol'].values, dtype=object))
+    isin_map = ticker_map.loc[is_str_mask(ticker_map['isin']) & (ticker_map['isin'] != 'nan').values,
+                              ['isin', 'sedol', 'bb_code', 'sedol_short', 'sedol_long', 'bb_code_short', 'bb_code_long']].copy()
+    isin_map['isin'] = isin_map['isin'].str.strip()
+    isin_map = isin_map.drop_duplicates('isin').set_index('isin')
+    return {'all_map': all_map, 'par_bb_map': par_bb_map, 'par_sedol_map': par_sedol_map, 'isin_map': isin_map}
+
+
+# values[i] where keys[i] is a str found in lookup, otherwise fallback[i]
+def lookup_or(lookup, keys, fallback, key_is_str=None):
+    if key_is_str is None:
+        key_is_str = is_str_mask(keys)
+    pos = lookup.index.get_indexer(keys)
+    found = (pos >= 0) & key_is_str
+    result = np.array(fallback, dtype=object)
+    result[found] = lookup.values[pos[found]]
+    return result
+
+
+# Resolve each distinct (sedol, bb_code, isin) once - holdings repeat the same ids every day
+def map_z_sedol(sedol, bb_code, isin, trade_type, at_date=None):
+    sedol = list(sedol)
+    bb_code = list(bb_code)
+    isin = None if isin is None else list(isin)
+    codes, uniques = pd.factorize(pd.Series(list(zip(sedol, bb_code, [None] * len(sedol) if isin is None else isin)), dtype=object))
+    first = np.unique(codes, return_index=True)[1]
+    result = resolve_z_sedol(z_sedol_maps(at_date), [sedol[i] for i in first], [bb_code[i] for i in first],
+                             None if isin is None else [isin[i] for i in first])
+    return pd.DataFrame({x: list(y[codes]) for x, y in result.items()})
+
+
+def resolve_z_sedol(maps, sedol, bb_code, isin):
+    all_map = maps['all_map']
+    par_bb_map = maps['par_bb_map']
+    par_sedol_map = maps['par_sedol_map']
+    bb_code = future_bb_code(bb_code)
+    country = bb_code.str[-2:].map(__bb_country_map__)
+    filt = (country.notnull() & ~bb_code.str.contains('=', regex=False)).values
+    bb_code[filt] = bb_code[filt].str[:-2] + country[filt]
     # find the base z_sedol of primary listing
-    z_sedol = pd.DataFrame(columns=['z_sedol'])
-    z_sedol['sedol'] = [x[:6] if (x.startswith("_CASH_") == False) and (
-        x.startswith("_FRWD_") == False) and ('_SWAP_' not in x) else x for x in sedol]
-    z_sedol['sedol'] = [
-        x if type(x) == str and x != 'nan' else np.nan for x in z_sedol['sedol']]
+    sedol = pd.Series(sedol, dtype=object)
+    keep = sedol.str.contains("^_CASH_|^_FRWD_|_SWAP_", na=False)
+    sedol = sedol.where(keep, sedol.str[:6]).to_numpy(dtype=object)
+    has_sedol = is_str_mask(sedol) & (sedol != 'nan')
+    sedol[~has_sedol] = np.nan
     # store the known sedols and bb_code of the traded instrument
-    z_sedol['bb_code'] = [
-        x if type(x) == str and x != 'nan' else np.nan for x in bb_code]
-    z_sedol['z_sedol'] = [par_sedol_map['z_sedol'][x] if type(
-        x) == str and x in par_sedol_map.index else x for x in z_sedol['sedol']]
-    z_sedol['z_sedol'] = [par_bb_map['z_sedol'][x] if type(x) == str and type(
-        y) != str and x in par_bb_map.index else y for x, y in zip(z_sedol['bb_code'], z_sedol['z_sedol'])]
-    z_sedol['z_bb_code'] = [all_map[x] if type(
-        x) == str and x in all_map.index else y for x, y in zip(z_sedol['z_sedol'], z_sedol['bb_code'])]
-    z_sedol['trade_type'] = list(trade_type)
-    z_sedol['z_sedol_long'] = [x if type(x) == str else par_bb_map['z_sedol'][y] if type(
-        y) == str and y in par_bb_map.index else np.nan for x, y in zip(z_sedol['sedol'], z_sedol['bb_code'])]
-    z_sedol['z_sedol_short'] = [x if type(x) == str else par_bb_map['z_sedol'][y] if type(
-        y) == str and y in par_bb_map.index else np.nan for x, y in zip(z_sedol['sedol'], z_sedol['bb_code'])]
-    z_sedol['z_bb_code_short'] = [x if type(x) == str else all_map[y] if type(
-        y) == str and y in all_map.index else np.nan for x, y in zip(z_sedol['bb_code'], z_sedol['z_sedol_short'])]
-    z_sedol['z_bb_code_long'] = [x if type(x) == str else all_map[y] if type(
-        y) == str and y in all_map.index else np.nan for x, y in zip(z_sedol['bb_code'], z_sedol['z_sedol_long'])]
+    bb_code = bb_code.to_numpy(dtype=object)
+    has_bb_code = bb_code != 'nan'
+    bb_code[~has_bb_code] = np.nan
+    nan_list = np.full(len(sedol), np.nan, dtype=object)
+    # primary z_sedol from the sedol, then from the bb_code
+    bb_code_z_sedol = lookup_or(par_bb_map, bb_code, nan_list, has_bb_code)
+    z_sedol = lookup_or(par_sedol_map, sedol, sedol, has_sedol)
+    z_sedol = np.where(is_str_mask(z_sedol), z_sedol, lookup_or(par_bb_map, bb_code, z_sedol, has_bb_code))
+    z_bb_code = lookup_or(all_map, z_sedol, bb_code)
+    z_sedol_long = np.where(has_sedol, sedol, bb_code_z_sedol)
+    z_bb_code_long = np.where(has_bb_code, bb_code, lookup_or(all_map, z_sedol_long, nan_list))
+    result = {'z_sedol': z_sedol, 'z_bb_code': z_bb_code, 'z_bb_code_short': z_bb_code_long.copy(), 'z_bb_code_long': z_bb_code_long,
+              'z_sedol_long': z_sedol_long, 'z_sedol_short': z_sedol_long.copy()}
     # fill in any missing _long and _short with ticker_map
     # check for isin
     if isin is not None:
-        filt = [type(x) == str and x != 'nan' for x in ticker_map['isin']]
-        isin_map = ticker_map.loc[filt, ['isin', 'sedol', 'bb_code',
-                                         'sedol_short', 'sedol_long', 'bb_code_short', 'bb_code_long']]
-        isin_map['isin'] = [x.strip() for x in isin_map['isin']]
-        isin_map = isin_map.drop_duplicates('isin').set_index('isin')
-        z_sedol['isin'] = [
-            x if type(x) == str and x != 'nan' else np.nan for x in isin]
+        isin_map = maps['isin_map']
+        isin = np.array(list(isin), dtype=object)
+        has_isin = is_str_mask(isin) & (isin != 'nan')
+        isin[~has_isin] = np.nan
         for i in ['sedol', 'bb_code', 'sedol_long', 'sedol_short', 'bb_code_long', 'bb_code_short']:
-            z_sedol['z_' + i] = [isin_map[i][y] if type(x) != str and type(
-                y) == str else x for x, y in zip(z_sedol['z_'+i], z_sedol['isin'])]
-    return z_sedol[['z_sedol', 'z_bb_code', 'z_bb_code_short', 'z_bb_code_long', 'z_sedol_long', 'z_sedol_short']]
+            values = result['z_' + i]
+            need = ~is_str_mask(values) & has_isin
+            if need.any():
+                values = values.copy()
+                values[need] = lookup_or(isin_map[i], isin[need], nan_list[need], has_isin[need])
+            result['z_' + i] = values
+    return result
+
+
+# Check map_z_sedol against what the row by row version gave for a small ticker map - secondary
+# listings, futures, country codes, isin fallback and a ticker change. Runs without a db
+# Usage:
+# check_map_z_sedol()
+__z_sedol_check_map__ = {'sedol': ['690064', '640833', 'B01NPJ', 'ABCDEF'],
+                         'sedol_hist_0': ['690064', '640833', 'B01NPJ', 'ABCDEF'],
+                         'bb_code': ['7203 JP Equity', '5 HK Equity', 'RIL IN Equity', None],
+                         'isin': ['JP3633400001', 'GB0005405286', 'INE002A01018', ' US0378331005 '],
+                         'fs_id_r': ['F1-R', 'F2-R', 'F3-R', None],
+                         'bb_code_short': ['7203 JP', None, 'RIL=H4 IS', 'AAPL US'],
+                         'sedol_short': ['690064', None, 'RILFUT', 'AAPLSW'],
+                         'bb_code_long_alt': [None, 'HSBA LN', None, None],
+                         'sedol_long_alt': [None, '054052', None, None]}
+__z_sedol_check_ids__ = {'sedol': ['6900643', 'nan', '054052', 'nan', 'nan', '_CASH_USD', 'ZZZZZZ', 'nan', '690065'],
+                         'bb_code': ['7203 JT', '5 HK', 'HSBA LN', 'RIL=M4 IS', np.nan, np.nan, 'NOPE JT', np.nan, np.nan],
+                         'isin': [np.nan, np.nan, np.nan, np.nan, 'US0378331005', np.nan, 'XX0000000000', np.nan, np.nan]}
+__z_sedol_check_result__ = {
+    None: {'z_sedol': ['690064', '640833', '640833', 'B01NPJ', 'ABCDEF', '_CASH_USD', 'ZZZZZZ', np.nan, '690065'],
+           'z_bb_code': ['7203 JP', '5 HK', '5 HK', 'RIL IN', None, np.nan, 'NOPE JP', np.nan, np.nan],
+           'z_bb_code_short': ['7203 JP', '5 HK', 'HSBA LN', 'RIL= IS', 'AAPL US', np.nan, 'NOPE JP', np.nan, np.nan],
+           'z_bb_code_long': ['7203 JP', '5 HK', 'HSBA LN', 'RIL= IS', 'None', np.nan, 'NOPE JP', np.nan, np.nan],
+           'z_sedol_long': ['690064', '640833', '054052', 'B01NPJ', None, '_CASH_USD', 'ZZZZZZ', np.nan, '690065'],
+           'z_sedol_short': ['690064', '640833', '054052', 'B01NPJ', 'AAPLSW', '_CASH_USD', 'ZZZZZZ', np.nan, '690065']},
+    datetime.date(2024, 1, 1): {
+           'z_sedol': ['690065', '640833', '640833', 'B01NPJ', 'ABCDEF', '_CASH_USD', 'ZZZZZZ', np.nan, '690065'],
+           'z_bb_code': ['7203 JT', '5 HK', '5 HK', 'RIL IN', None, np.nan, 'NOPE JP', np.nan, '7203 JT'],
+           'z_bb_code_short': ['7203 JP', '5 HK', 'HSBA LN', 'RIL= IS', 'AAPL US', np.nan, 'NOPE JP', np.nan, '7203 JT'],
+           'z_bb_code_long': ['7203 JP', '5 HK', 'HSBA LN', 'RIL= IS', 'None', np.nan, 'NOPE JP', np.nan, '7203 JT'],
+           'z_sedol_long': ['690064', '640833', '054052', 'B01NPJ', None, '_CASH_USD', 'ZZZZZZ', np.nan, '690065'],
+           'z_sedol_short': ['690064', '640833', '054052', 'B01NPJ', 'AAPLSW', '_CASH_USD', 'ZZZZZZ', np.nan, '690065']}}
+
+
+def check_map_z_sedol():
+    ticker_map = pd.DataFrame(__z_sedol_check_map__).reindex(columns=__ticker_map_cols__).astype(object)
+    ticker_map = ticker_map.where(ticker_map.notnull(), None)
+    # the first listing had its sedol and bb_code changed on 2024-01-10
+    ticker_changes = ticker_map.iloc[[0]].copy()
+    ticker_changes['sedol_hist_0'] = '690065'
+    ticker_changes['bb_code'] = '7203 JT Equity'
+    ticker_changes.insert(0, 'date', datetime.date(2024, 1, 10))
+    frames = {'ticker_map': ticker_map, 'ticker_changes': ticker_changes}
+    ids = __z_sedol_check_ids__
+    for at_date, expected in __z_sedol_check_result__.items():
+        result = resolve_z_sedol(build_z_sedol_maps(frames, at_date), ids['sedol'], ids['bb_code'], ids['isin'])
+        for this_col, values in expected.items():
+            # compared as str - the row by row version gave None, NaN and 'None' for missing ids
+            if [str(x) for x in result[this_col]] != [str(x) for x in values]:
+                raise ValueError('map_z_sedol ' + this_col + ' at ' + str(at_date) + ' is ' + str(list(result[this_col])) +
+                                 ' not ' + str(values))
+    return True
+
+
+# Security master - the ticker map (as of a date, from the ticker map snapshot) with hash indexes
+# on sedol, bb_code, isin, ric, fs_id_r and local code, for bulk resolution of identifiers.
+# Each index maps an id to the first ticker map row that has it, in the order of the columns in
+# __security_master_keys__. rics come from zimdb..trade_ticker_map and go through the bb_code index.
+# Inputs are cleaned like map_z_sedol - 7 char sedols are cut to 6, " Equity" is dropped and
+# bb_code country codes are mapped (JT -> JP etc)
+# Keep one instance for a run (get_security_master()) - the indexes are built once per as of date and
+# kept on the instance, or with the ticker map snapshot when enable_ticker_snapshot() is on so they are
+# rebuilt when the tables change. reference(as_of, refresh=True) rebuilds them
+# traded_bb_code() looks ids up in zimdb..trade_ticker_map instead and gives the traded bb_code, as the
+# recs use it - that table is read once per instance
+# Usage:
+# sm = get_security_master()
+# matched, misses = sm.resolve(holdings, keys=['sedol', 'bb_code', 'isin'], as_of=this_date)
+# holdings = holdings.join(matched[['z_sedol', 'z_bb_code', 'matched_on']])
+# df['bb_code'] = sm.traded_bb_code(['isin', 'sedol'], df['Investment'])
+__security_master_keys__ = {'sedol': ['sedol', 'sedol_hist_0', 'sedol_long', 'sedol_short', 'sedol_long_alt', 'sedol_short_alt',
+                                      'sedol_hist_1', 'sedol_hist_2', 'sedol_hist_3'],
+                            'bb_code': ['bb_code', 'bb_code_long', 'bb_code_short', 'bb_code_long_alt', 'bb_code_short_alt'],
+                            'isin': ['isin'],
+                            'fs_id_r': ['fs_id_r'],
+                            'local': ['local']}
+__security_master_columns__ = ['sedol', 'bb_code', 'isin', 'fs_id_r', 'local', 'name', 'currency', 'country_exchange']
+__security_masters__ = {}
+
+
+class SecurityMaster(object):
+    trade_sql = "select bb_code_traded, sedol_traded, isin, ric from zimdb..trade_ticker_map"
+
+    def __init__(self, alias='zim_ops', columns=None):
+        self.alias = alias
+        self.columns = list(__security_master_columns__ if columns is None else columns)
+        self.trade = None
+        self.refs = {}
+
+    @staticmethod
+    def clean(key, values):
+        values = pd.Series(list(values), dtype=object)
+        values = values.where(is_str_mask(values)).str.strip()
+        values = values.where(~values.isin(['', 'nan', 'NULL', 'NO_ID']))
+        if key == 'sedol':
+            short = (values.str.len() == 7) & ~values.str.contains('_', regex=False, na=False)
+            values = values.where(~short, values.str[:6])
+        elif key == 'bb_code':
+            values = values.str.replace(r'\s+Equity$', '', regex=True, case=False)
+            country = values.str[-2:].map(__bb_country_map__)
+            filt = (country.notnull() & ~values.str.contains('=', regex=False, na=False) & (values.str[-3:-2] == ' ')).values
+            values[filt] = values[filt].str[:-2] + country[filt]
+        return values.to_numpy(dtype=object)
+
+    def reference(self, as_of=None, refresh=False):
+        # the ticker map rows for the date and the {key: Series(id -> row)} indexes
+        def build(frames):
+            frame = hist_ticker_map(frames, as_of).reset_index(drop=True)
+            indexes = {}
+            for key, cols in __security_master_keys__.items():
+                cols = [x for x in cols if x in frame.columns]
+                ids = np.concatenate([self.clean(key, frame[x]) for x in cols])
+                rows = np.tile(np.arange(len(frame)), len(cols))
+                found = is_str_mask(ids)
+                index = pd.Series(rows[found], index=ids[found])
+                indexes[key] = index[~index.index.duplicated()]
+            trade = self.traded()[0]
+            rics = pd.DataFrame({'ric': trade['ric'].to_numpy(dtype=object),
+                                 'row': lookup_or(indexes['bb_code'], self.clean('bb_code', trade['bb_code_traded']),
+                                                  np.full(len(trade), -1, dtype=object))})
+            rics = rics.loc[is_str_mask(rics['ric']) & (rics['row'] != -1).values].drop_duplicates('ric')
+            indexes['ric'] = pd.Series(rics['row'].values.astype(int), index=rics['ric'].values)
+            return frame, indexes
+        key = ('security_master', self.alias, as_of)
+        if __ticker_snapshot__['on']:
+            return ticker_snapshot_cached(key, build, as_of)
+        with __ticker_snapshot_lock__:
+            value = None if refresh else self.refs.get(as_of)
+        if value is None:
+            value = ticker_snapshot_cached(key, build, as_of)
+            with __ticker_snapshot_lock__:
+                self.refs[as_of] = value
+                while len(self.refs) > __ticker_snapshot_max_maps__:
+                    del self.refs[next(iter(self.refs))]
+        return value
+
+    # zimdb..trade_ticker_map and {key: Series(id -> traded bb_code)} indexes on sedol, isin and ric
+    # bb_code is bb_code_traded without " Equity" and Thai foreign / NVDR lines get their own ric
+    # (XXX.BK -> XXX_f.BK / XXX_n.BK). The first row for an id wins
+    def traded(self, refresh=False):
+        if self.trade is not None and not refresh:
+            return self.trade
+        tmp = exec_sql(self.trade_sql, alias=self.alias)
+        bb_code_traded = pd.Series(list(tmp['bb_code_traded']), dtype=object)
+        bb_code = bb_code_traded.where(~bb_code_traded.str.endswith('Equity', na=False),
+                                       bb_code_traded.str.split('Equity', n=1, regex=False).str[0].str[:-1])
+        ric = pd.Series(self.clean('ric', tmp['ric']), dtype=object)
+        for board, suffix in [('/F TB', '_f.BK'), ('-R TB', '_n.BK')]:
+            filt = (bb_code_traded.str.contains(board, regex=False, na=False) & ric.str.contains('.BK', regex=False, na=False)).values
+            ric[filt] = ric[filt].str.split('.BK', n=1, regex=False).str[0] + suffix
+        frame = pd.DataFrame({'bb_code': bb_code.to_numpy(dtype=object), 'bb_code_traded': bb_code_traded.to_numpy(dtype=object),
+                              'sedol': list(tmp['sedol_traded']), 'isin': list(tmp['isin']), 'ric': ric.to_numpy(dtype=object)})
+        indexes = {}
+        for key in ['sedol', 'isin', 'ric']:
+            ids = self.clean(key, frame[key])
+            found = is_str_mask(ids)
+            index = pd.Series(frame['bb_code'].values[found], index=ids[found])
+            indexes[key] = index[~index.index.duplicated()]
+        self.trade = (frame, indexes)
+        return self.trade
+
+    # The traded bb_code for each value (NaN where not found) - keys are tried in order
+    def traded_bb_code(self, keys, values):
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        indexes = self.traded()[1]
+        result = np.full(len(values), np.nan, dtype=object)
+        for key in keys:
+            ids = self.clean(key, values)
+            result = np.where(is_str_mask(result), result, lookup_or(indexes[key], ids, result))
+        return result
+
+    # Row of the ticker map for each value (-1 where not found)
+    def lookup(self, key, values, as_of=None):
+        return self.find_rows(self.reference(as_of)[1][key], key, values)
+
+    @classmethod
+    def find_rows(cls, index, key, values):
+        ids = cls.clean(key, values)
+        pos = index.index.get_indexer(ids)
+        rows = np.full(len(ids), -1)
+        rows[pos >= 0] = index.values[pos[pos >= 0]]
+        return rows
+
+    # Resolve the ids in frame - keys are tried in order, each only for the rows not matched yet
+    # key_cols = {key: frame column} where the frame column names differ from the keys
+    # returns (matched, misses) - matched has the z_<column> values of the ticker map row and
+    # matched_on (the key used) with the frame's index, misses the frame rows nothing matched
+    def resolve(self, frame, keys=('sedol', 'bb_code', 'isin'), as_of=None, key_cols=None, columns=None):
+        key_cols = dict(key_cols or {})
+        columns = self.columns if columns is None else list(columns)
+        ref, indexes = self.reference(as_of)
+        rows = np.full(len(frame), -1)
+        matched_on = np.full(len(frame), np.nan, dtype=object)
+        for key in keys:
+            if key not in indexes:
+                raise ValueError('Unknown key ' + key + ' - use one of ' + str(list(indexes.keys())))
+            need = rows == -1
+            if not need.any():
+                break
+            this_col = key_cols.get(key, key)
+            if this_col not in frame.columns:
+                continue
+            found = self.find_rows(indexes[key], key, frame[this_col].values[need])
+            tmp = rows[need]
+            tmp[found >= 0] = found[found >= 0]
+            rows[need] = tmp
+            tmp = matched_on[need]
+            tmp[found >= 0] = key
+            matched_on[need] = tmp
+        hit = rows >= 0
+        matched = pd.DataFrame(index=frame.index)
+        for this_col in columns:
+            values = np.full(len(frame), np.nan, dtype=object)
+            values[hit] = ref[this_col].values[rows[hit]]
+            matched['z_' + this_col] = values
+        matched['matched_on'] = matched_on
+        misses = frame.loc[~hit, [key_cols.get(x, x) for x in keys if key_cols.get(x, x) in frame.columns]]
+        return matched, misses
+
+    # Resolve (id, date) pairs across many dates in one pass with the point in time index
+    # returns z_<column> values with the frame's index
+    def resolve_dates(self, frame, key='sedol', date_col='date', key_col=None, columns=None):
+        columns = self.columns if columns is None else list(columns)
+        tmp = get_ticker_asof_index(key).resolve(frame[key_col or key], frame[date_col], columns=columns)
+        tmp.columns = ['z_' + x for x in tmp.columns]
+        tmp.index = frame.index
+        return tmp
+
+
+# Point in time index over ticker_map / ticker_changes for one id column (sedol, bb_code, isin ...)
+# Every version of a row is kept with its [valid_from, valid_to) dates - a ticker_changes row holds the
+# values in force before its date, the ticker_map row those from the last change on - the same
+# versions get_hist_ticker_map(date) picks for the id. resolve() answers any number of (id, date)
+# pairs in one searchsorted pass over (id, valid_to), so a backfill needs one load instead of a map
+# per date. Ids are cleaned like SecurityMaster, a date of None gives the current values
+# Usage:
+# idx = get_ticker_asof_index('sedol')
+# bb = idx.resolve(holdings['sedol'], holdings['date'], columns=['bb_code'])['bb_code']
+__asof_day_offset__ = 1000000
+__asof_day_span__ = 10000000
+
+
+class TickerAsOfIndex(object):
+    def __init__(self, key, frames):
+        self.key = key
+        current = frames['ticker_map'].copy()
+        current['valid_to'] = __asof_day_span__ - 1
+        changes = frames['ticker_changes'].copy()
+        changes['valid_to'] = self.days(changes['date'])
+        self.columns = [x for x in current.columns if x != 'valid_to']
+        records = pd.concat([changes[self.columns + ['valid_to']], current[self.columns + ['valid_to']]], ignore_index=True)
+        ids = SecurityMaster.clean(key, records[key])
+        keep = is_str_mask(ids)
+        records = records.loc[keep].reset_index(drop=True)
+        self.ids = pd.Index(pd.unique(ids[keep]))
+        codes = self.ids.get_indexer(ids[keep])
+        # the first row for an id and date wins, as in get_hist_ticker_map
+        order = np.lexsort((records['valid_to'].values, codes))
+        codes = codes[order]
+        records = records.iloc[order].reset_index(drop=True)
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (records['valid_to'].values[1:] != records['valid_to'].values[:-1])
+        self.codes = codes[first]
+        self.records = records.loc[first].reset_index(drop=True)
+        valid_to = self.records['valid_to'].values.astype('int64')
+        valid_from = np.full(len(valid_to), 0, dtype='int64')
+        same = np.zeros(len(valid_to), dtype=bool)
+        same[1:] = self.codes[1:] == self.codes[:-1]
+        valid_from[same] = valid_to[:-1][same[1:]]
+        self.records['valid_from'] = valid_from
+        self.sort_key = self.codes.astype('int64') * __asof_day_span__ + valid_to
+
+    @staticmethod
+    def days(dates):
+        dates = pd.to_datetime(pd.Series(dates).reset_index(drop=True) if hasattr(dates, 'dtype') else pd.Series(list(dates)), errors='coerce')
+        result = dates.values.astype('datetime64[D]').astype('int64') + __asof_day_offset__
+        return np.where(dates.isnull().values, __asof_day_span__ - 2, result)
+
+    @staticmethod
+    def to_date(days, open_value):
+        days = np.asarray(days, dtype='int64')
+        result = (days - __asof_day_offset__).astype('datetime64[D]').astype(object)
+        result[days == open_value] = None
+        return result
+
+    # columns of the version in force for each (id, date), NaN where the id is unknown
+    # valid_from / valid_to are None for open ends
+    def resolve(self, ids, dates, columns=None):
+        columns = self.columns if columns is None else list(columns)
+        ids = SecurityMaster.clean(self.key, ids)
+        codes = self.ids.get_indexer(ids)
+        days = self.days(dates)
+        if len(ids) != len(days):
+            raise ValueError('ids and dates must be the same length')
+        pos = np.searchsorted(self.sort_key, codes.astype('int64') * __asof_day_span__ + days, side='right')
+        pos = np.minimum(pos, len(self.codes) - 1)
+        hit = (codes >= 0) & (len(self.codes) > 0)
+        hit[hit] = self.codes[pos[hit]] == codes[hit]
+        result = pd.DataFrame(index=range(len(ids)))
+        for this_col in columns + ['valid_from', 'valid_to']:
+            values = np.full(len(ids), np.nan, dtype=object)
+            values[hit] = self.records[this_col].values[pos[hit]]
+            if this_col in ['valid_from', 'valid_to']:
+                values[hit] = self.to_date(values[hit], 0 if this_col == 'valid_from' else __asof_day_span__ - 1)
+            result[this_col] = values
+        return result
+
+
+def get_ticker_asof_index(key='sedol'):
+    return ticker_snapshot_cached(('asof', key), lambda frames: TickerAsOfIndex(key, frames), all_changes=True)
+
+
+# One SecurityMaster per alias for the whole run
+def get_security_master(alias='zim_ops'):
+    with __ticker_snapshot_lock__:
+        if alias not in __security_masters__:
+            __security_masters__[alias] = SecurityMaster(alias)
+        return __security_masters__[alias]
 
 
 # special xml spreadsheet file reader to handle the malformed XML Spreadsheet files
@@ -1210,14 +3894,14 @@ def get_india_futures_as_it_was(start_date=datetime.datetime.now().date()):
 
 def get_web_account(name, account_type=None):
     datetoday = datetime.date.today()
-    sqlmain = "select * from zimdb..web_scraping_accounts where web_name = '" + name + "'"
-    sqldate = "select max(date) from zimdb..web_scraping_accounts where  date <= '" + \
-        str(datetoday) + "' and web_name = '" + name + "'"
+    sqlmain = "select * from zimdb..web_scraping_accounts where web_name = :name"
+    sqldate = "select max(date) from zimdb..web_scraping_accounts where  date <= :datetoday and web_name = :name"
     if account_type:
-        sqlmain = sqlmain + " and account_type = '" + account_type + "'"
-        sqldate = sqldate + " and account_type = '" + account_type + "'"
-    sql = sqlmain + ' and date in (' + sqldate + ')'
-    acc = exec_sql(sql)
+        sqlmain = sqlmain + " and account_type = :account_type"
+        sqldate = sqldate + " and account_type = :account_type"
+    sql, params = sql_bind(sqlmain + ' and date in (' + sqldate + ')',
+                           name=name, datetoday=datetoday, account_type=account_type)
+    acc = exec_sql(sql, params=params)
     if len(acc) > 1:
         raise Exception(
             'Non unique accounts returned from web_scraping_accounts')
@@ -1227,64 +3911,135 @@ def get_web_account(name, account_type=None):
     return acc
 
 
-def create_table(df, table_name, db='', keys=[], drop_if_exists=True, type_map=None, strlen=50, step_size=1e100, verbose=False):
+# SQL type per column worked out over the whole column (nulls ignored) - {col: 'varchar(12)', ...}
+# ints -> int / bigint from the value range, strings -> varchar sized to the longest value,
+# dates -> date unless there is a time part. sedol is always varchar(15)
+# type_map overrides a column with a sql type string or a python type, which gets the sql type
+# create_table has always given it (__create_table_types__ - str is varchar(strlen), 50 by default,
+# and int varchar(50)); a python type not in there raises ValueError. strlen fixes the varchar width
+__create_table_types__ = {str: 'varchar', float: 'float', np.float64: 'float', bool: 'bit',
+                          datetime.date: 'date', datetime.datetime: 'date', np.datetime64: 'date', pd.Timestamp: 'date',
+                          int: 'varchar(50)', np.int64: 'varchar(50)'}
+
+
+def sql_column_types(df, type_map=None, strlen=None):
+    type_map = type_map or {}
+    result = {}
+    for this_col in df.columns:
+        values = df[this_col]
+        if this_col in type_map and type(type_map[this_col]) == str:
+            result[this_col] = type_map[this_col]
+            continue
+        if this_col == 'sedol':
+            result[this_col] = 'varchar(15)'
+            continue
+        if this_col in type_map:
+            if type_map[this_col] not in __create_table_types__:
+                raise ValueError('No sql type for ' + str(type_map[this_col]) + ' (column ' + str(this_col) + ')')
+            kind = __create_table_types__[type_map[this_col]]
+            result[this_col] = 'varchar(' + str(int(50 if strlen is None else strlen)) + ')' if kind == 'varchar' else kind
+            continue
+        inferred = pd.api.types.infer_dtype(values, skipna=True)
+        if inferred == 'boolean':
+            kind = 'bit'
+        elif inferred == 'integer':
+            kind = 'int'
+        elif inferred in ['floating', 'mixed-integer-float', 'decimal']:
+            kind = 'float'
+        elif inferred in ['datetime64', 'datetime', 'date']:
+            kind = 'date'
+        else:
+            kind = 'varchar'
+        if kind == 'int':
+            num = pd.to_numeric(values, errors='coerce')
+            kind = 'int' if num.isnull().all() or (num.min() >= -2**31 and num.max() < 2**31) else 'bigint'
+        elif kind in ['date', 'datetime']:
+            stamps = pd.to_datetime(values, errors='coerce') if not pd.api.types.is_datetime64_any_dtype(values) else values
+            kind = 'date' if (stamps.dropna() == stamps.dropna().dt.normalize()).all() else 'datetime'
+        elif kind == 'float' and values.dtype == np.float32:
+            kind = 'real'
+        elif kind == 'varchar':
+            if strlen is None:
+                width = values.dropna().astype(str).str.len().max()
+                width = 50 if pd.isnull(width) else max(int(width), 1)
+            else:
+                width = int(strlen)
+            kind = 'varchar(' + ('max' if width > 8000 else str(width)) + ')'
+        result[this_col] = kind
+    return result
+
+
+# Create a table from a df and load it. The create, the load (TABLOCK so a bulk load into the new heap
+# is minimally logged) and the primary key are one transaction, so a failed load leaves no table.
+# With step_size / workers the table is created first and loaded by load_to_table
+def create_table(df, table_name, db='', keys=[], drop_if_exists=True, type_map=None, strlen=None, step_size=1e100, verbose=False, workers=1,
+                 alias='zim_ops', engine=None, keepnulls=True, encoding=None):
     df = df.copy()
     if type(df.index.name) != type(None):
         df = df.reset_index()
-    if drop_if_exists and sql_table_exists(table_name, db=db):
-        if db == '':
-            dropsql = "DROP TABLE " + table_name
-        else:
-            dropsql = "DROP TABLE " + db + ".." + table_name
+    if type_map is not None and type(type_map) != dict:
+        type_map = dict(zip(df.columns, type_map))
+    full_name = ('' if db == '' or db is None else (db + "..")) + table_name
+    if drop_if_exists and sql_table_exists(table_name, db=db, alias=alias):
         # Execute the drop
-        exec_sql(dropsql, isselect=0)
+        exec_sql("DROP TABLE " + full_name, isselect=0, alias=alias)
+        invalidate_schema_cache(table_name, db=db)
     # now clear to create the table
-    if type_map is None:
-        cols = pd.Series([type(x) for x in df.iloc[0]])
-        cols.index = df.columns
-    else:
-        cols = pd.Series(type_map, index=df.columns)
-    sqlcmd = "CREATE TABLE " + ('' if db ==
-                                '' else (db + "..")) + table_name + " ("
-    first_col = True
-    for this_col, this_type in pd.DataFrame(cols).iterrows():
-        if (this_col == 'sedol'):
-            sqlcmd = sqlcmd + (", " if not first_col else '') + \
-                "[" + this_col + "] varchar(15) " + \
-                ("NOT " if this_col in keys else '') + "NULL"
-        elif this_type[0] in [datetime.date, np.datetime64, datetime.datetime, pd.tslib.Timestamp]:
-            sqlcmd = sqlcmd + (", " if not first_col else '') + \
-                "[" + this_col + "] date " + \
-                ("NOT " if this_col in keys else '') + "NULL"
-        elif this_type[0] in [str]:
-            sqlcmd = sqlcmd + (", " if not first_col else '') + "[" + this_col + "] varchar(" + str(
-                int(strlen)) + ") " + ("NOT " if this_col in keys else '') + "NULL"
-        elif this_type[0] in [float, np.float64]:
-            sqlcmd = sqlcmd + (", " if not first_col else '') + \
-                "[" + this_col + "] float " + \
-                ("NOT " if this_col in keys else '') + "NULL"
-        elif this_type[0] in [bool]:
-            sqlcmd = sqlcmd + (", " if not first_col else '') + \
-                "[" + this_col + "] bit " + \
-                ("NOT " if this_col in keys else '') + "NULL"
-        else:
-            sqlcmd = sqlcmd + (", " if not first_col else '') + \
-                "[" + this_col + "] varchar(50) " + \
-                ("NOT " if this_col in keys else '') + "NULL"
-        first_col = False
-    sqlcmd = sqlcmd + ")  ON [PRIMARY]"
-    exec_sql(sqlcmd, isselect=0)
+    cols = sql_column_types(df, type_map=type_map, strlen=strlen)
+    sqlcreate = "CREATE TABLE " + full_name + " (" + \
+        ", ".join(["[" + x + "] " + y + " " + ("NOT " if x in keys else '') + "NULL" for x, y in cols.items()]) + \
+        ")  ON [PRIMARY]"
+    sqlkey = ''
     if len(keys) > 0:
-        sqlcmd = "ALTER TABLE "+('' if db == '' else (db + "..")) + table_name + " ADD CONSTRAINT PK_" + \
+        sqlkey = "ALTER TABLE " + full_name + " ADD CONSTRAINT PK_" + \
             table_name+"_"+str(round(random.random()*1e8)
                                )+" PRIMARY KEY CLUSTERED ("
-        sqlcmd = sqlcmd + ", ".join(keys)
-        sqlcmd = sqlcmd + \
+        sqlkey = sqlkey + ", ".join(keys)
+        sqlkey = sqlkey + \
             ") WITH( STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, ALLOW_ROW_LOCKS = ON, ALLOW_PAGE_LOCKS = ON) ON [PRIMARY]"
-        exec_sql(sqlcmd, isselect=0)
-    if len(df) > 0:
-        load_to_table(df, table_name, db=db,
-                      step_size=step_size, verbose=verbose)
+    if len(df) == 0 or step_size < len(df) or workers > 1:
+        exec_sql(sqlcreate, isselect=0, alias=alias)
+        invalidate_schema_cache(table_name, db=db)
+        if sqlkey != '':
+            exec_sql(sqlkey, isselect=0, alias=alias)
+        if len(df) > 0:
+            load_to_table(df, table_name, db=db, step_size=step_size, verbose=verbose, workers=workers, alias=alias,
+                          engine=engine, keepnulls=keepnulls, encoding=encoding)
+        return len(df)
+    if engine is None:
+        engine = get_load_engine(alias)
+    tstart = time.time()
+    try:
+        if engine == 'executemany':
+            rowcount = insert_rows(df, full_name + ('' if is_local_alias(alias) else ' WITH (TABLOCK)'), pre_sql_cmd=sqlcreate,
+                                   post_sql_cmd=sqlkey, alias=alias)
+        else:
+            fileloc = bulk_tmp_file()
+            if encoding:
+                df.to_csv(fileloc, index=False, encoding=encoding)
+            else:
+                df.to_csv(fileloc, index=False)
+            randname = str(round(random.random()*1e15))
+            sqltransaction = "begin transaction t_" + randname + "; " + \
+                "SET NOCOUNT ON; " + sqlcreate + "; SET NOCOUNT OFF; " + \
+                bulk_insert(fileloc, full_name, rterm='\\n', keepnulls=keepnulls, returnsql=True, encoding=encoding, tablock=True) + "; " + \
+                ("SET NOCOUNT ON; " + sqlkey + "; " if sqlkey != '' else '') + \
+                "commit transaction t_" + randname + "; "
+            if verbose:
+                print("AT " + str(datetime.datetime.now()) + " SQL : " + sqltransaction)
+            rowcount = exec_sql(sqltransaction, isselect=0, alias=alias)
+            silentremove(fileloc)
+    except Exception as e:
+        trace_sql('load', 'create_table ' + full_name, alias, tstart, nbytes=load_trace_bytes(df), error=e)
+        invalidate_schema_cache(table_name, db=db)
+        raise
+    trace_sql('load', 'create_table ' + full_name, alias, tstart, rows=rowcount, nbytes=load_trace_bytes(df))
+    invalidate_schema_cache(table_name, db=db)
+    invalidate_result_cache([table_name])
+    if rowcount != len(df):
+        print("table " + table_name + " expected " + str(len(df)) + " got " + str(rowcount))
+        raise Exception('Bulk upload in create_table failed')
+    return rowcount
 
 
 def df_restore_date_index(df, datecol='date', inplace=False):
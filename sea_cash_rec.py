@@ -73,14 +73,8 @@ ticker_map = ou.exec_sql(
 
 
 def load_zen_unwind_performance(broker, date, ops_param):
-	sql = """SELECT *
-		FROM zimdb_ops..{0}
-		WHERE date_settle = '{1}'
-		AND prime = '{2}'
-		AND event = 'close trade'
-		AND on_swap = 'SWAP'
-	""".format(ops_param['cash_tickets_table'], date, broker)
-	df = ou.exec_sql(sql)
+	df = ou.read_table(ops_param['cash_tickets_table'], 'zimdb_ops',
+					   where={'date_settle': date, 'prime': broker, 'event': 'close trade', 'on_swap': 'SWAP'})
 	if df.empty:
 		logger.warning('There is no ZEN swap unwind cashflow on settle date = {} for broker {}'.format(date, broker))
 	return df
@@ -317,10 +311,10 @@ def load_zen_settled_cash_div(broker, date, ops_param):
 		FROM zimdb_ops..{}
 		WHERE event = 'cash dividend'
 		AND currency = 'USD'
-		AND date_settle = '{}'
-		AND prime = '{}'
-	""".format(ops_param['cash_tickets_table'], date, broker)
-	df = ou.exec_sql(sql)
+		AND date_settle = ?
+		AND prime = ?
+	""".format(ops_param['cash_tickets_table'])
+	df = ou.exec_sql(sql, params=[date, broker])
 	if df.empty:
 		logger.warning('There is no ZEN cash dividend settled on  {} for broker {}'.format(date, broker))
 	return df
@@ -10,22 +10,8 @@ code_path = r'S:\\Operations\Workflow\zim_ops'
 sys.path.append(code_path)
 import ops_utils as ou
 
-ticker_map = ou.exec_sql("""SELECT
-                            CASE
-                                WHEN bb_code_traded LIKE '%Equity' THEN SUBSTRING(bb_code_traded, 1, CHARINDEX('Equity',bb_code_traded)-2 )
-                                ELSE bb_code_traded
-                            END AS bb_code,
-                            sedol_traded AS sedol,
-                            isin,
-                            CASE
-                                WHEN bb_code_traded LIKE '%/F TB%' AND CHARINDEX('.BK',ric) > 0 
-                                    THEN SUBSTRING(ric, 1, CHARINDEX('.BK',ric)-1) + '_f.BK'
-                                WHEN bb_code_traded LIKE '%-R TB%' AND CHARINDEX('.BK',ric) > 0
-                                    THEN SUBSTRING(ric, 1, CHARINDEX('.BK',ric)-1) + '_n.BK'
-                                ELSE ric
-                            END AS ric
-                            FROM zimdb..trade_ticker_map
-                            """)
+# trade_ticker_map bb_codes by isin / sedol / ric - read once and shared by both recs
+security_master = ou.get_security_master()
 
 def get_ssnc_CFD_valuation(file_path):
     df = pd.read_excel(file_path,skiprows=11)
@@ -51,7 +37,7 @@ def get_zen_CFD_valuation(ops_param, date):
         [fx_rate_now]
     FROM zimdb_ops..{0}
     WHERE 
-        date = '{1}'
+        date = ?
         AND on_swap = 'SWAP'
     )
 
@@ -71,8 +57,8 @@ def get_zen_CFD_valuation(ops_param, date):
         [price_local_now],
         [fx_rate_now]
     ORDER BY [bb_code]
-    """.format(ops_param['holdings_table'], date)
-    df = ou.exec_sql(sqlcmd)
+    """.format(ops_param['holdings_table'])
+    df = ou.exec_sql(sqlcmd, params=[date])
     return df
 
 def get_zen_PHYSICAL_valuation(ops_param, date):
@@ -82,12 +68,12 @@ def get_zen_PHYSICAL_valuation(ops_param, date):
     SUM(quantity_adj*price_local_now/fx_rate_now) AS [MV],
     [fx_rate_now]
     FROM zimdb_ops..{0}
-    WHERE date = '{1}'
+    WHERE date = ?
     AND on_swap = 'PHYSICAL'
     AND bb_code not LIKE '%CASH%'
     GROUP BY bb_code,price_local_now, fx_rate_now
-    """.format(ops_param['holdings_table'], date)
-    df = ou.exec_sql(sqlcmd)
+    """.format(ops_param['holdings_table'])
+    df = ou.exec_sql(sqlcmd, params=[date])
     return df
 
 
@@ -96,11 +82,7 @@ def reconcile_PHYSICAL_valuations(file_path, date, ops_param):
     df_zen = get_zen_PHYSICAL_valuation(ops_param, date)
     # adding bb_code to df_fa (map on ISIN + SEDOL), force map on CUSIP)
     df_fa['Investment'] = [i[:6] if len(i)==7 else i for i in df_fa['Investment']] #cut sedol to 6 digits
-    df_fa = df_fa.merge(ticker_map[['isin','bb_code']], left_on='Investment', right_on='isin', how='left')
-    df_fa = df_fa.merge(ticker_map[['sedol', 'bb_code']], left_on='Investment', right_on='sedol', how='left')
-    # combine two bb_code columns
-    df_fa['bb_code'] = df_fa['bb_code_x'].combine_first(df_fa['bb_code_y'])
-    df_fa = df_fa.drop(['bb_code_x', 'bb_code_y'], axis=1)
+    df_fa['bb_code'] = security_master.traded_bb_code(['isin', 'sedol'], df_fa['Investment'])
     manual_map = {
         'TLI/F_TB':'TLI/F TB',
         '81141R100':'SE US',
@@ -139,7 +121,7 @@ def reconcile_CFD_valuations(file_path,date,ops_param):
     df_zen = get_zen_CFD_valuation(ops_param, date)
     #adding bb_code to df_fa (map on RIC)
     df_fa['Investment'] = df_fa['Investment'].str.replace('.USDDEC30','').str.replace('_N','_n').str.replace('F.BK','_f.BK').str.replace('N.BK','_n.BK')
-    df_fa = df_fa.merge(ticker_map[['ric', 'bb_code']], left_on='Investment', right_on='ric', how='left')
+    df_fa['bb_code'] = security_master.traded_bb_code('ric', df_fa['Investment'])
     manual_map = {
         'AMAT_f.BK': 'AMATA/F TB',
         'CELC.KL': 'CDB MK',